@@ -10,6 +10,8 @@ from numpy.linalg import inv
 import os
 import os.path
 from scipy import ndimage
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
 
 #*************************************************************************************************************************
 #***Written by K. Krycka to automatically group and reduce unpol, half-pol, and full-pol data on VSANS and NG7SANS.
@@ -47,20 +49,52 @@ def AllSANS_ReadIn_UserInput():
 
     return Contents
 
-def get_by_filenumber(Detector_Panels, Instrument, input_path, filenumber, cache=True):
+#Process-wide pool of open data files shared by get_by_filenumber. Handles are kept open (read-only) and reused;
+#once more than MaxOpenFiles are open the least recently used handle is closed. MaxOpenFiles may be set in the user input.
+MaxOpenFiles = 64
+file_objects = OrderedDict()
+file_objects_stats = {'hits': 0, 'misses': 0, 'evictions': 0}
+
+def get_pooled_file(fullpath, cache=True):
+
+    if cache and fullpath in file_objects:
+        file_object = file_objects[fullpath]
+        if file_object.id.valid:
+            file_objects.move_to_end(fullpath)
+            file_objects_stats['hits'] += 1
+            return file_object
+        del file_objects[fullpath]
+    if not os.path.isfile(fullpath):
+        return None
+    file_object = h5py.File(fullpath, 'r')
+    if cache:
+        file_objects_stats['misses'] += 1
+        file_objects[fullpath] = file_object
+        Max_Open = max(int(MaxOpenFiles), 4) #callers may hold a scattering file plus its transmission files at once
+        while len(file_objects) > Max_Open:
+            old_path, old_object = file_objects.popitem(last=False)
+            old_object.close()
+            file_objects_stats['evictions'] += 1
+    return file_object
+
+def close_pooled_files(report=True):
+
+    while len(file_objects) > 0:
+        old_path, old_object = file_objects.popitem(last=False)
+        old_object.close()
+    if report:
+        print('File handle pool:', file_objects_stats['hits'], 'hits,', file_objects_stats['misses'], 'misses,', file_objects_stats['evictions'], 'evictions')
+    return
 
-    file_objects = {}
+def get_by_filenumber(Detector_Panels, Instrument, input_path, filenumber, cache=True):
+    #With cache=True the handle stays in the shared pool and must not be closed by the caller;
+    #with cache=False a fresh handle is returned and the caller is responsible for closing it.
     if 'VSANS' in Instrument:
         filename = "sans" + str(filenumber) + ".nxs.ngv"
     elif 'NG7SANS' in Instrument:
         filename = "sans" + str(filenumber) + ".nxs.ng7"
     fullpath = os.path.join(input_path, filename)
-    if os.path.isfile(fullpath):
-        file_object = h5py.File(fullpath, 'r')
-        file_objects[filenumber] = file_object
-        return file_object
-    else:
-        return None
+    return get_pooled_file(fullpath, cache)
 
 def GetBeamCenter(Detector_Panels, Instrument, input_path, filenumber, dshort, trans_max_width_pixels):
     #Uses f = get_by_filenumber(Detector_Panels, Instrument, input_path, filenumber)
@@ -330,11 +364,56 @@ def AllSANS_Config_ID(Detector_Panels, Instrument, input_path, filenumber):
 
     return Configuration_ID
 
+#Number of processes used to read the file headers while sorting (1 reads them one after another); may be set in the user input.
+HeaderScanWorkers = 4
+
+def AllSANS_ScanFile(Detector_Panels, Instrument, UsePolCorr, SampleDescriptionKeywordsToExclude, TransPanel, input_path, filenumber):
+    #Collects, for one file, everything AllSANS_SortDataAutomaticAlt reads from it
+
+    Scan = None
+    f = get_by_filenumber(Detector_Panels, Instrument, input_path, filenumber)
+    if f is not None:
+        Scan = {}
+        Scan['Sample'] = AllSANS_Sample_BaseNameDescrip(Detector_Panels, Instrument, SampleDescriptionKeywordsToExclude, input_path, filenumber)
+        Scan['Purpose'] = AllSANS_PurposeIntentPolarizationSolenoid(Detector_Panels, Instrument, UsePolCorr, input_path, filenumber)
+        Scan['Config'] = AllSANS_Config_ID(Detector_Panels, Instrument, input_path, filenumber)
+        Scan['Count_time'] = f['entry/collection_time'][0]
+        Scan['End_time'] = dateutil.parser.parse(f['entry/end_time'][0])
+        Trans_Counts_Path = 'entry/instrument/detector_{ds}/integrated_count'.format(ds=TransPanel)
+        if Trans_Counts_Path in f:
+            Scan['Trans_Counts'] = f[Trans_Counts_Path][0]
+        if 'backPolarization' in f['entry/DAS_logs/']:
+            for Field in ['timestamp', 'name', 'opacityAt1Ang', 'glassTransmission']:
+                if Field in f['entry/DAS_logs/backPolarization']:
+                    Scan['HE3_' + Field] = f['entry/DAS_logs/backPolarization/' + Field][0]
+        Scan['Wavelength'] = f['/entry/DAS_logs/wavelength/wavelength'][0]
+        Scan['HE3Type'] = str(f['entry/sample/description'][()])
+        if 'VSANS' in Instrument and 'entry/instrument/attenuator/num_atten_dropped' in f:
+            Scan['Attenuators'] = int(f['entry/instrument/attenuator/num_atten_dropped'][0])
+        elif 'NG7SANS' in Instrument and '/entry/DAS_logs/counter/actualAttenuatorsDropped' in f:
+            Scan['Attenuators'] = int(f['/entry/DAS_logs/counter/actualAttenuatorsDropped'][0])
+
+    return Scan
+
+def AllSANS_ScanWorkerInit():
+    #Worker processes must not reuse file handles inherited from the parent
+    file_objects.clear()
+
+def AllSANS_ScanFiles(Detector_Panels, Instrument, UsePolCorr, SampleDescriptionKeywordsToExclude, TransPanel, input_path, filenumbers):
+    #File reads are independent, so they are spread over HeaderScanWorkers processes; results come back in filenumbers order
+
+    N = len(filenumbers)
+    if HeaderScanWorkers > 1 and N > HeaderScanWorkers:
+        with ProcessPoolExecutor(max_workers = int(HeaderScanWorkers), initializer = AllSANS_ScanWorkerInit) as Pool:
+            Scans = list(Pool.map(AllSANS_ScanFile, [Detector_Panels]*N, [Instrument]*N, [UsePolCorr]*N, [SampleDescriptionKeywordsToExclude]*N, [TransPanel]*N, [input_path]*N, filenumbers, chunksize = 8))
+    else:
+        Scans = [AllSANS_ScanFile(Detector_Panels, Instrument, UsePolCorr, SampleDescriptionKeywordsToExclude, TransPanel, input_path, filenumber) for filenumber in filenumbers]
+
+    return Scans
+
 def AllSANS_SortDataAutomaticAlt(Detector_Panels, Instrument, UsePolCorr, SampleDescriptionKeywordsToExclude, TransPanel, input_path, YesNoManualHe3Entry, New_HE3_Files, MuValues, TeValues, Excluded_Filenumbers, Min_Filenumber, Max_Filenumber, Min_Scatt_Filenumber, Max_Scatt_Filenumber, Min_Trans_Filenumber, Max_Trans_Filenumber, ReAssignBlockBeamIntent, ReAssignEmptyIntent, ReAssignOpenIntent, ReAssignSampleIntent, YesNoRenameEmpties):
-    #Uses get_by_filenumber(Detector_Panels, Instrument, input_path, filenumber)
-    #Uses AllSANS_Sample_BaseNameDescrip(Detector_Panels, Instrument, input_path, filenumber)
-    #Uses AllSANS_PurposeIntentPolarizationSolenoid(Detector_Panels, Instrument, UsePolCorr, input_path, filenumber)
-    #Uses AllSANS_Config_ID(Detector_Panels, Instrument, input_path, filenumber)
+    #Uses AllSANS_ScanFiles(Detector_Panels, Instrument, UsePolCorr, SampleDescriptionKeywordsToExclude, TransPanel, input_path, filenumbers), which reads each file
+    #with AllSANS_Sample_BaseNameDescrip, AllSANS_PurposeIntentPolarizationSolenoid and AllSANS_Config_ID
     
     Sample_Names = {}
     Sample_Bases = {}
@@ -362,16 +441,18 @@ def AllSANS_SortDataAutomaticAlt(Detector_Panels, Instrument, UsePolCorr, Sample
     elif 'NG7SANS' in Instrument:
         filelist = [fn for fn in os.listdir(input_path) if fn.endswith(".nxs.ng7")] #or filenames = [fn for fn in os.listdir("./") if os.path.isfile(fn)]
     filelist.sort()
+    ScanNumbers = [int(filename[4:9]) for filename in filelist if int(filename[4:9]) >= Min_Filenumber and int(filename[4:9]) <= Max_Filenumber and int(filename[4:9]) not in Excluded_Filenumbers]
+    Scans = dict(zip(ScanNumbers, AllSANS_ScanFiles(Detector_Panels, Instrument, UsePolCorr, SampleDescriptionKeywordsToExclude, TransPanel, input_path, ScanNumbers)))
     if len(filelist) >= 1:
         for filename in filelist:
             filenumber = int(filename[4:9])
             if filenumber >= Min_Filenumber and filenumber <= Max_Filenumber and filenumber not in Excluded_Filenumbers:
                 if start_number == 0:
                     start_number = filenumber
-                f = get_by_filenumber(Detector_Panels, Instrument, input_path, filenumber)
-                if f is not None:
-                    Sample_Base, Sample_Name, Descrip, ListedConfig, Temp, Voltage = AllSANS_Sample_BaseNameDescrip(Detector_Panels, Instrument, SampleDescriptionKeywordsToExclude, input_path, filenumber)
-                    SiMirror, Purpose, Intent, PolarizationState, FrontPolDirection, BackPolDirection, SolenoidPosition = AllSANS_PurposeIntentPolarizationSolenoid(Detector_Panels, Instrument, UsePolCorr, input_path, filenumber)
+                Scan = Scans[filenumber]
+                if Scan is not None:
+                    Sample_Base, Sample_Name, Descrip, ListedConfig, Temp, Voltage = Scan['Sample']
+                    SiMirror, Purpose, Intent, PolarizationState, FrontPolDirection, BackPolDirection, SolenoidPosition = Scan['Purpose']
 
                     if filenumber in ReAssignBlockBeamIntent:
                         Intent = 'Block'
@@ -385,9 +466,9 @@ def AllSANS_SortDataAutomaticAlt(Detector_Panels, Instrument, UsePolCorr, Sample
                         Sample_Base = 'Empty'
                         Sample_Name = 'Empty'
                     
-                    Config = AllSANS_Config_ID(Detector_Panels, Instrument, input_path, filenumber)
-                    Count_time = f['entry/collection_time'][0]
-                    End_time = dateutil.parser.parse(f['entry/end_time'][0])
+                    Config = Scan['Config']
+                    Count_time = Scan['Count_time']
+                    End_time = Scan['End_time']
                     TimeOfMeasurement = (End_time.timestamp() - Count_time/2)/3600.0 #in hours
                     if filenumber not in Excluded_Filenumbers and 'UNKNOWN' not in Config and Count_time > 29: #and str(Descrip).find("Align") == -1 and str(Descrip).find("align") == -1:
                         print('Reading:', filenumber, ' ', Sample_Base, Descrip)
@@ -398,7 +479,7 @@ def AllSANS_SortDataAutomaticAlt(Detector_Panels, Instrument, UsePolCorr, Sample
                         if 'Block' in Intent:
                             if Config not in BlockBeam:
                                 BlockBeam[Config] = {'Scatt':{'File' : 'NA'}, 'Trans':{'File' : 'NA', 'CountsPerSecond' : 'NA'}, 'ExampleFile' : filenumber}
-                            Trans_Counts = f['entry/instrument/detector_{ds}/integrated_count'.format(ds=TransPanel)][0]
+                            Trans_Counts = Scan['Trans_Counts']
                             if 'TRANS' in Purpose or 'HE3' in Purpose:
                                 if 'NA' in BlockBeam[Config]['Trans']['File']:
                                     BlockBeam[Config]['Trans']['File'] = [filenumber]
@@ -600,18 +681,18 @@ def AllSANS_SortDataAutomaticAlt(Detector_Panels, Instrument, UsePolCorr, Sample
                                     CellIdentifier += 1
                                     CellName = CellTimeIdentifier
                             else:
-                                CellTimeIdentifier = f['/entry/DAS_logs/backPolarization/timestamp'][0]/3600000 #milliseconds to hours
-                                CellName = str(f['entry/DAS_logs/backPolarization/name'][0])
+                                CellTimeIdentifier = Scan['HE3_timestamp']/3600000 #milliseconds to hours
+                                CellName = str(Scan['HE3_name'])
                                 CellName = CellName[2:]
                                 CellName = CellName[:-1]
                                 CellName = CellName + str(CellTimeIdentifier)
                                 if CellTimeIdentifier not in HE3_Trans:
-                                    HE3Insert_Time = f['/entry/DAS_logs/backPolarization/timestamp'][0]/3600000 #milliseconds to hours
-                                    Opacity = f['/entry/DAS_logs/backPolarization/opacityAt1Ang'][0]
-                                    Wavelength = f['/entry/DAS_logs/wavelength/wavelength'][0]
+                                    HE3Insert_Time = Scan['HE3_timestamp']/3600000 #milliseconds to hours
+                                    Opacity = Scan['HE3_opacityAt1Ang']
+                                    Wavelength = Scan['Wavelength']
                                     ScaledOpacity = Opacity*Wavelength
-                                    TE = f['/entry/DAS_logs/backPolarization/glassTransmission'][0]
-                            HE3Type = str(f['entry/sample/description'][()])
+                                    TE = Scan['HE3_glassTransmission']
+                            HE3Type = Scan['HE3Type']
                             if 'OUT' in HE3Type:
                                 if Sample_Name not in Trans:
                                     Trans[Sample_Name] = {'Intent': Intent, 'Sample_Base': Sample_Base, 'Config(s)' : {Config : {'Unpol_Files': 'NA', 'U_Files' : 'NA', 'D_Files' : 'NA','Unpol_Trans_Cts': 'NA', 'U_Trans_Cts' : 'NA', 'D_Trans_Cts' : 'NA'}}}
@@ -635,18 +716,12 @@ def AllSANS_SortDataAutomaticAlt(Detector_Panels, Instrument, UsePolCorr, Sample
                                 HE3OUT_filenumber = filenumber
                                 HE3OUT_config = Config
                                 HE3OUT_sample = Sample_Name
-                                if 'VSANS' in Instrument:
-                                    HE3OUT_attenuators = int(f['entry/instrument/attenuator/num_atten_dropped'][0])
-                                elif 'NG7SANS' in Instrument:
-                                    HE3OUT_attenuators = int(f['/entry/DAS_logs/counter/actualAttenuatorsDropped'][0])
+                                HE3OUT_attenuators = Scan['Attenuators']
                             elif 'IN' in HE3Type:
                                 HE3IN_filenumber = filenumber
                                 HE3IN_config = Config
                                 HE3IN_sample = Sample_Name
-                                if 'VSANS' in Instrument:
-                                    HE3IN_attenuators = int(f['entry/instrument/attenuator/num_atten_dropped'][0])
-                                elif 'NG7SANS' in Instrument:
-                                    HE3IN_attenuators = int(f['/entry/DAS_logs/counter/actualAttenuatorsDropped'][0])
+                                HE3IN_attenuators = Scan['Attenuators']
                                 HE3IN_StartTime = TimeOfMeasurement
                                 if HE3OUT_filenumber > 0:
                                     if HE3OUT_config == HE3IN_config and HE3OUT_attenuators == HE3IN_attenuators and HE3OUT_sample == HE3IN_sample: #This implies that you must have a 3He out before 3He in of same config and atten
@@ -4081,9 +4156,13 @@ def main(python_config=None, json_config=None):
     FullPol_BaseToSampleMap, HalfPol_BaseToSampleMap, Unpol_BaseToSampleMap = VSANS_CatergorizeSamplesAndBases(He3Only_Check, Configs, Sample_Bases, Sample_Names, ScattCatalog, AllFullPolSlices,AllHalfPolSlices, AllUnpolSlices)
     VSANS_SaveComparativePlots(Slices, ScattCatalog, SectorCutAngles, save_path, FullPol_BaseToSampleMap, HalfPol_BaseToSampleMap, Unpol_BaseToSampleMap, AllFullPolSlices, AllHalfPolSlices, AllUnpolSlices, AllFullPolResults, AllHalfPolResults, AllUnpolResults, Configs, He3Only_Check, CompareUnpolCirc, CompareHalfPolSumCirc, CompareFullPolSumCirc, CompareFullPolStruc, CompareFullPolMagnetism)
     
+    close_pooled_files()
+
     #*************************************************
     #***           End of 'The Program'            ***
     #*************************************************
 
 if __name__ == '__main__':
+    import multiprocessing
+    multiprocessing.freeze_support()
     main(python_config="AllSANS_UserInput")
@@ -9,6 +9,7 @@ import datetime
 from numpy.linalg import inv
 from uncertainties import unumpy
 import os
+from concurrent.futures import ProcessPoolExecutor
 
 Scatt_filenumber = 95171
 Trans_filenumber = 95022
@@ -23,6 +24,7 @@ MuValues = [3.105, 3.374, 3.105, 3.374, 3.105, 3.374] #Default is []; Values onl
 TeValues = [0.86, 0.86, 0.86, 0.86, 0.86, 0.86] #Default is []; Values only used IF YesNoManualHe3Entry = 1; example [0.86, 0.86]=[Fras, Bur]; should not be needed after July 2019
 
 path = ''
+HeaderScanWorkers = 4 #Number of processes used to read the file headers while sorting; 1 reads them one after another
 
 def NG7SANS_Config_ID(filenumber):
 
@@ -45,6 +47,58 @@ def NG7SANS_Config_ID(filenumber):
         
     return Configuration_ID
 
+def NG7SANS_ScanFile(filename, Excluded):
+    #Reads, from one open file, every header field (and the summed detector counts) NG7SANS_SortData needs
+
+    Scan = None
+    config = Path(filename)
+    if config.is_file():
+        filenumber = int(filename[4:9])
+        f = h5py.File(filename, 'r')
+        Scan = {}
+        Scan['Count_time'] = f['entry/collection_time'][0]
+        Scan['Descrip'] = str(f['entry/sample/description'][0])
+        if Scan['Count_time'] > 29 and Scan['Descrip'][2:-1].find("Align") == -1 and not Excluded:
+            Scan['Listed_Config'] = str(f['entry/DAS_logs/configuration/key'][0])
+            Scan['Temp'] = 'NA'
+            if "temp" in f['entry/DAS_logs/']:
+                Scan['Temp'] = str(f['entry/DAS_logs/temp/desiredPrimaryNode'][(0)])
+            Scan['Voltage'] = 'NA'
+            if "adam4021" in f['entry/DAS_logs/']:
+                Scan['Voltage'] = str(f['entry/DAS_logs/adam4021/voltage'][(0)])
+            Scan['Type'] = str(f['entry/sample/description'][()])
+            Scan['End_time'] = dateutil.parser.parse(f['entry/end_time'][0])
+            Scan['Trans_Counts'] = np.sum(np.array(f['entry/instrument/detector/data']))
+            Scan['Config'] = NG7SANS_Config_ID(filenumber)
+            Scan['FrontPolDirection'] = [b'UNPOLARIZED']
+            if "frontPolarization" in f['entry/DAS_logs/']:
+                Scan['FrontPolDirection'] = f['entry/DAS_logs/frontPolarization/direction'][()]
+            Scan['BackPolDirection'] = [b'UNPOLARIZED']
+            if "backPolarization" in f['entry/DAS_logs/']:
+                Scan['BackPolDirection'] = f['entry/DAS_logs/backPolarization/direction'][()]
+                for Field in ['timestamp', 'name', 'opacityAt1Ang', 'glassTransmission']:
+                    if Field in f['entry/DAS_logs/backPolarization']:
+                        Scan['HE3_' + Field] = f['entry/DAS_logs/backPolarization/' + Field][0]
+            Scan['Wavelength'] = f['entry/DAS_logs/wavelength/wavelength'][0]
+            Scan['GuideHolder'] = f['entry/DAS_logs/guide/guide'][0]
+            if 'attenuator' in f['entry/instrument'] and 'num_atten_dropped' in f['entry/instrument/attenuator']:
+                Scan['Attenuators'] = int(f['entry/instrument/attenuator/num_atten_dropped'][0])
+        f.close()
+
+    return Scan
+
+def NG7SANS_ScanFiles(filelist):
+    #Header reads are independent, so they are spread over HeaderScanWorkers processes; results come back in filelist order
+
+    Excluded = [int(str(name)[4:9]) in Excluded_Filenumbers for name in filelist]
+    if HeaderScanWorkers > 1 and len(filelist) > HeaderScanWorkers:
+        with ProcessPoolExecutor(max_workers = int(HeaderScanWorkers)) as Pool:
+            Scans = list(Pool.map(NG7SANS_ScanFile, [str(name) for name in filelist], Excluded, chunksize = 8))
+    else:
+        Scans = [NG7SANS_ScanFile(str(name), Skip) for name, Skip in zip(filelist, Excluded)]
+
+    return Scans
+
 def NG7SANS_SortData(YesNoManualHe3Entry, New_HE3_Files, MuValues, TeValues):
     BlockBeam = {}
     Configs = {}
@@ -65,23 +119,22 @@ def NG7SANS_SortData(YesNoManualHe3Entry, New_HE3_Files, MuValues, TeValues):
     HE3OUT_filenumber = -10
     start_number = 0
     filelist = [fn for fn in os.listdir("./") if fn.endswith(".nxs.ng7")] #or filenames = [fn for fn in os.listdir("./") if os.path.isfile(fn)]
+    Scans = NG7SANS_ScanFiles(filelist)
     if len(filelist) >= 1:
-        for name in filelist:
+        for name, Scan in zip(filelist, Scans):
             filename = str(name)
             filenumber = int(filename[4:9])
             if start_number == 0:
                 start_number = filenumber
-            config = Path(filename)
-            if config.is_file():
-                f = h5py.File(filename)
-                Count_time = f['entry/collection_time'][0]
-                Descrip = str(f['entry/sample/description'][0])
+            if Scan is not None:
+                Count_time = Scan['Count_time']
+                Descrip = Scan['Descrip']
                 Descrip = Descrip[2:]
                 Descrip = Descrip[:-1]
                 if Count_time > 29 and str(Descrip).find("Align") == -1 and filenumber not in Excluded_Filenumbers:
                     FileNumberList.append(filenumber)
                     print('Reading:', filenumber, ' ', Descrip)
-                    Listed_Config = str(f['entry/DAS_logs/configuration/key'][0])
+                    Listed_Config = Scan['Listed_Config']
                     Listed_Config = Listed_Config[2:]
                     Listed_Config = Listed_Config[:-1]
                     Sample_Name = Descrip.replace(Listed_Config, '')
@@ -89,12 +142,12 @@ def NG7SANS_SortData(YesNoManualHe3Entry, New_HE3_Files, MuValues, TeValues):
                     for i in Not_Sample:
                         Sample_Name = Sample_Name.replace(i, '')
                     Desired_Temp = 'na'
-                    if "temp" in f['entry/DAS_logs/']:
-                        Desired_Temp = str(f['entry/DAS_logs/temp/desiredPrimaryNode'][(0)])
+                    if 'NA' != Scan['Temp']:
+                        Desired_Temp = Scan['Temp']
                         record_temp = 1    
                     Voltage = 'na'
-                    if "adam4021" in f['entry/DAS_logs/']:
-                        Voltage = str(f['entry/DAS_logs/adam4021/voltage'][(0)])
+                    if 'NA' != Scan['Voltage']:
+                        Voltage = Scan['Voltage']
                         record_adam4021 = 1
                     DT5 = Desired_Temp + " K,"
                     DT4 = Desired_Temp + " K"
@@ -133,27 +186,16 @@ def NG7SANS_SortData(YesNoManualHe3Entry, New_HE3_Files, MuValues, TeValues):
                         Intent = 'Blocked Beam'
                     if filenumber in ReAssignEmpty:
                         Intent = 'Empty'
-                    Type = str(f['entry/sample/description'][()])
-                    End_time = dateutil.parser.parse(f['entry/end_time'][0])
+                    Type = Scan['Type']
+                    End_time = Scan['End_time']
                     TimeOfMeasurement = (End_time.timestamp() - Count_time/2)/3600.0 #in hours
-                    data = np.array(f['entry/instrument/detector/data'])
-                    Trans_Counts = np.sum(data)
-                    MonCounts = f['entry/control/monitor_counts'][0]
-                    Trans_Distance = f['entry/instrument/detector/distance'][0]
-                    #Attenuation = f['entry/DAS_logs/attenuator/attenuator'][0] (VSANS)
-                    Attenuation = f['entry/DAS_logs/attenuator/key'][0]
-                    Wavelength = f['entry/DAS_logs/wavelength/wavelength'][0]
-                    Config = NG7SANS_Config_ID(filenumber)
-                    if "frontPolarization" in f['entry/DAS_logs/']:
-                        FrontPolDirection = f['entry/DAS_logs/frontPolarization/direction'][()]
-                    else:
-                        FrontPolDirection = [b'UNPOLARIZED']
-                    if "backPolarization" in f['entry/DAS_logs/']:
-                        BackPolDirection = f['entry/DAS_logs/backPolarization/direction'][()]
-                    else:
-                        BackPolDirection = [b'UNPOLARIZED']
-
-                    GuideHolder = f['entry/DAS_logs/guide/guide'][0]
+                    Trans_Counts = Scan['Trans_Counts']
+                    Wavelength = Scan['Wavelength']
+                    Config = Scan['Config']
+                    FrontPolDirection = Scan['FrontPolDirection']
+                    BackPolDirection = Scan['BackPolDirection']
+
+                    GuideHolder = Scan['GuideHolder']
                     if str(GuideHolder).find("CONV") == -1:
                         if int(GuideHolder) == 0:
                             FrontPolDirection = [b'UNPOLARIZED']
@@ -400,7 +442,7 @@ def NG7SANS_SortData(YesNoManualHe3Entry, New_HE3_Files, MuValues, TeValues):
                                         else:
                                             Pol_Trans[Sample_Name]['Config'].append(Config)
                         if str(Purpose).find("HE3") != -1:
-                            HE3Type = str(f['entry/sample/description'][()])
+                            HE3Type = Type
                             if HE3Type[-7:-2] == 'HeOUT':
                                 if Sample_Name not in Trans:
                                     Trans[Sample_Name] = {'Intent': Intent_short, 'Sample_Base': Sample_Base, 'Config(s)' : {Config : {'Unpol_Files': 'NA', 'U_Files' : 'NA', 'D_Files' : 'NA','Unpol_Trans_Cts': 'NA', 'U_Trans_Cts' : 'NA', 'D_Trans_Cts' : 'NA'}}}
@@ -418,28 +460,28 @@ def NG7SANS_SortData(YesNoManualHe3Entry, New_HE3_Files, MuValues, TeValues):
                                     HE3Insert_Time = (End_time.timestamp() - Count_time)/3600.0
                                     CellIdentifier += 1    
                             else:
-                                CellTimeIdentifier = f['/entry/DAS_logs/backPolarization/timestamp'][0]/3600000 #milliseconds to hours
-                                CellName = str(f['entry/DAS_logs/backPolarization/name'][0])
+                                CellTimeIdentifier = Scan['HE3_timestamp']/3600000 #milliseconds to hours
+                                CellName = str(Scan['HE3_name'])
                                 CellName = CellName[2:]
                                 CellName = CellName[:-1]
                                 CellName = CellName + str(CellTimeIdentifier)
-                                CellTimeIdentifier = f['/entry/DAS_logs/backPolarization/timestamp'][0]/3600000 #milliseconds to hours
+                                CellTimeIdentifier = Scan['HE3_timestamp']/3600000 #milliseconds to hours
                                 if CellTimeIdentifier not in HE3_Trans:
-                                    HE3Insert_Time = f['/entry/DAS_logs/backPolarization/timestamp'][0]/3600000 #milliseconds to hours
-                                    Opacity = f['/entry/DAS_logs/backPolarization/opacityAt1Ang'][0]
-                                    Wavelength = f['/entry/DAS_logs/wavelength/wavelength'][0]
+                                    HE3Insert_Time = Scan['HE3_timestamp']/3600000 #milliseconds to hours
+                                    Opacity = Scan['HE3_opacityAt1Ang']
+                                    Wavelength = Scan['Wavelength']
                                     ScaledOpacity = Opacity*Wavelength
-                                    TE = f['/entry/DAS_logs/backPolarization/glassTransmission'][0]
+                                    TE = Scan['HE3_glassTransmission']
                             if HE3Type[-7:-2] == 'HeOUT':
                                 HE3OUT_filenumber = filenumber
                                 HE3OUT_config = Config
                                 HE3OUT_sample = Sample_Name
-                                HE3OUT_attenuators = int(f['entry/instrument/attenuator/num_atten_dropped'][0])
+                                HE3OUT_attenuators = Scan['Attenuators']
                             elif HE3Type[-7:-2] == ' HeIN':
                                 HE3IN_filenumber = filenumber
                                 HE3IN_config = Config
                                 HE3IN_sample = Sample_Name
-                                HE3IN_attenuators = int(f['entry/instrument/attenuator/num_atten_dropped'][0])
+                                HE3IN_attenuators = Scan['Attenuators']
                                 HE3IN_StartTime = (End_time.timestamp() - Count_time/2)/3600.0
                                 if HE3OUT_filenumber > 0:
                                     if HE3OUT_config == HE3IN_config and HE3OUT_attenuators == HE3IN_attenuators and HE3OUT_sample == HE3IN_sample: #This implies that you must have a 3He out before 3He in of same config and atten
@@ -763,35 +805,36 @@ def SaveTextData(SliceType, Sample, Config, DataMatrix):
   
     return
 
-#*************************************************
-#***        Start of 'The Program'             ***
-#*************************************************
-Sample_Names, Configs, BlockBeam, Scatt, Trans, Pol_Trans, HE3_Trans, start_number, filenumberlisting = NG7SANS_SortData(YesNoManualHe3Entry, New_HE3_Files, MuValues, TeValues)
-print(Scatt)
-print('  ')
-print(Trans)
+if __name__ == '__main__':
+    #*************************************************
+    #***        Start of 'The Program'             ***
+    #*************************************************
+    Sample_Names, Configs, BlockBeam, Scatt, Trans, Pol_Trans, HE3_Trans, start_number, filenumberlisting = NG7SANS_SortData(YesNoManualHe3Entry, New_HE3_Files, MuValues, TeValues)
+    print(Scatt)
+    print('  ')
+    print(Trans)
 
-Config = NG7SANS_Config_ID(Scatt_filenumber)
+    Config = NG7SANS_Config_ID(Scatt_filenumber)
 
-Qx, Qy, Qz, Q_total, Q_perp_unc, Q_parl_unc, InPlaneAngleMap, dimX, dimY  = NG7SANS_QCalculation(Scatt_filenumber)
+    Qx, Qy, Qz, Q_total, Q_perp_unc, Q_parl_unc, InPlaneAngleMap, dimX, dimY  = NG7SANS_QCalculation(Scatt_filenumber)
 
-Abs_Trans = NG7SANS_TransCountsPer1E8MonCounts(Trans_filenumber)
+    Abs_Trans = NG7SANS_TransCountsPer1E8MonCounts(Trans_filenumber)
 
-Sample_Trans = 1.0
-Data, DataUnc = NG7SANS_AbsScaleScattData(Scatt_filenumber, Abs_Trans, Sample_Trans)
+    Sample_Trans = 1.0
+    Data, DataUnc = NG7SANS_AbsScaleScattData(Scatt_filenumber, Abs_Trans, Sample_Trans)
 
-PrimaryAngle = 42
-AngleWidth = 45
-BothSides = 1
-SectorMask = NG7SANS_SectorMask(InPlaneAngleMap, PrimaryAngle, AngleWidth, BothSides)
+    PrimaryAngle = 42
+    AngleWidth = 45
+    BothSides = 1
+    SectorMask = NG7SANS_SectorMask(InPlaneAngleMap, PrimaryAngle, AngleWidth, BothSides)
 
-Q_min = 0.001
-Q_max = 0.03
-Q_bins = 100
-TwoDimData = NG7SANS_TwoDimToOneDim(Q_min, Q_max, Q_bins, Q_total, Q_total, SectorMask, Data, DataUnc)
+    Q_min = 0.001
+    Q_max = 0.03
+    Q_bins = 100
+    TwoDimData = NG7SANS_TwoDimToOneDim(Q_min, Q_max, Q_bins, Q_total, Q_total, SectorMask, Data, DataUnc)
 
-Sample = 'Samp' + str(Scatt_filenumber)
-SliceType = 'Sec42,45deg'
-SaveTextData(SliceType, Sample, Config, TwoDimData)
+    Sample = 'Samp' + str(Scatt_filenumber)
+    SliceType = 'Sec42,45deg'
+    SaveTextData(SliceType, Sample, Config, TwoDimData)
 
-#NG7SANS_QxQyASCII(Data, DataUnc, Qx, Qy, Qz, Q_perp_unc, Q_parl_unc)
+    #NG7SANS_QxQyASCII(Data, DataUnc, Qx, Qy, Qz, Q_perp_unc, Q_parl_unc)
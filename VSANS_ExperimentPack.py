@@ -0,0 +1,140 @@
+import os
+import json
+import argparse
+import numpy as np
+import h5py
+import VSANS_ReductionHighRes as VSANS
+
+def copy_run(src, dst, panel_sources):
+    """ Copy the file (or group) src with all its attributes into the group dst.
+    Datasets are copied by HDF5 itself; detector data that was stacked into
+    /panels becomes a virtual dataset viewing its frame there. Objects linked
+    under several names in the NeXus file are linked the same way in the copy """
+
+    links = []
+    src.id.links.visit(lambda name, info: links.append((name, info.type, info.u)), info=True)
+    groups = set()
+    h5py.h5o.visit(src.id, lambda name, info: groups.add(name) if info.type == h5py.h5o.TYPE_GROUP else None, info=True)
+    for name, value in src.attrs.items():
+        dst.attrs[name] = value
+    copied = {}
+    aliases = []
+    for name, link_type, address in links:
+        if any([name.startswith(alias) for alias in aliases]):
+            continue #already present through a linked group
+        if link_type == h5py.h5l.TYPE_SOFT:
+            target = src.id.links.get_val(name).decode()
+            if target.startswith('/'):
+                target = dst.name + target #absolute paths now start at the run's group
+            dst[name.decode()] = h5py.SoftLink(target)
+        elif link_type != h5py.h5l.TYPE_HARD:
+            continue
+        elif address in copied:
+            dst.id.links.create_hard(name, dst.id, copied[address])
+            if copied[address] in groups:
+                aliases.append(name + b'/')
+        elif name in groups:
+            group = dst.create_group(name.decode())
+            for attr_name, value in src[name.decode()].attrs.items():
+                group.attrs[attr_name] = value
+        elif address in panel_sources:
+            obj = src[name.decode()]
+            layout = h5py.VirtualLayout(shape=obj.shape, dtype=obj.dtype)
+            layout[...] = panel_sources[address]
+            dset = dst.create_virtual_dataset(name.decode(), layout, fillvalue=0)
+            for attr_name, value in obj.attrs.items():
+                dset.attrs[attr_name] = value
+        else:
+            h5py.h5o.copy(src.id, name, dst.id, name)
+        if link_type == h5py.h5l.TYPE_HARD and address not in copied:
+            copied[address] = name
+
+def write_header_table(group, headers):
+    """ Write the run headers as one column per field. Fields that hold the same
+    numpy type for every run are stored with that type; all others are stored as
+    JSON text (empty for runs without the field) """
+
+    keys = []
+    for header in headers:
+        keys += [key for key in header if key not in keys]
+    for key in keys:
+        values = [header.get(key) for header in headers]
+        dtypes = set([value.dtype for value in values if isinstance(value, np.generic)])
+        if len(dtypes) == 1 and all([isinstance(value, np.generic) for value in values]):
+            group.create_dataset(key, data=np.array(values, dtype=dtypes.pop()))
+        else:
+            text = [json.dumps(VSANS.VSANS_EncodeHeaderValue(header[key])) if key in header else '' for header in headers]
+            column = group.create_dataset(key, data=text, dtype=h5py.string_dtype())
+            column.attrs['Encoding'] = 'json'
+
+def make_experiment_pack(input_path, pack_path=None, compression_level=4, verbose=True):
+    """ Consolidate all sansNNNNN.nxs.ngv runs in input_path into one HDF5
+    experiment pack (by default input_path/VSANS_ExperimentPack.h5), which
+    VSANS_ReductionHighRes.py then reads in place of the individual files """
+
+    VSANS.UseExperimentPack = 0 #always pack from the original files
+    if pack_path is None:
+        pack_path = os.path.join(input_path, VSANS.ExperimentPackName)
+    if not hasattr(VSANS, 'save_path'):
+        VSANS.save_path = os.path.dirname(os.path.abspath(pack_path)) #run index location if input_path is read-only
+    filelist = sorted([fn for fn in os.listdir(input_path) if fn.endswith(".nxs.ngv")])
+    filenumbers = [int(filename[4:9]) for filename in filelist]
+    headers = VSANS.VSANS_ScanRunHeaders(input_path, filenumbers)
+    runs = [(filename, filenumber, header) for filename, filenumber, header in zip(filelist, filenumbers, headers) if header is not None]
+    if len(runs) == 0:
+        print("no .nxs.ngv files found in {path}".format(path=input_path))
+        return
+
+    # each panel is stacked over the runs in which it has the shape and type found first
+    panels = {}
+    for filename, filenumber, header in runs:
+        f = VSANS.get_by_filenumber(input_path, filenumber)
+        for name in f['entry/instrument']:
+            dshort = name[9:]
+            datafieldname = 'entry/instrument/detector_{ds}/data'.format(ds=dshort)
+            if name.startswith('detector_') and dshort not in panels and datafieldname in f:
+                panels[dshort] = (f[datafieldname].shape, f[datafieldname].dtype)
+
+    temp_path = pack_path + '.tmp'
+    with h5py.File(temp_path, 'w') as pack:
+        pack.attrs['PackVersion'] = VSANS.ExperimentPackVersion
+        pack.attrs['Source'] = os.path.abspath(input_path)
+        n_runs = len(runs)
+        stats = [os.stat(os.path.join(input_path, filename)) for filename, filenumber, header in runs]
+        pack.create_dataset('files/filename', data=[filename for filename, filenumber, header in runs], dtype=h5py.string_dtype())
+        pack.create_dataset('files/size', data=np.array([stat.st_size for stat in stats], dtype=np.int64))
+        pack.create_dataset('files/mtime', data=np.array([stat.st_mtime_ns for stat in stats], dtype=np.int64))
+        write_header_table(pack.create_group('header'), [header for filename, filenumber, header in runs])
+
+        cubes = {}
+        for dshort in panels:
+            shape, dtype = panels[dshort]
+            cubes[dshort] = pack.create_dataset('panels/{ds}'.format(ds=dshort), shape=(n_runs,) + shape, dtype=dtype, chunks=(1,) + shape,
+                                                compression='gzip', compression_opts=compression_level, shuffle=True)
+        runs_group = pack.create_group('runs')
+        for row, (filename, filenumber, header) in enumerate(runs):
+            if verbose:
+                print("packing " + filename)
+            f = VSANS.get_by_filenumber(input_path, filenumber)
+            panel_sources = {}
+            for dshort in panels:
+                datafieldname = 'entry/instrument/detector_{ds}/data'.format(ds=dshort)
+                if datafieldname in f and (f[datafieldname].shape, f[datafieldname].dtype) == panels[dshort]:
+                    cubes[dshort][row] = f[datafieldname][()]
+                    source = h5py.VirtualSource('.', cubes[dshort].name, shape=cubes[dshort].shape, dtype=cubes[dshort].dtype)
+                    panel_sources[h5py.h5o.get_info(f[datafieldname].id).addr] = source[row]
+            copy_run(f, runs_group.create_group(filename), panel_sources)
+    VSANS.close_pooled_files(report=False)
+    os.replace(temp_path, pack_path)
+    if verbose:
+        print("wrote {n} runs to {path}".format(n=len(runs), path=pack_path))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("input_path", type=str, help="folder holding the sansNNNNN.nxs.ngv files to pack, e.g. Example_Fe3O4Nanoparticles_VSANS26903/")
+    parser.add_argument("-o", "--output", type=str, default=None, help="pack file to write (defaults to VSANS_ExperimentPack.h5 in input_path, where the reduction finds it automatically)")
+    parser.add_argument("-c", "--compression", type=int, default=4, help="gzip level for the stacked detector panels (defaults to 4)")
+    parser.add_argument("-q", "--quiet", action="store_true", help="suppress printouts during execution")
+    args = parser.parse_args()
+
+    make_experiment_pack(args.input_path, pack_path=args.output, compression_level=args.compression, verbose=(not args.quiet))
@@ -6,11 +6,15 @@ import matplotlib.pyplot as plt
 from pathlib import Path
 import dateutil
 import datetime
+import time
+import traceback
 from numpy.linalg import inv
 #from uncertainties import unumpy
 import os
 import os.path
 from scipy import ndimage
+from collections import OrderedDict, deque
+from concurrent.futures import ProcessPoolExecutor
 
 '''
 Updated 2/15/1/2021. Don't include config in SASView Plotable data names.
@@ -39,27 +43,275 @@ def VSANS_ReadIn_UserInput():
 
     return Contents
 
+#Process-wide pool of open data files shared by get_by_filenumber. Handles are kept open (read-only) and reused;
+#once more than MaxOpenFiles are open the least recently used handle is closed. MaxOpenFiles may be set in the user input.
+MaxOpenFiles = 64
+file_objects = OrderedDict()
+file_objects_stats = {'hits': 0, 'misses': 0, 'evictions': 0}
+
+def get_pooled_file(fullpath, cache=True):
+
+    if cache and fullpath in file_objects:
+        file_object = file_objects[fullpath]
+        if file_object.id.valid:
+            file_objects.move_to_end(fullpath)
+            file_objects_stats['hits'] += 1
+            return file_object
+        del file_objects[fullpath]
+    if not os.path.isfile(fullpath):
+        return None
+    file_object = h5py.File(fullpath, 'r')
+    if cache:
+        file_objects_stats['misses'] += 1
+        file_objects[fullpath] = file_object
+        Max_Open = max(int(MaxOpenFiles), 4) #callers may hold a scattering file plus its transmission files at once
+        while len(file_objects) > Max_Open:
+            old_path, old_object = file_objects.popitem(last=False)
+            old_object.close()
+            file_objects_stats['evictions'] += 1
+    return file_object
+
+def close_pooled_files(report=True):
+
+    while len(file_objects) > 0:
+        old_path, old_object = file_objects.popitem(last=False)
+        old_object.close()
+    while len(experiment_packs) > 0:
+        old_path, old_pack = experiment_packs.popitem()
+        if old_pack is not None:
+            old_pack['File'].close()
+    while len(prefetch_readers) > 0:
+        old_name, old_reader = prefetch_readers.popitem()
+        old_reader.shutdown()
+    if report:
+        print('File handle pool:', file_objects_stats['hits'], 'hits,', file_objects_stats['misses'], 'misses,', file_objects_stats['evictions'], 'evictions')
+    return
+
+#Experiment pack written by VSANS_ExperimentPack.py (VSANS_ExperimentPack.h5 in input_path): all runs of a folder in one
+#HDF5 file, with each panel's frames stacked into one (n_files, X, Y) dataset and the run headers in a columnar table.
+#Runs in the pack are read from it unless the original file is present and has changed since it was packed.
+#Set UseExperimentPack = 0 in the user input to always read the individual files.
+UseExperimentPack = 1
+ExperimentPackName = 'VSANS_ExperimentPack.h5'
+ExperimentPackVersion = 1
+experiment_packs = {}
+
+class VSANS_PackedRun(object):
+    #One run of an experiment pack, indexed with the same paths as the NeXus file it was packed from
+
+    def __init__(self, group):
+        self.group = group
+
+    def __getitem__(self, name):
+        return self.group[name.lstrip('/')]
+
+    def __contains__(self, name):
+        return name.lstrip('/') in self.group
+
+    def __iter__(self):
+        return iter(self.group)
+
+    def keys(self):
+        return self.group.keys()
+
+    def close(self):
+        return #the pack itself stays open until close_pooled_files()
+
+def get_experiment_pack(input_path):
+    #Returns the experiment pack of input_path, or None if there is none (or UseExperimentPack = 0)
+
+    if input_path in experiment_packs:
+        return experiment_packs[input_path]
+    Pack = None
+    fullpath = os.path.join(input_path, ExperimentPackName)
+    if UseExperimentPack >= 1 and os.path.isfile(fullpath):
+        f = h5py.File(fullpath, 'r')
+        if f.attrs.get('PackVersion') == ExperimentPackVersion:
+            Names = list(f['files/filename'].asstr()[()])
+            Pack = {'File' : f, 'Rows' : {Name : Row for Row, Name in enumerate(Names)}, 'Size' : f['files/size'][()], 'Mtime' : f['files/mtime'][()], 'Current' : {}, 'Headers' : None}
+        else:
+            print('Experiment pack', fullpath, 'was written by a different version and will not be used.')
+            f.close()
+    experiment_packs[input_path] = Pack
+    return Pack
+
+def VSANS_PackedRow(input_path, filename):
+    #Returns the row of filename in the experiment pack, or None if it is not packed or the original file has since changed
+
+    Pack = get_experiment_pack(input_path)
+    if Pack is None or filename not in Pack['Rows']:
+        return None
+    Row = Pack['Rows'][filename]
+    if filename not in Pack['Current']:
+        try:
+            Stat = os.stat(os.path.join(input_path, filename))
+            Pack['Current'][filename] = (Stat.st_size == Pack['Size'][Row] and Stat.st_mtime_ns == Pack['Mtime'][Row])
+        except OSError:
+            Pack['Current'][filename] = True #only kept in the pack
+    if Pack['Current'][filename]:
+        return Row
+    return None
+
+def VSANS_PackedRunHeader(input_path, filenumber):
+    #Returns the header of a packed run from the pack's columnar header table, or None if the run is not packed
+    import json
+
+    filename = "sans" + str(filenumber) + ".nxs.ngv"
+    Row = VSANS_PackedRow(input_path, filename)
+    if Row is None:
+        return None
+    Pack = experiment_packs[input_path]
+    if Pack['Headers'] is None:
+        Headers = [{} for Name in Pack['Rows']]
+        Columns = Pack['File']['header']
+        for Key in Columns:
+            if Columns[Key].attrs.get('Encoding') == 'json':
+                for Header, Value in zip(Headers, Columns[Key].asstr()[()]):
+                    if len(Value) > 0:
+                        Header[Key] = VSANS_DecodeHeaderValue(json.loads(Value))
+            else:
+                for Header, Value in zip(Headers, Columns[Key][()]):
+                    Header[Key] = Value
+        Pack['Headers'] = Headers
+    return Pack['Headers'][Row]
+
+def VSANS_RunFileList(input_path):
+    #Sorted names of all sansNNNNN.nxs.ngv runs in input_path, including those only kept in its experiment pack
+
+    filelist = [fn for fn in os.listdir(input_path) if fn.endswith(".nxs.ngv")]
+    Pack = get_experiment_pack(input_path)
+    if Pack is not None:
+        filelist = list(set(filelist) | set(Pack['Rows']))
+    filelist.sort()
+    return filelist
+
 def get_by_filenumber(input_path, filenumber, cache=True):
-    '''
-    if filenumber in file_objects:
-        return file_objects[filenumber]
-    else:
-    '''
-    file_objects = {}
+    #With cache=True the handle stays in the shared pool and must not be closed by the caller;
+    #with cache=False a fresh handle is returned and the caller is responsible for closing it.
+    #Runs kept in an experiment pack are returned as a VSANS_PackedRun, which is read the same way.
     filename = "sans" + str(filenumber) + ".nxs.ngv"
+    if VSANS_PackedRow(input_path, filename) is not None:
+        return VSANS_PackedRun(experiment_packs[input_path]['File']['runs'][filename])
     fullpath = os.path.join(input_path, filename)
-    if os.path.isfile(fullpath):
-        file_object = h5py.File(fullpath, 'r')
-        file_objects[filenumber] = file_object
-        return file_object
-    else:
+    return get_pooled_file(fullpath, cache)
+
+#Cache of detector panel arrays shared by all reduction steps, so transmission, blocked-beam and scattering files that are
+#used many times are only read and decompressed once. Arrays are handed out read-only; the least recently used arrays are
+#dropped once the cache holds more than PanelCacheMB megabytes. PanelCacheMB may be set in the user input (0 disables it).
+PanelCacheMB = 512
+panel_cache = OrderedDict()
+panel_cache_stats = {'hits': 0, 'misses': 0, 'evictions': 0, 'bytes': 0}
+
+def HighRes_Subset(HighResMinX, HighResMaxX, HighResMinY, HighResMaxY):
+    #Returns (x0, x1, y0, y1) with exclusive ends, i.e. data[x0:x1, y0:y1] == data[HighResMinX:HighResMaxX+1,HighResMinY:HighResMaxY+1]
+
+    return (int(HighResMinX), int(HighResMaxX) + 1, int(HighResMinY), int(HighResMaxY) + 1)
+
+#With ConvertHighResToSubset = 0 the full rear detector is used. HighResRebin = 2, 4 or 8 then sums each block of
+#HighResRebin x HighResRebin B pixels into one as the panel is read (incomplete blocks at the far edges are dropped), so
+#the data, Plex, blocked beam and Q maps of B all have 1/HighResRebin**2 of the pixels; the full frame is read
+#HighResRebinChunk pixels at a time and never held as one array. HighResRebin may be set in the user input (1 disables it).
+HighResRebin = 1
+HighResRebinChunk = 2**18
+
+def HighRes_Rebin(Factor):
+    #Returns the subset spec (see read_hyperslab) of the full panel summed in Factor x Factor blocks
+
+    return (0, None, 0, None, int(Factor))
+
+def HighRes_ReadSpec(HighResMinX, HighResMaxX, HighResMinY, HighResMaxY, ConvertHighResToSubset):
+    #Returns how the B panel is read: the HighRes subset, the HighResRebin blocks of the full panel, or None (all of it)
+
+    if ConvertHighResToSubset > 0:
+        return HighRes_Subset(HighResMinX, HighResMaxX, HighResMinY, HighResMaxY)
+    if int(HighResRebin) > 1:
+        return HighRes_Rebin(HighResRebin)
+    return None
+
+def HighRes_RebinFactor(subset):
+    #Returns the block size of a subset spec, i.e. 1 unless it is HighRes_Rebin(...)
+
+    if subset is not None and len(subset) > 4:
+        return subset[4]
+    return 1
+
+def read_hyperslab(dataset, subset):
+    #Reads only dataset[x0:x1, y0:y1] from disk into a preallocated buffer; the full panel is never materialized
+    #subset = (x0, x1, y0, y1) or (x0, x1, y0, y1, Factor) to sum Factor x Factor blocks; None ends are the panel edges
+
+    x0, x1, y0, y1 = subset[:4]
+    x1 = dataset.shape[0] if x1 is None else min(x1, dataset.shape[0])
+    y1 = dataset.shape[1] if y1 is None else min(y1, dataset.shape[1])
+    if HighRes_RebinFactor(subset) > 1:
+        return read_rebinned(dataset, x0, x1, y0, y1, HighRes_RebinFactor(subset))
+    data = np.empty((max(x1 - x0, 0), max(y1 - y0, 0)), dtype=dataset.dtype)
+    if data.size > 0:
+        dataset.read_direct(data, source_sel=np.s_[x0:x1, y0:y1])
+    return data
+
+def read_rebinned(dataset, x0, x1, y0, y1, Factor):
+    #Returns dataset[x0:x1, y0:y1] summed in Factor x Factor blocks, reading about HighResRebinChunk pixels at a time into
+    #one reused buffer; counts are summed as int64, floating point data in its own type
+
+    nx = max(x1 - x0, 0)//Factor
+    ny = max(y1 - y0, 0)//Factor
+    SumType = dataset.dtype if np.issubdtype(dataset.dtype, np.floating) else np.int64
+    data = np.zeros((nx, ny), dtype=SumType)
+    Rows = max(1, HighResRebinChunk//max(ny*Factor*Factor, 1)) #block rows per read
+    Buffer = np.empty((min(Rows, max(nx, 1))*Factor, ny*Factor), dtype=dataset.dtype)
+    for Start in range(0, nx, Rows):
+        Stop = min(Start + Rows, nx)
+        Chunk = Buffer[:(Stop - Start)*Factor]
+        dataset.read_direct(Chunk, source_sel=np.s_[x0 + Start*Factor:x0 + Stop*Factor, y0:y0 + ny*Factor])
+        data[Start:Stop] = Chunk.reshape(Stop - Start, Factor, ny, Factor).sum(axis=(1, 3), dtype=SumType)
+    return data
+
+def get_panel_data(input_path, filenumber, dshort, subset=None):
+    #Uses get_by_filenumber(input_path, filenumber); returns entry/instrument/detector_{dshort}/data or None if there is no such file
+    #subset = HighRes_Subset(...) or HighRes_Rebin(...) returns only that hyperslab or block sum of the panel (see read_hyperslab)
+
+    key = (input_path, filenumber, dshort, subset)
+    if key in panel_cache:
+        panel_cache.move_to_end(key)
+        panel_cache_stats['hits'] += 1
+        return panel_cache[key]
+    f = get_by_filenumber(input_path, filenumber)
+    if f is None:
         return None
+    if subset is None:
+        data = np.array(f['entry/instrument/detector_{ds}/data'.format(ds=dshort)])
+    else:
+        data = read_hyperslab(f['entry/instrument/detector_{ds}/data'.format(ds=dshort)], subset)
+    panel_cache_stats['misses'] += 1
+    return cache_panel_data(key, data)
+
+def cache_panel_data(key, data):
+    #Adds a panel array read elsewhere (e.g. by a prefetch process) to the panel cache; returns it read-only
+
+    data.setflags(write=False)
+    Budget = PanelCacheMB*1024*1024
+    if data.nbytes <= Budget and key not in panel_cache:
+        panel_cache[key] = data
+        panel_cache_stats['bytes'] += data.nbytes
+        while panel_cache_stats['bytes'] > Budget:
+            old_key, old_data = panel_cache.popitem(last=False)
+            panel_cache_stats['bytes'] -= old_data.nbytes
+            panel_cache_stats['evictions'] += 1
+    return data
+
+def clear_panel_cache(report=True):
+
+    panel_cache.clear()
+    if report:
+        print('Panel cache:', panel_cache_stats['hits'], 'hits,', panel_cache_stats['misses'], 'misses,', panel_cache_stats['evictions'], 'evictions')
+    panel_cache_stats['bytes'] = 0
+    return
 
 def VSANS_GetBeamCenter(input_path, filenumber, dshort, trans_max_width_pixels):
     #Uses f = get_by_filenumber(input_path, filenumber)
 
     f = get_by_filenumber(input_path, filenumber)
-    data = np.array(f['entry/instrument/detector_{ds}/data'.format(ds=dshort)])
+    data = get_panel_data(input_path, filenumber, dshort)
     beam_center_x = f['entry/instrument/detector_{ds}/beam_center_x'.format(ds=dshort)][0]
     beam_center_y = f['entry/instrument/detector_{ds}/beam_center_y'.format(ds=dshort)][0]
     x_width, y_width = np.shape(data)
@@ -108,6 +360,29 @@ def VSANS_GetBeamCenter(input_path, filenumber, dshort, trans_max_width_pixels):
 
     return middle_bc_x, middle_bc_y
 
+#Table of the beam centres fitted to alignment transmissions, keyed by (input_path, filenumber, panel, fit width), so the
+#centre of each transmission file is fitted once however many samples, configurations and Q calculations use it.
+beam_center_table = {}
+beam_center_stats = {'hits': 0, 'misses': 0}
+
+def VSANS_TabulatedBeamCenter(input_path, filenumber, dshort, trans_max_width_pixels):
+    #VSANS_GetBeamCenter(input_path, filenumber, dshort, trans_max_width_pixels) from the beam-centre table
+
+    key = (input_path, filenumber, dshort, trans_max_width_pixels)
+    if key in beam_center_table:
+        beam_center_stats['hits'] += 1
+    else:
+        beam_center_stats['misses'] += 1
+        beam_center_table[key] = VSANS_GetBeamCenter(input_path, filenumber, dshort, trans_max_width_pixels)
+    return beam_center_table[key]
+
+def clear_beam_center_table(report=True):
+
+    beam_center_table.clear()
+    if report:
+        print('Beam centers:', beam_center_stats['hits'], 'hits,', beam_center_stats['misses'], 'misses')
+    return
+
 def VSANS_GetBeamCenterForScattFile(input_path, Sample_Name, Config, AlignTrans):
     #Uses f = get_by_filenumber(input_path, filenumber)
     #Uses VSANS_GetBeamCenter
@@ -133,82 +408,282 @@ def VSANS_GetBeamCenterForScattFile(input_path, Sample_Name, Config, AlignTrans)
 
         trans_max_width_pixels = 10
         if FR_filenumber != 0:
-            X_FR, Y_FR = VSANS_GetBeamCenter(input_path, FR_filenumber, 'FR', trans_max_width_pixels)
+            X_FR, Y_FR = VSANS_TabulatedBeamCenter(input_path, FR_filenumber, 'FR', trans_max_width_pixels)
         if MR_filenumber != 0:
-            X_MR, Y_MR = VSANS_GetBeamCenter(input_path, MR_filenumber, 'MR', trans_max_width_pixels)
+            X_MR, Y_MR = VSANS_TabulatedBeamCenter(input_path, MR_filenumber, 'MR', trans_max_width_pixels)
 
     '''Here'''
 
     return X_FR, Y_FR, X_MR, Y_MR
 
+def read_run_header(input_path, filenumber):
+    #Reads, in one pass over one open file, every metadata field needed to sort and classify a run.
+    #Values are kept as read (numpy scalars) so everything derived from the record matches reading the file directly.
+    f = get_by_filenumber(input_path, filenumber)
+    if f is None:
+        return None
+    DAS_logs = f['entry/DAS_logs/']
+    Header = {'filenumber' : filenumber}
+    Header['Descrip'] = str(f['entry/sample/description'][0])[2:-1]
+    Header['Listed_Config'] = str(f['entry/DAS_logs/configuration/key'][0])[2:-1]
+    Header['Temp'] = 'NA'
+    if "temp" in DAS_logs:
+        Header['Temp'] = str(f['entry/DAS_logs/temp/desiredPrimaryNode'][(0)])
+    Header['Voltage'] = 'NA'
+    if "adam4021" in DAS_logs:
+        Header['Voltage'] = str(f['entry/DAS_logs/adam4021/voltage'][(0)])
+    Header['SiMirror'] = str(f['entry/DAS_logs/siMirror/siMirror'][()])[3:-2]
+    Header['Purpose'] = str(f['entry/reduction/file_purpose'][()])[3:-2]
+    Header['Intent'] = str(f['entry/reduction/intent'][()])[3:-2]
+    Header['FrontPolDirection'] = 'NA'
+    if "frontPolarization" in DAS_logs:
+        Header['FrontPolDirection'] = str(f['entry/DAS_logs/frontPolarization/direction'][()])[3:-2]
+    Header['BackPolDirection'] = 'NA'
+    if "backPolarization" in DAS_logs:
+        Header['BackPolDirection'] = str(f['entry/DAS_logs/backPolarization/direction'][()])[3:-2]
+        for Field, Name in [('timestamp', 'HE3_Timestamp'), ('name', 'HE3_Name'), ('opacityAt1Ang', 'HE3_Opacity'), ('glassTransmission', 'HE3_Te')]:
+            if Field in DAS_logs['backPolarization']:
+                Header[Name] = DAS_logs['backPolarization'][Field][0]
+        if 'HE3_Name' in Header:
+            Header['HE3_Name'] = str(Header['HE3_Name'])[2:-1]
+    Header['Wavelength'] = f['entry/DAS_logs/wavelength/wavelength'][0]
+    Header['FrontCarriage'] = 'NA'
+    Header['MiddleCarriage'] = 'NA'
+    Header['Guide'] = 'NA'
+    if np.isfinite(Header['Wavelength']):
+        Header['FrontCarriage'] = int(f['entry/DAS_logs/carriage1Trans/desiredSoftPosition'][0]) #in cm
+        Header['MiddleCarriage'] = int(f['entry/DAS_logs/carriage2Trans/desiredSoftPosition'][0]) #in cm
+        GuideHolder = f['entry/DAS_logs/guide/guide'][0]
+        if "CONV" in str(GuideHolder):
+            Header['Guide'] = "CvB"
+        else:
+            Header['Guide'] = str(int(GuideHolder))
+    Header['Count_time'] = f['entry/collection_time'][0]
+    Header['End_time'] = dateutil.parser.parse(f['entry/end_time'][0]).timestamp()
+    Header['Integrated_Counts'] = {}
+    for Name in f['entry/instrument']:
+        if Name.startswith('detector_') and 'integrated_count' in f['entry/instrument'][Name]:
+            Header['Integrated_Counts'][Name[9:]] = f['entry/instrument'][Name]['integrated_count'][0]
+    Header['Attenuators'] = 'NA'
+    if 'attenuator' in f['entry/instrument'] and 'num_atten_dropped' in f['entry/instrument/attenuator']:
+        Header['Attenuators'] = int(f['entry/instrument/attenuator/num_atten_dropped'][0])
+
+    return Header
+
+#Persistent index of run headers kept next to the data (VSANS_RunIndex.json in input_path, or in save_path if input_path
+#is read-only). Entries are keyed by file name and reused while the file size and modification time are unchanged,
+#so re-running a reduction only re-reads new or changed files. Set UseRunIndex = 0 in the user input to disable.
+#Headers that do need reading are read by HeaderScanWorkers processes in parallel (1 reads them one after another).
+UseRunIndex = 1
+HeaderScanWorkers = 4
+RunIndexName = 'VSANS_RunIndex.json'
+RunIndexVersion = 1
+run_indexes = {}
+
+def VSANS_EncodeHeaderValue(Value):
+    #numpy scalars are stored with their dtype so the values read back are identical to those read from the file
+    if isinstance(Value, dict):
+        return {Key : VSANS_EncodeHeaderValue(Value[Key]) for Key in Value}
+    if isinstance(Value, np.generic):
+        return {'dtype' : Value.dtype.str, 'value' : Value.item()}
+    return Value
+
+def VSANS_DecodeHeaderValue(Value):
+    if isinstance(Value, dict):
+        if 'dtype' in Value and 'value' in Value and len(Value) == 2:
+            return np.dtype(Value['dtype']).type(Value['value'])
+        return {Key : VSANS_DecodeHeaderValue(Value[Key]) for Key in Value}
+    return Value
+
+def VSANS_RunIndexPath(input_path):
+
+    Index_Path = os.path.join(input_path, RunIndexName)
+    if os.path.isfile(Index_Path) or os.access(input_path, os.W_OK):
+        return Index_Path
+    return os.path.join(save_path, RunIndexName)
+
+def VSANS_LoadRunIndex(input_path):
+    import json
+
+    if input_path in run_indexes:
+        return run_indexes[input_path]
+    Index = {'Version' : RunIndexVersion, 'Files' : {}}
+    Index_Path = VSANS_RunIndexPath(input_path)
+    if UseRunIndex >= 1 and os.path.isfile(Index_Path):
+        try:
+            with open(Index_Path, 'rt') as h:
+                Stored = json.load(h)
+            if Stored.get('Version') == RunIndexVersion:
+                Index['Files'] = Stored['Files']
+        except (OSError, ValueError, KeyError):
+            print('Could not read run index', Index_Path, '; it will be rebuilt.')
+    Index['Headers'] = {}
+    Index['Changed'] = 0
+    run_indexes[input_path] = Index
+    return Index
+
+def VSANS_SaveRunIndex(input_path):
+    import json
+
+    if UseRunIndex < 1 or input_path not in run_indexes or run_indexes[input_path]['Changed'] == 0:
+        return
+    Index = run_indexes[input_path]
+    Index_Path = VSANS_RunIndexPath(input_path)
+    try:
+        if not os.path.exists(os.path.dirname(Index_Path)):
+            os.makedirs(os.path.dirname(Index_Path))
+        Temp_Path = Index_Path + '.tmp'
+        with open(Temp_Path, 'wt') as h:
+            json.dump({'Version' : RunIndexVersion, 'Files' : Index['Files']}, h)
+        os.replace(Temp_Path, Index_Path)
+        Index['Changed'] = 0
+    except OSError:
+        print('Could not write run index', Index_Path)
+    return
+
+def VSANS_IndexedRunHeader(input_path, filenumber):
+    #Returns the packed or indexed header if the file is unchanged since it was packed or indexed, 'NA' if it needs
+    #to be (re)read, and None if the file does not exist
+
+    Header = VSANS_PackedRunHeader(input_path, filenumber)
+    if Header is not None:
+        return Header
+    filename = "sans" + str(filenumber) + ".nxs.ngv"
+    try:
+        Stat = os.stat(os.path.join(input_path, filename))
+    except OSError:
+        return None
+    Index = VSANS_LoadRunIndex(input_path)
+    Entry = Index['Files'].get(filename)
+    if Entry is not None and Entry['Size'] == Stat.st_size and Entry['Mtime'] == Stat.st_mtime_ns:
+        if filename not in Index['Headers']:
+            Index['Headers'][filename] = VSANS_DecodeHeaderValue(Entry['Header'])
+        return Index['Headers'][filename]
+    return 'NA'
+
+def VSANS_StoreRunHeader(input_path, filenumber, Header):
+
+    filename = "sans" + str(filenumber) + ".nxs.ngv"
+    try:
+        Stat = os.stat(os.path.join(input_path, filename))
+    except OSError:
+        return
+    if Header is not None:
+        Index = VSANS_LoadRunIndex(input_path)
+        Index['Files'][filename] = {'Size' : Stat.st_size, 'Mtime' : Stat.st_mtime_ns, 'Header' : VSANS_EncodeHeaderValue(Header)}
+        Index['Headers'][filename] = Header
+        Index['Changed'] = 1
+    return
+
+def get_run_header(input_path, filenumber):
+    #Uses read_run_header(input_path, filenumber) for files not yet in (or changed since) the run index
+
+    Header = VSANS_IndexedRunHeader(input_path, filenumber)
+    if isinstance(Header, str):
+        Header = read_run_header(input_path, filenumber)
+        VSANS_StoreRunHeader(input_path, filenumber, Header)
+    return Header
+
+def VSANS_ScanWorkerInit(Settings=None):
+    #Worker processes must not reuse file handles (or cached panels) inherited from the parent;
+    #Settings are user-input values the worker needs, as a worker that is spawned rather than forked does not have them
+    file_objects.clear()
+    experiment_packs.clear()
+    panel_cache.clear()
+    if Settings is not None:
+        globals().update(Settings)
+
+def VSANS_WorkerSettings():
+    #The user-input values VSANS_ScanWorkerInit passes on to worker processes (which do not cache panels themselves)
+
+    return {'UseExperimentPack' : UseExperimentPack, 'ExperimentPackName' : ExperimentPackName, 'MaxOpenFiles' : MaxOpenFiles, 'HighResRebinChunk' : HighResRebinChunk, 'PanelCacheMB' : 0}
+
+def VSANS_ScanRunHeaders(input_path, filenumbers):
+    #Uses get_run_header(input_path, filenumber). Headers not already indexed are first read in parallel over
+    #HeaderScanWorkers processes; the list returned is in the same order as filenumbers.
+
+    Missing = [filenumber for filenumber in filenumbers if isinstance(VSANS_IndexedRunHeader(input_path, filenumber), str)]
+    if HeaderScanWorkers > 1 and len(Missing) > HeaderScanWorkers:
+        with ProcessPoolExecutor(max_workers = int(HeaderScanWorkers), initializer = VSANS_ScanWorkerInit, initargs = (VSANS_WorkerSettings(),)) as Pool:
+            Headers = list(Pool.map(read_run_header, [input_path]*len(Missing), Missing, chunksize = 8))
+        for filenumber, Header in zip(Missing, Headers):
+            VSANS_StoreRunHeader(input_path, filenumber, Header)
+
+    return [get_run_header(input_path, filenumber) for filenumber in filenumbers]
+
 def VSANS_Sample_BaseNameDescrip(SampleDescriptionKeywordsToExclude, input_path, filenumber):
+    #Uses get_run_header(input_path, filenumber)
+
+    Header = get_run_header(input_path, filenumber)
+    return VSANS_Sample_BaseNameDescripFromHeader(SampleDescriptionKeywordsToExclude, Header)
+
+def VSANS_Sample_BaseNameDescripFromHeader(SampleDescriptionKeywordsToExclude, Header):
 
     record_temp = 0
     record_adam4021 = 0
-  
-    f = get_by_filenumber(input_path, filenumber)
-    if f is not None:
-        Descrip = str(f['entry/sample/description'][0])     
-        Descrip = Descrip[2:]
-        Descrip = Descrip[:-1]
+
+    Descrip = Header['Descrip']
+    Listed_Config = Header['Listed_Config']
+
+    Sample_Name = Descrip.replace(Listed_Config, '')
+    Not_Sample = ['T_UU', 'T_DU', 'T_DD', 'T_UD', 'T_SM', 'T_NP', 'HeIN', 'HeOUT', 'S_UU', 'S_DU', 'S_DD', 'S_UD', 'S_NP', 'S_HeU', 'S_HeD', 'S_SMU', 'S_SMD']
+    for i in Not_Sample:
+        Sample_Name = Sample_Name.replace(i, '')
+    Desired_Temp = '295.0'
+    if 'NA' != Header['Temp']:
+        Desired_Temp = Header['Temp']
+        record_temp = 1
+    Voltage = 'na'
+    if 'NA' != Header['Voltage']:
+        Voltage = Header['Voltage']
+        record_adam4021 = 1
+
+    for keyword in SampleDescriptionKeywordsToExclude:
+        Sample_Name = Sample_Name.replace(keyword, '')
         
-        Listed_Config = str(f['entry/DAS_logs/configuration/key'][0])
-        Listed_Config = Listed_Config[2:]
-        Listed_Config = Listed_Config[:-1]
         
-        Sample_Name = Descrip.replace(Listed_Config, '')
-        Not_Sample = ['T_UU', 'T_DU', 'T_DD', 'T_UD', 'T_SM', 'T_NP', 'HeIN', 'HeOUT', 'S_UU', 'S_DU', 'S_DD', 'S_UD', 'S_NP', 'S_HeU', 'S_HeD', 'S_SMU', 'S_SMD']
-        for i in Not_Sample:
-            Sample_Name = Sample_Name.replace(i, '')
-        Desired_Temp = '295.0'
-        if "temp" in f['entry/DAS_logs/']:
-            Desired_Temp = str(f['entry/DAS_logs/temp/desiredPrimaryNode'][(0)])
-            record_temp = 1    
-        Voltage = 'na'
-        if "adam4021" in f['entry/DAS_logs/']:
-            Voltage = str(f['entry/DAS_logs/adam4021/voltage'][(0)])
-            record_adam4021 = 1
-
-        for keyword in SampleDescriptionKeywordsToExclude:
-            Sample_Name = Sample_Name.replace(keyword, '')
-            
-            
-        DT5 = Desired_Temp + " K,"
-        DT4 = Desired_Temp + " K"
-        DT3 = Desired_Temp + "K,"
-        DT2 = Desired_Temp + "K"
-        DT1 = Desired_Temp
-        V5 = Voltage + " V,"
-        V4 = Voltage + " V"
-        V3 = Voltage + "V,"
-        V2 = Voltage + "V"
-        V1 = Voltage
-        TempShort = Desired_Temp
-        TempShort = TempShort.replace('.0', '')
-        VShort = Voltage
-        VShort = VShort.replace('.0', '')
-        DT6 = TempShort + " K,"
-        DT7 = TempShort + " K"
-        V6 = VShort + " V,"
-        V7 = VShort + " V"
-        Z = "/"
-        Not_Sample = [DT5, DT4, DT3, DT2, DT1, DT6, DT7, V5, V4, V3, V2, V1, V6, V7, Z]
-        for i in Not_Sample:
-            Sample_Name = Sample_Name.replace(i, '')
-        Sample_Name = Sample_Name.replace(' ', '')
-        Sample_Base = Sample_Name
-        if record_adam4021 == 0 and record_temp == 0:
-            Sample_Name = Sample_Name
-        elif record_adam4021 == 1 and record_temp == 0:
-            Sample_Name = Sample_Name + '_' + str(Voltage) + 'V'
-        elif record_adam4021 == 0 and record_temp == 1:
-            Sample_Name = Sample_Name + '_' + str(Desired_Temp) + 'K'
-        else:
-            Sample_Name = Sample_Name + '_' + str(Voltage) + 'V_' + str(Desired_Temp) + 'K'
+    DT5 = Desired_Temp + " K,"
+    DT4 = Desired_Temp + " K"
+    DT3 = Desired_Temp + "K,"
+    DT2 = Desired_Temp + "K"
+    DT1 = Desired_Temp
+    V5 = Voltage + " V,"
+    V4 = Voltage + " V"
+    V3 = Voltage + "V,"
+    V2 = Voltage + "V"
+    V1 = Voltage
+    TempShort = Desired_Temp
+    TempShort = TempShort.replace('.0', '')
+    VShort = Voltage
+    VShort = VShort.replace('.0', '')
+    DT6 = TempShort + " K,"
+    DT7 = TempShort + " K"
+    V6 = VShort + " V,"
+    V7 = VShort + " V"
+    Z = "/"
+    Not_Sample = [DT5, DT4, DT3, DT2, DT1, DT6, DT7, V5, V4, V3, V2, V1, V6, V7, Z]
+    for i in Not_Sample:
+        Sample_Name = Sample_Name.replace(i, '')
+    Sample_Name = Sample_Name.replace(' ', '')
+    Sample_Base = Sample_Name
+    if record_adam4021 == 0 and record_temp == 0:
+        Sample_Name = Sample_Name
+    elif record_adam4021 == 1 and record_temp == 0:
+        Sample_Name = Sample_Name + '_' + str(Voltage) + 'V'
+    elif record_adam4021 == 0 and record_temp == 1:
+        Sample_Name = Sample_Name + '_' + str(Desired_Temp) + 'K'
+    else:
+        Sample_Name = Sample_Name + '_' + str(Voltage) + 'V_' + str(Desired_Temp) + 'K'
 
     return Sample_Base, Sample_Name, Descrip, Listed_Config, Desired_Temp
 
 def VSANS_PurposeIntentPolarizationSolenoid(input_path, filenumber):
+    #Uses get_run_header(input_path, filenumber)
+
+    Header = get_run_header(input_path, filenumber)
+    return VSANS_PurposeIntentPolarizationSolenoidFromHeader(Header)
+
+def VSANS_PurposeIntentPolarizationSolenoidFromHeader(Header):
 
     SiMirror = 'UNKNOWN'
     Purpose = 'UNKNOWN'
@@ -217,23 +692,17 @@ def VSANS_PurposeIntentPolarizationSolenoid(input_path, filenumber):
     BackPolDirection = 'UNKNOWN'
     SolenoidPosition = 'UNKNOWN'
     PolarizationState = 'UNKNOWN'  
-    f = get_by_filenumber(input_path, filenumber)
-    if f is not None:
-        SiMirror = str(f['entry/DAS_logs/siMirror/siMirror'][()]) #SCATTERING, TRANSMISSION, HE3
-        SiMirror = SiMirror[3:-2]
-        Purpose = str(f['entry/reduction/file_purpose'][()]) #SCATTERING, TRANSMISSION, HE3
-        Purpose = Purpose[3:-2]
-        Intent = str(f['entry/reduction/intent'][()]) #Sample, Empty, Blocked Beam, Open Beam (will manually remove the 'Beam')
-        Intent = Intent[3:-2]
+    if Header is not None:
+        SiMirror = Header['SiMirror'] #SCATTERING, TRANSMISSION, HE3
+        Purpose = Header['Purpose'] #SCATTERING, TRANSMISSION, HE3
+        Intent = Header['Intent'] #Sample, Empty, Blocked Beam, Open Beam (will manually remove the 'Beam')
         Intent = Intent.replace(' Beam', '')
-        if "frontPolarization" in f['entry/DAS_logs/']:
-            FrontPolDirection = str(f['entry/DAS_logs/frontPolarization/direction'][()])
-            FrontPolDirection = FrontPolDirection[3:-2]
+        if 'NA' != Header['FrontPolDirection']:
+            FrontPolDirection = Header['FrontPolDirection']
         else:
             FrontPolDirection = 'UNPOLARIZED'
-        if "backPolarization" in f['entry/DAS_logs/']:
-            BackPolDirection = str(f['entry/DAS_logs/backPolarization/direction'][()])
-            BackPolDirection = BackPolDirection[3:-2]
+        if 'NA' != Header['BackPolDirection']:
+            BackPolDirection = Header['BackPolDirection']
         else:
             BackPolDirection = 'UNPOLARIZED'
         if 'UP' in BackPolDirection or 'DOWN' in BackPolDirection:
@@ -262,43 +731,40 @@ def VSANS_PurposeIntentPolarizationSolenoid(input_path, filenumber):
         #Kludge to enable if needed (mostly older files):
         OverridePol_ByDescription = 0
         if OverridePol_ByDescription > 0:
-            Type = str(f['entry/sample/description'][()])
-            if Type[-6:-2] == 'S_UU' or Type[-6:-2] == 'T_UU':
+            Type = Header['Descrip']
+            if Type[-4:] == 'S_UU' or Type[-4:] == 'T_UU':
                 PolarizationState = 'UU'
-            elif Type[-6:-2] == 'S_DU' or Type[-6:-2] == 'T_DU':
+            elif Type[-4:] == 'S_DU' or Type[-4:] == 'T_DU':
                 PolarizationState = 'DU'
-            elif Type[-6:-2] == 'S_DD' or Type[-6:-2] == 'T_DD':
+            elif Type[-4:] == 'S_DD' or Type[-4:] == 'T_DD':
                 PolarizationState = 'DD'
-            elif Type[-6:-2] == 'S_UD' or Type[-6:-2] == 'T_UD':
+            elif Type[-4:] == 'S_UD' or Type[-4:] == 'T_UD':
                 PolarizationState = 'UD'
             
         
     return SiMirror, Purpose, Intent, PolarizationState, FrontPolDirection, BackPolDirection, SolenoidPosition
 
 def VSANS_Config_ID(input_path, filenumber):
+    #Uses get_run_header(input_path, filenumber)
+
+    Header = get_run_header(input_path, filenumber)
+    return VSANS_Config_IDFromHeader(Header)
+
+def VSANS_Config_IDFromHeader(Header):
     
     Configuration_ID = 'UNKNOWN'
-    f = get_by_filenumber(input_path, filenumber)
-    if f is not None:
-        if np.isfinite(f['entry/DAS_logs/wavelength/wavelength'][0]):
-            Desired_FrontCarriage_Distance = int(f['entry/DAS_logs/carriage1Trans/desiredSoftPosition'][0]) #in cm
-            Desired_MiddleCarriage_Distance = int(f['entry/DAS_logs/carriage2Trans/desiredSoftPosition'][0]) #in cm
-            WV = str(f['entry/DAS_logs/wavelength/wavelength'][0])
+    if Header is not None:
+        if np.isfinite(Header['Wavelength']):
+            WV = str(Header['Wavelength'])
             Wavelength = WV[:3]
-            GuideHolder = f['entry/DAS_logs/guide/guide'][0]
-            if "CONV" in str(GuideHolder):
-                Guides =  "CvB"
-            else:
-                GuideNum = int(f['entry/DAS_logs/guide/guide'][0])
-                Guides = str(GuideNum) 
-            Configuration_ID = str(Guides) + "Gd" + str(Desired_FrontCarriage_Distance) + "cmF" + str(Desired_MiddleCarriage_Distance) + "cmM" + str(Wavelength) + "Ang"
+            Configuration_ID = str(Header['Guide']) + "Gd" + str(Header['FrontCarriage']) + "cmF" + str(Header['MiddleCarriage']) + "cmM" + str(Wavelength) + "Ang"
     return Configuration_ID
 
 def VSANS_SortDataAutomaticAlt(SampleDescriptionKeywordsToExclude, TransPanel, input_path, YesNoManualHe3Entry, New_HE3_Files, MuValues, TeValues, Excluded_Filenumbers, Min_Filenumber, Max_Filenumber, Min_Scatt_Filenumber, Max_Scatt_Filenumber, Min_Trans_Filenumber, Max_Trans_Filenumber, ReAssignBlockBeamIntent, ReAssignEmptyIntent, ReAssignOpenIntent, ReAssignSampleIntent, YesNoRenameEmpties):
-    #Uses get_by_filenumber(input_path, filenumber)
-    #Uses VSANS_Sample_BaseNameDescrip(input_path, filenumber)
-    #Uses VSANS_PurposeIntentPolarizationSolenoid(input_path, filenumber)
-    #Uses VSANS_Config_ID(input_path, filenumber)
+    #Uses VSANS_ScanRunHeaders(input_path, filenumbers), at most one metadata read per new or changed file
+    #Uses VSANS_Sample_BaseNameDescripFromHeader(SampleDescriptionKeywordsToExclude, Header)
+    #Uses VSANS_PurposeIntentPolarizationSolenoidFromHeader(Header)
+    #Uses VSANS_Config_IDFromHeader(Header)
     
     Sample_Names = {}
     Sample_Bases = {}
@@ -321,18 +787,19 @@ def VSANS_SortDataAutomaticAlt(SampleDescriptionKeywordsToExclude, TransPanel, i
     CellIdentifier = 0
     HE3OUT_filenumber = -10
 
-    filelist = [fn for fn in os.listdir(input_path) if fn.endswith(".nxs.ngv")] #or filenames = [fn for fn in os.listdir("./") if os.path.isfile(fn)]
-    filelist.sort()
+    filelist = VSANS_RunFileList(input_path) #or filenames = [fn for fn in os.listdir("./") if os.path.isfile(fn)]
+    ScanNumbers = [int(filename[4:9]) for filename in filelist if int(filename[4:9]) >= Min_Filenumber and int(filename[4:9]) <= Max_Filenumber]
+    Headers = dict(zip(ScanNumbers, VSANS_ScanRunHeaders(input_path, ScanNumbers)))
     if len(filelist) >= 1:
         for filename in filelist:
             filenumber = int(filename[4:9])
             if filenumber >= Min_Filenumber and filenumber <= Max_Filenumber:
                 if start_number == 0:
                     start_number = filenumber
-                f = get_by_filenumber(input_path, filenumber)
-                if f is not None:
-                    Sample_Base, Sample_Name, Descrip, ListedConfig, Temp = VSANS_Sample_BaseNameDescrip(SampleDescriptionKeywordsToExclude, input_path, filenumber)
-                    SiMirror, Purpose, Intent, PolarizationState, FrontPolDirection, BackPolDirection, SolenoidPosition = VSANS_PurposeIntentPolarizationSolenoid(input_path, filenumber)
+                Header = Headers[filenumber]
+                if Header is not None:
+                    Sample_Base, Sample_Name, Descrip, ListedConfig, Temp = VSANS_Sample_BaseNameDescripFromHeader(SampleDescriptionKeywordsToExclude, Header)
+                    SiMirror, Purpose, Intent, PolarizationState, FrontPolDirection, BackPolDirection, SolenoidPosition = VSANS_PurposeIntentPolarizationSolenoidFromHeader(Header)
 
                     if filenumber in ReAssignBlockBeamIntent:
                         Intent = 'Block'
@@ -346,10 +813,9 @@ def VSANS_SortDataAutomaticAlt(SampleDescriptionKeywordsToExclude, TransPanel, i
                         Sample_Base = 'Empty'
                         Sample_Name = 'Empty'
                     
-                    Config = VSANS_Config_ID(input_path, filenumber)
-                    Count_time = f['entry/collection_time'][0]
-                    End_time = dateutil.parser.parse(f['entry/end_time'][0])
-                    TimeOfMeasurement = (End_time.timestamp() - Count_time/2)/3600.0 #in hours
+                    Config = VSANS_Config_IDFromHeader(Header)
+                    Count_time = Header['Count_time']
+                    TimeOfMeasurement = (Header['End_time'] - Count_time/2)/3600.0 #in hours
                     if filenumber not in Excluded_Filenumbers and 'UNKNOWN' not in Config and Count_time > 29: #and str(Descrip).find("Align") == -1 and str(Descrip).find("align") == -1:
                         print('Reading:', filenumber, ' ', Sample_Base, Descrip)
                         FileNumberList.append(filenumber)
@@ -359,7 +825,7 @@ def VSANS_SortDataAutomaticAlt(SampleDescriptionKeywordsToExclude, TransPanel, i
                         if 'Block' in Intent:
                             if Config not in BlockBeam:
                                 BlockBeam[Config] = {'Scatt':{'File' : 'NA'}, 'Trans':{'File' : 'NA', 'CountsPerSecond' : 'NA'}, 'ExampleFile' : filenumber}
-                            Trans_Counts = f['entry/instrument/detector_{ds}/integrated_count'.format(ds=TransPanel)][0]
+                            Trans_Counts = Header['Integrated_Counts'][TransPanel]
                             if 'TRANS' in Purpose or 'HE3' in Purpose:
                                 if 'NA' in BlockBeam[Config]['Trans']['File']:
                                     BlockBeam[Config]['Trans']['File'] = [filenumber]
@@ -545,18 +1011,16 @@ def VSANS_SortDataAutomaticAlt(SampleDescriptionKeywordsToExclude, TransPanel, i
                                     CellIdentifier += 1
                                     CellName = CellTimeIdentifier
                             else:
-                                CellTimeIdentifier = f['/entry/DAS_logs/backPolarization/timestamp'][0]/3600000 #milliseconds to hours
-                                CellName = str(f['entry/DAS_logs/backPolarization/name'][0])
-                                CellName = CellName[2:]
-                                CellName = CellName[:-1]
+                                CellTimeIdentifier = Header['HE3_Timestamp']/3600000 #milliseconds to hours
+                                CellName = Header['HE3_Name']
                                 CellName = CellName + str(CellTimeIdentifier)
                                 if CellTimeIdentifier not in HE3_Trans:
-                                    HE3Insert_Time = f['/entry/DAS_logs/backPolarization/timestamp'][0]/3600000 #milliseconds to hours
-                                    Opacity = f['/entry/DAS_logs/backPolarization/opacityAt1Ang'][0]
-                                    Wavelength = f['/entry/DAS_logs/wavelength/wavelength'][0]
+                                    HE3Insert_Time = Header['HE3_Timestamp']/3600000 #milliseconds to hours
+                                    Opacity = Header['HE3_Opacity']
+                                    Wavelength = Header['Wavelength']
                                     ScaledOpacity = Opacity*Wavelength
-                                    TE = f['/entry/DAS_logs/backPolarization/glassTransmission'][0]
-                            HE3Type = str(f['entry/sample/description'][()])
+                                    TE = Header['HE3_Te']
+                            HE3Type = Descrip
                             if 'OUT' in HE3Type:
                                 if Sample_Name not in Trans:
                                     Trans[Sample_Name] = {'Intent': Intent, 'Sample_Base': Sample_Base, 'Config(s)' : {Config : {'Unpol_Files': 'NA', 'U_Files' : 'NA', 'D_Files' : 'NA','Unpol_Trans_Cts': 'NA', 'U_Trans_Cts' : 'NA', 'D_Trans_Cts' : 'NA'}}}
@@ -580,12 +1044,12 @@ def VSANS_SortDataAutomaticAlt(SampleDescriptionKeywordsToExclude, TransPanel, i
                                 HE3OUT_filenumber = filenumber
                                 HE3OUT_config = Config
                                 HE3OUT_sample = Sample_Name
-                                HE3OUT_attenuators = int(f['entry/instrument/attenuator/num_atten_dropped'][0])
+                                HE3OUT_attenuators = Header['Attenuators']
                             elif 'IN' in HE3Type:
                                 HE3IN_filenumber = filenumber
                                 HE3IN_config = Config
                                 HE3IN_sample = Sample_Name
-                                HE3IN_attenuators = int(f['entry/instrument/attenuator/num_atten_dropped'][0])
+                                HE3IN_attenuators = Header['Attenuators']
                                 HE3IN_StartTime = TimeOfMeasurement
                                 if HE3OUT_filenumber > 0:
                                     if HE3OUT_config == HE3IN_config and HE3OUT_attenuators == HE3IN_attenuators and HE3OUT_sample == HE3IN_sample: #This implies that you must have a 3He out before 3He in of same config and atten
@@ -606,6 +1070,7 @@ def VSANS_SortDataAutomaticAlt(SampleDescriptionKeywordsToExclude, TransPanel, i
                                             HE3_Trans[CellTimeIdentifier]['HE3_IN_file'].append(HE3IN_filenumber)
                                             HE3_Trans[CellTimeIdentifier]['Elasped_time'].append(Elasped_time)
                                             HE3_Trans[CellTimeIdentifier]['Cell_name'].append(CellName)
+    VSANS_SaveRunIndex(input_path)
     print(' ')
     return Sample_Names, Sample_Bases, Configs, BlockBeam, Scatt, Trans, Pol_Trans, AlignDet_Trans, HE3_Trans, start_number, FileNumberList
 
@@ -754,7 +1219,7 @@ def VSANS_MakeTransMask(input_path, filenumber, Config, DetectorPanel):
         CvBYesNo = 1
     f = get_by_filenumber(input_path, filenumber)
     for dshort in relevant_detectors:
-        data = np.array(f['entry/instrument/detector_{ds}/data'.format(ds=dshort)])
+        data = get_panel_data(input_path, filenumber, dshort)
         mask_it[dshort] = np.zeros_like(data)
         x_pixel_size = f['entry/instrument/detector_{ds}/x_pixel_size'.format(ds=dshort)][0]/10.0
         y_pixel_size = f['entry/instrument/detector_{ds}/y_pixel_size'.format(ds=dshort)][0]/10.0
@@ -859,7 +1324,8 @@ def VSANS_ShareSampleBaseTransCatalog(Trans, Scatt):
                                 Trans[Sample]['Config(s)'][Config]['U_Files'] = [UpAssociatedTrans[Config][i]]
     return
 
-def VSANS_BlockedBeamCountsPerSecond_ListOfFiles(input_path, filelist, Config, examplefilenumber):
+def VSANS_BlockedBeamCountsPerSecond_ListOfFiles(input_path, filelist, Config, examplefilenumber, HighResSubset=None):
+    #HighResSubset = HighRes_ReadSpec(...) reads only that hyperslab (or block sum) of the B panel
 
     BB_Counts = {}
     BB_Unc = {}
@@ -878,8 +1344,10 @@ def VSANS_BlockedBeamCountsPerSecond_ListOfFiles(input_path, filelist, Config, e
             Count_time = f['entry/collection_time'][0]
             if Count_time > 0:
                 for dshort in relevant_detectors:
-                    bb_data = np.array(f['entry/instrument/detector_{ds}/data'.format(ds=dshort)])
-                    unc = np.sqrt(np.array(f['entry/instrument/detector_{ds}/data'.format(ds=dshort)]))
+                    if dshort == 'B':
+                        bb_data = get_panel_data(input_path, item, dshort, HighResSubset)
+                    else:
+                        bb_data = get_panel_data(input_path, item, dshort)
                 
                     if item_counter < 1:
                         BB_Counts[dshort] = bb_data
@@ -895,7 +1363,10 @@ def VSANS_BlockedBeamCountsPerSecond_ListOfFiles(input_path, filelist, Config, e
         f = get_by_filenumber(input_path, examplefilenumber)
         if f is not None:
             for dshort in relevant_detectors:
-                data = np.array(f['entry/instrument/detector_{ds}/data'.format(ds=dshort)])
+                if dshort == 'B':
+                    data = get_panel_data(input_path, examplefilenumber, dshort, HighResSubset)
+                else:
+                    data = get_panel_data(input_path, examplefilenumber, dshort)
                 BB_CountsPerSecond[dshort] = np.zeros_like(data)
                 BB_Unc[dshort] = np.zeros_like(data)
 
@@ -932,7 +1403,7 @@ def VSANS_CalcABSTrans_BlockBeamList(input_path, trans_filenumber, BBList, Detec
         abs_trans = 0
         abs_trans_unc = 0
         for dshort in relevant_detectors:
-            data = np.array(f['entry/instrument/detector_{ds}/data'.format(ds=dshort)])    
+            data = get_panel_data(input_path, trans_filenumber, dshort)
             if dshort in BB and dshort in BB_Unc:
                 trans = (data - BB[dshort]*count_time)*Mask[dshort]
                 unc = np.sqrt(data + BB_Unc[dshort])*Mask[dshort]
@@ -1078,17 +1549,14 @@ def Plex_File(input_path, start_number, HighResMinX, HighResMaxX, HighResMinY, H
     fullpath = os.path.join(input_path, filename)
     if os.path.isfile(fullpath):
         print('Reading in ', filename)
-        f = h5py.File(fullpath)
+        f = get_pooled_file(fullpath)
+        HighResSubset = HighRes_ReadSpec(HighResMinX, HighResMaxX, HighResMinY, HighResMaxY, ConvertHighResToSubset)
         for dshort in all_detectors:
-            data = np.array(f['entry/instrument/detector_{ds}/data'.format(ds=dshort)])
-            if ConvertHighResToSubset > 0:
-                if dshort == 'B':
-                    data_subset = data[HighResMinX:HighResMaxX+1,HighResMinY:HighResMaxY+1]
-                    PlexData[dshort] = data_subset
-                else:
-                    PlexData[dshort] = data
+            dataset = f['entry/instrument/detector_{ds}/data'.format(ds=dshort)]
+            if HighResSubset is not None and dshort == 'B':
+                PlexData[dshort] = read_hyperslab(dataset, HighResSubset)/(HighRes_RebinFactor(HighResSubset)**2) #block average
             else:
-               PlexData[dshort] = data
+                PlexData[dshort] = np.array(dataset)
     else:
         filenumber = start_number
         f = get_by_filenumber(input_path, filenumber)
@@ -1096,20 +1564,16 @@ def Plex_File(input_path, start_number, HighResMinX, HighResMaxX, HighResMinY, H
             for dshort in all_detectors:
                 datafieldname = 'entry/instrument/detector_{ds}/data'.format(ds=dshort)
                 if datafieldname in f:
-                    data = np.array(f['entry/instrument/detector_{ds}/data'.format(ds=dshort)])
-                    data_filler = np.ones_like(data)
+                    data_filler = np.ones(f[datafieldname].shape, dtype=f[datafieldname].dtype) #only the shape is needed, so the panel is not read
                 else:
                     x_size = f['entry/instrument/detector_{ds}/pixel_num_x'.format(ds=dshort)][0]
                     y_size = f['entry/instrument/detector_{ds}/pixel_num_y'.format(ds=dshort)][0]
-                    data = np.zeros((x_size, y_size))
-                    data_filler = np.ones_like(data)
+                    data_filler = np.ones((x_size, y_size))
                                           
-                if ConvertHighResToSubset > 0:
-                    if dshort == 'B':
-                        data_subset = data_filler[HighResMinX:HighResMaxX+1,HighResMinY:HighResMaxY+1]
-                        PlexData[dshort] = data_subset
-                    else:
-                        PlexData[dshort] = data_filler
+                if ConvertHighResToSubset > 0 and dshort == 'B':
+                    PlexData[dshort] = data_filler[HighResMinX:HighResMaxX+1,HighResMinY:HighResMaxY+1]
+                elif int(HighResRebin) > 1 and dshort == 'B':
+                    PlexData[dshort] = data_filler[:np.shape(data_filler)[0]//int(HighResRebin), :np.shape(data_filler)[1]//int(HighResRebin)]
                 else:
                     PlexData[dshort] = data_filler
         print('Plex file not found; populated with ones instead')
@@ -1117,7 +1581,46 @@ def Plex_File(input_path, start_number, HighResMinX, HighResMaxX, HighResMinY, H
             
     return filename, PlexData
 
-def SolidAngle_AllDetectors(input_path, representative_filenumber, Config):
+class VSANS_DetectorLayout(object):
+    #All panels of a configuration stitched into one flat pixel vector, so per-pixel arithmetic is one array operation.
+    #Panel dshort holds Vector[..., Offsets[dshort]:Offsets[dshort] + Sizes[dshort]], its pixels in C order; leading axes
+    #(e.g. cross-sections) are kept.
+
+    def __init__(self, Detectors, Shapes):
+        #Shapes[dshort] = panel shape, e.g. np.shape(Plex[dshort])
+        self.Detectors = list(Detectors)
+        self.Shapes = {}
+        self.Offsets = {}
+        self.Sizes = {}
+        self.Size = 0
+        for dshort in self.Detectors:
+            self.Shapes[dshort] = tuple([int(n) for n in Shapes[dshort]])
+            self.Offsets[dshort] = self.Size
+            self.Sizes[dshort] = int(np.prod(self.Shapes[dshort]))
+            self.Size += self.Sizes[dshort]
+
+    def Flatten(self, Panels):
+        #Panels[dshort] = array of (..., panel shape); returns the stitched array of (..., Size) with the promoted dtype
+        Pieces = []
+        for dshort in self.Detectors:
+            Panel = np.asarray(Panels[dshort])
+            Pieces.append(Panel.reshape(Panel.shape[:Panel.ndim - len(self.Shapes[dshort])] + (self.Sizes[dshort],)))
+        return np.concatenate(Pieces, axis=-1)
+
+    def Expand(self, PerPanel):
+        #PerPanel[dshort] = scalar or array broadcastable to the panel shape; returns the stitched per-pixel vector
+        return np.concatenate([np.broadcast_to(PerPanel[dshort], self.Shapes[dshort]).ravel() for dshort in self.Detectors])
+
+    def Unflatten(self, Vector):
+        #Returns {dshort : view of Vector reshaped to (..., panel shape)}
+        Panels = {}
+        for dshort in self.Detectors:
+            Start = self.Offsets[dshort]
+            Panels[dshort] = Vector[..., Start:Start + self.Sizes[dshort]].reshape(Vector.shape[:-1] + self.Shapes[dshort])
+        return Panels
+
+def SolidAngle_AllDetectors(input_path, representative_filenumber, Config, HighResSubset=None):
+    #HighResSubset = HighRes_ReadSpec(...); a B pixel read as a HighRes_Rebin block covers Factor**2 pixels
 
     relevant_detectors = nonhighres_detectors
     if str(Config).find('CvB') != -1:
@@ -1138,54 +1641,285 @@ def SolidAngle_AllDetectors(input_path, representative_filenumber, Config):
             theta_x_step = x_pixel_size / realDistZ
             theta_y_step = y_pixel_size / realDistZ
             Solid_Angle[dshort] = theta_x_step * theta_y_step
+            if dshort == 'B':
+                Solid_Angle[dshort] *= HighRes_RebinFactor(HighResSubset)**2
 
     return Solid_Angle
 
+#Floating point type of the scaled and pol-corrected detector images and of the Q maps. 'float32' halves their memory
+#and memory traffic (which matters most for the full rear detector); monitor normalization, the sum over files and the
+#Q histograms are always done in float64, and the Q maps are computed in float64 before being converted. ComputeDType
+#may be set in the user input ('float64' gives the previous results exactly).
+ComputeDType = 'float32'
+
+#Q grids, resolution maps and shadow masks depend only on the instrument geometry read from the representative file, so
+#samples measured in the same instrument state share one set. The results for the last QGridCacheSize geometries are
+#kept (read-only). QGridCacheSize may be set in the user input (0 disables it).
+QGridCacheSize = 8
+qgrid_cache = OrderedDict()
+qgrid_cache_stats = {'hits': 0, 'misses': 0}
+
+#The grids are also stored on disk, one folder per geometry in QGridCacheDir named by a hash of the exact geometry values
+#and QGridCacheVersion, and are memory-mapped (read-only, without copying) by later runs instead of being recalculated.
+#QGridCacheDir may be set in the user input ('' disables it); the folder may be deleted at any time.
+#QGridCacheVersion must be raised whenever QCalculation_FromGeometry changes its results. Once the stored folders take
+#more than QGridCacheMaxMB megabytes, the least recently used ones (by folder modification time, which is renewed whenever
+#a folder is read) are deleted after each save. QGridCacheMaxMB may be set in the user input.
+QGridCacheDir = os.path.join(os.path.expanduser('~'), '.cache', 'VSANS_QGrids')
+QGridCacheMaxMB = 256
+QGridCacheVersion = 1
+QGridNames = ['Qx', 'Qy', 'Qz', 'Q_total', 'Q_perp_unc', 'Q_parl_unc', 'InPlaneAngleMap', 'dimXX', 'dimYY', 'Shadow_Mask']
+
+#Qz and the resolution maps are not needed by every reduction (e.g. Q_perp_unc only enters the 2D output), so they are
+#VSANS_LazyGrid dicts that compute (VSANS_ResolutionMap) and keep each panel's map on first look-up.
+ResolutionMapNames = ['Qz', 'Q_perp_unc', 'Q_parl_unc']
+
+class VSANS_LazyGrid(dict):
+    #Grid[dshort] computes Makers[dshort]() on first look-up and keeps it read-only; copies share the computed maps. Once
+    #the grids are stored on disk (VSANS_SaveQGrids sets Shared['Folder']), maps are read from and written to that folder.
+    def __init__(self, Name, Makers, Shared = None):
+        dict.__init__(self)
+        self.Name = Name
+        self.Makers = Makers
+        self.Shared = {'Maps' : {}, 'Folder' : None} if Shared is None else Shared
+
+    def __missing__(self, dshort):
+        Maps = self.Shared['Maps']
+        if dshort not in Maps:
+            if dshort not in self.Makers:
+                raise KeyError(dshort)
+            Folder = self.Shared['Folder']
+            Map = None
+            if Folder is not None:
+                try:
+                    Map = np.load(os.path.join(Folder, '{n}_{ds}.npy'.format(n=self.Name, ds=dshort)), mmap_mode='r')
+                except (OSError, ValueError):
+                    Map = None
+            if Map is None:
+                Map = self.Makers[dshort]()
+                Map.setflags(write=False)
+                if Folder is not None:
+                    VSANS_SaveQGridMap(Folder, self.Name, dshort, Map)
+            Maps[dshort] = Map
+        return Maps[dshort]
+
+    def keys(self):
+        return list(self.Makers) + [dshort for dshort in dict.keys(self) if dshort not in self.Makers]
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return len(self.keys())
+
+    def __contains__(self, dshort):
+        return dshort in self.Makers or dict.__contains__(self, dshort)
+
+    def items(self):
+        return [(dshort, self[dshort]) for dshort in self.keys()]
+
+    def values(self):
+        return [self[dshort] for dshort in self.keys()]
+
+    def get(self, dshort, default = None):
+        return self[dshort] if dshort in self else default
+
+    def copy(self):
+        Copy = VSANS_LazyGrid(self.Name, self.Makers, self.Shared)
+        dict.update(Copy, dict.items(self))
+        return Copy
+
+def VSANS_ResolutionMakers(Geometry, HighResMinX, HighResMaxX, HighResMinY, HighResMaxY, ConvertHighResToSubset, DType):
+    #Returns Makers[name][dshort] for the VSANS_LazyGrid of each of ResolutionMapNames, giving maps of type DType
+    from functools import partial
+
+    Makers = {}
+    for name in ResolutionMapNames:
+        Makers[name] = OrderedDict()
+        for dshort in Geometry:
+            Makers[name][dshort] = partial(VSANS_ResolutionMap, name, Geometry[dshort], dshort, HighResMinX, HighResMaxX, HighResMinY, HighResMaxY, ConvertHighResToSubset, DType)
+    return Makers
+
+def VSANS_QGridAddress(key):
+    #Hashes the bytes of every geometry value, so only bit-identical geometries share a cache folder
+    import hashlib
+
+    Digest = hashlib.sha256('VSANS_QGrids {v}'.format(v=QGridCacheVersion).encode())
+    for dshort, Values in key[0]:
+        for name, value_type, value in Values:
+            Value = np.asarray(value)
+            Digest.update('{ds}/{n}:{t}:{d}:{s}:'.format(ds=dshort, n=name, t=value_type.__name__, d=Value.dtype.str, s=Value.shape).encode())
+            Digest.update(Value.tobytes())
+    Digest.update(repr(key[1:]).encode())
+    return 'v{v}_{h}'.format(v=QGridCacheVersion, h=Digest.hexdigest())
+
+def VSANS_LoadQGrids(Address, Makers):
+    #Returns the stored grids in the order of QGridNames, memory-mapped, or None if they are not (completely) stored.
+    #Makers = VSANS_ResolutionMakers(...) for the maps of ResolutionMapNames, which are only read (or computed) when used
+    import json
+
+    Folder = os.path.join(QGridCacheDir, Address)
+    try:
+        with open(os.path.join(Folder, 'QGrids.json'), 'rt') as h:
+            Stored = json.load(h)
+        if Stored.get('Version') != QGridCacheVersion:
+            return None
+        QGrids = []
+        for name in QGridNames:
+            if name == 'dimXX' or name == 'dimYY':
+                QGrids.append(VSANS_DecodeHeaderValue(Stored[name]))
+            elif name in ResolutionMapNames:
+                if list(Makers[name]) != Stored['Detectors']:
+                    return None
+                Grid = VSANS_LazyGrid(name, Makers[name])
+                Grid.Shared['Folder'] = Folder
+                QGrids.append(Grid)
+            else:
+                QGrids.append({dshort : np.load(os.path.join(Folder, '{n}_{ds}.npy'.format(n=name, ds=dshort)), mmap_mode='r') for dshort in Stored['Detectors']})
+        os.utime(Folder) #marks the folder as recently used for VSANS_PruneQGridCache
+    except (OSError, ValueError, KeyError):
+        return None
+    return tuple(QGrids)
+
+def VSANS_SaveQGrids(Address, QGrids):
+    #Written to a temporary folder that is then renamed, so other runs never see a partly written entry
+    import json
+    import shutil
+
+    Folder = os.path.join(QGridCacheDir, Address)
+    Temp_Folder = Folder + '.tmp{pid}'.format(pid=os.getpid())
+    Stored = {'Version' : QGridCacheVersion}
+    try:
+        os.makedirs(Temp_Folder, exist_ok=True)
+        for name, Grid in zip(QGridNames, QGrids):
+            if name == 'dimXX' or name == 'dimYY':
+                Stored[name] = VSANS_EncodeHeaderValue(Grid)
+            elif isinstance(Grid, VSANS_LazyGrid):
+                for dshort in Grid.Shared['Maps']:
+                    np.save(os.path.join(Temp_Folder, '{n}_{ds}.npy'.format(n=name, ds=dshort)), Grid.Shared['Maps'][dshort])
+            else:
+                Stored['Detectors'] = list(Grid)
+                for dshort in Grid:
+                    np.save(os.path.join(Temp_Folder, '{n}_{ds}.npy'.format(n=name, ds=dshort)), Grid[dshort])
+        with open(os.path.join(Temp_Folder, 'QGrids.json'), 'wt') as h:
+            json.dump(Stored, h)
+        os.rename(Temp_Folder, Folder)
+    except OSError:
+        shutil.rmtree(Temp_Folder, ignore_errors=True) #e.g. stored meanwhile by another run, or no write access
+    if os.path.isdir(Folder):
+        for Grid in QGrids:
+            if isinstance(Grid, VSANS_LazyGrid):
+                Grid.Shared['Folder'] = Folder #maps computed later are added to it
+    VSANS_PruneQGridCache(Folder)
+    return
+
+def VSANS_SaveQGridMap(Folder, name, dshort, Map):
+    #Adds one map of a VSANS_LazyGrid to the stored grids in Folder
+    Path = os.path.join(Folder, '{n}_{ds}.npy'.format(n=name, ds=dshort))
+    Temp_Path = Path + '.tmp{pid}.npy'.format(pid=os.getpid())
+    try:
+        np.save(Temp_Path, Map)
+        os.replace(Temp_Path, Path)
+    except OSError:
+        if os.path.exists(Temp_Path):
+            os.remove(Temp_Path)
+    VSANS_PruneQGridCache(Folder)
+    return
+
+def VSANS_PruneQGridCache(Keep):
+    #Deletes the least recently used folders of QGridCacheDir (other than Keep) until they take at most QGridCacheMaxMB
+    import shutil
+
+    Folders = []
+    try:
+        for Address in os.listdir(QGridCacheDir):
+            Folder = os.path.join(QGridCacheDir, Address)
+            if Address.startswith('v') and '.tmp' not in Address and os.path.isdir(Folder):
+                Size = sum([os.path.getsize(os.path.join(Folder, fn)) for fn in os.listdir(Folder)])
+                Folders.append((os.path.getmtime(Folder), Folder, Size))
+    except OSError:
+        return #e.g. deleted meanwhile by another run
+    Total = sum([Size for Mtime, Folder, Size in Folders])
+    for Mtime, Folder, Size in sorted(Folders):
+        if Total <= QGridCacheMaxMB*1024*1024:
+            break
+        if os.path.abspath(Folder) != os.path.abspath(Keep):
+            shutil.rmtree(Folder, ignore_errors=True)
+            Total -= Size
+    return
+
+def VSANS_DetectorGeometry(f, dshort):
+    #Reads every value of one detector panel that enters QCalculation_FromGeometry, as read from the file
+
+    Geometry = {}
+    Geometry['data_shape'] = f['entry/instrument/detector_{ds}/data'.format(ds=dshort)].shape #only the panel shape is needed here
+    Geometry['Wavelength'] = f['entry/instrument/beam/monochromator/wavelength'][0] # Angstroms
+    Geometry['Wavelength_spread'] = f['entry/instrument/beam/monochromator/wavelength_spread'][0] # fraction of Wavelength (dL/L)
+    Geometry['dimX'] = f['entry/instrument/detector_{ds}/pixel_num_x'.format(ds=dshort)][0]
+    Geometry['dimY'] = f['entry/instrument/detector_{ds}/pixel_num_y'.format(ds=dshort)][0]
+    Geometry['beam_center_x'] = f['entry/instrument/detector_{ds}/beam_center_x'.format(ds=dshort)][0]
+    Geometry['beam_center_y'] = f['entry/instrument/detector_{ds}/beam_center_y'.format(ds=dshort)][0]
+    Geometry['detector_distance'] = f['entry/instrument/detector_{ds}/distance'.format(ds=dshort)][0]
+    Geometry['x_pixel_size'] = f['entry/instrument/detector_{ds}/x_pixel_size'.format(ds=dshort)][0]/10.0
+    Geometry['y_pixel_size'] = f['entry/instrument/detector_{ds}/y_pixel_size'.format(ds=dshort)][0]/10.0
+    if dshort != 'B':
+        Geometry['panel_gap'] = f['entry/instrument/detector_{ds}/panel_gap'.format(ds=dshort)][0]/10.0
+        Geometry['coeffs'] = f['entry/instrument/detector_{ds}/spatial_calibration'.format(ds=dshort)][0][0]/10.0
+    SampleApShape = f['/entry/DAS_logs/geometry/externalSampleApertureShape'][0]
+    if SampleApShape == 'CIRCLE':
+        SampleApExternal = f['/entry/DAS_logs/geometry/externalSampleAperture'][0] # in cm
+    else:
+        SampleApExternal = f['/entry/DAS_logs/geometry/externalSampleApertureHeight'][0] #external sample aperture in cm
+    if SampleApertureInMM:
+        SampleApExternal *= 0.1 # convert mm to cm
+    Geometry['SampleApExternal'] = SampleApExternal
+    Geometry['SourceAp'] = f['/entry/DAS_logs/geometry/sourceApertureHeight'][0] #source aperture in cm, assumes circular aperture(?) #0.75, 1.5, or 3 for guides; otherwise 6 cm for >= 1 guides
+    Geometry['SampleToSourceAp'] = f['/entry/DAS_logs/geometry/sourceApertureToSample'][0] #1490.6; "Calculated distance between sample and source aperture" in cm
+    '''
+    #SampleApInternal = f['/entry/DAS_logs/geometry/internalSampleApertureHeight'][0] #internal sample aperture in cm
+    #SampleApOffset = f['/entry/instrument/sample_aperture_2/distance'][0] # distance from sample to external sample aperture, in cm
+    #FrontDetToGateValve = f['/entry/DAS_logs/carriage/frontTrans'][0] #400
+    #MiddleDetToGateValve = f['/entry/DAS_logs/carriage/middleTrans'][0] #1650
+    #FrontDetToSample = f['/entry/DAS_logs/geometry/sampleToFrontLeftDetector'][0] #491.4
+    #MiddleDetToSample = f['/entry/DAS_logs/geometry/sampleToMiddleLeftDetector'][0] #1741.4
+    #GateValveToSample = f['/entry/DAS_logs/geometry/samplePositionOffset'][0] #e.g. 91.4; gate valve to sample in cm ("Hand-measured distance from the center of the table the sample is mounted on to the sample. A positive value means the sample is offset towards the guides.")
+    #SampleToSampleAp = f['/entry/DAS_logs/geometry/SampleApertureOffset'][0] #e.g. 106.9; sample to sample aperture in cm ("Hand-measured distance between the Sample aperture and the sample.")            
+    #SampleApToSourceAp = f['/entry/DAS_logs/geometry/sourceApertureToSampleAperture'][0] #1383.7; "Calculated distance between sample aperture and source aperture" in cm
+    #Note gate valve to source aperture distances are based on the number of guides used:
+    #0=2441; 1=2157; 2=1976; 3=1782; 4=1582; 5=1381; 6=1181; 7=980; 8=780; 9=579 in form of # guides=distance in cm
+    '''
+    if dshort == 'MT' or dshort == 'MB' or dshort == 'FT' or dshort == 'FB':
+        Geometry['setback'] = f['entry/instrument/detector_{ds}/setback'.format(ds=dshort)][0]
+        Geometry['vertical_offset'] = f['entry/instrument/detector_{ds}/vertical_offset'.format(ds=dshort)][0]
+        Geometry['lateral_offset'] = 0
+    else:
+        Geometry['setback'] = 0
+        Geometry['vertical_offset'] = 0
+        Geometry['lateral_offset'] = f['entry/instrument/detector_{ds}/lateral_offset'.format(ds=dshort)][0]
+
+    return Geometry
+
 def QCalculation_AllDetectors(SampleDescriptionKeywordsToExclude, input_path, Calc_Q_From_Trans, HighResMinX, HighResMaxX, HighResMinY, HighResMaxY, ConvertHighResToSubset, HighResGain, representative_filenumber, Config, MidddlePixelBorderHorizontal, MidddlePixelBorderVertical, SectorCutAngles, Slices, AlignDet_Trans):
     #Uses VSANS_Sample_BaseNameDescrip(input_path, representative_filenumber)
+    #Uses VSANS_DetectorGeometry; the results are shared through qgrid_cache by all files with the same geometry
 
     relevant_detectors = nonhighres_detectors
     if str(Config).find('CvB') != -1:
         relevant_detectors = all_detectors
 
-    Q_total = {}
-    deltaQ = {}
-    Qx = {}
-    Qy = {}
-    Qz = {}
-    Q_perp_unc = {}
-    Q_parl_unc = {}
-    InPlaneAngleMap = {}
-    TwoThetaAngleMap = {}
-    twotheta_x = {}
-    twotheta_y = {}
-    twotheta_xmin = {}
-    twotheta_xmax = {}
-    twotheta_ymin = {}
-    twotheta_ymax = {}
-    dimXX = {}
-    dimYY = {}
-
-    Sample_Base, Sample_Name, Descrip, Listed_Config, Desired_Temp = VSANS_Sample_BaseNameDescrip(SampleDescriptionKeywordsToExclude, input_path, representative_filenumber)
-
+    Geometry = {}
     f = get_by_filenumber(input_path, representative_filenumber)
     if f is not None:
+        if Calc_Q_From_Trans > 0:
+            Sample_Base, Sample_Name, Descrip, Listed_Config, Desired_Temp = VSANS_Sample_BaseNameDescrip(SampleDescriptionKeywordsToExclude, input_path, representative_filenumber)
+            X_FR, Y_FR, X_MR, Y_MR = VSANS_GetBeamCenterForScattFile(input_path, Sample_Name, Config, AlignDet_Trans)
         for dshort in relevant_detectors:
-            data = np.array(f['entry/instrument/detector_{ds}/data'.format(ds=dshort)])
-            Wavelength = f['entry/instrument/beam/monochromator/wavelength'][0] # Angstroms
-            Wavelength_spread = f['entry/instrument/beam/monochromator/wavelength_spread'][0] # fraction of Wavelength (dL/L)
-            dimX = f['entry/instrument/detector_{ds}/pixel_num_x'.format(ds=dshort)][0]
-            dimY = f['entry/instrument/detector_{ds}/pixel_num_y'.format(ds=dshort)][0]
-            dimXX[dshort] = f['entry/instrument/detector_{ds}/pixel_num_x'.format(ds=dshort)][0]
-            dimYY[dshort] = f['entry/instrument/detector_{ds}/pixel_num_y'.format(ds=dshort)][0]
-            beam_center_x = f['entry/instrument/detector_{ds}/beam_center_x'.format(ds=dshort)][0]
-            beam_center_y = f['entry/instrument/detector_{ds}/beam_center_y'.format(ds=dshort)][0]
+            Geometry[dshort] = VSANS_DetectorGeometry(f, dshort)
+            if dshort == 'B' and HighRes_RebinFactor(HighRes_ReadSpec(HighResMinX, HighResMaxX, HighResMinY, HighResMaxY, ConvertHighResToSubset)) > 1:
+                Geometry[dshort]['rebin'] = int(HighResRebin) #B pixels are read as HighResRebin x HighResRebin blocks
             if Calc_Q_From_Trans > 0:
-                X_FR, Y_FR, X_MR, Y_MR = VSANS_GetBeamCenterForScattFile(input_path, Sample_Name, Config, AlignDet_Trans)
                 x_ctr_offset = 0.0
                 y_ctr_offset = 0.0
-                beam_center_x_infile = beam_center_x
-                beam_center_y_infile = beam_center_y
                 if dshort == 'FR' or dshort == 'FL' or dshort == 'FT' or dshort == 'FB':
                     if 'NA' not in str(X_FR) and 'NA' not in str(Y_FR):
                         if dshort == 'FR': #FR x_ctr_offset: 0.0, y_ctr_offset: 0.0, panel_gap: 0.35, setback: 0.0
@@ -1200,8 +1934,8 @@ def QCalculation_AllDetectors(SampleDescriptionKeywordsToExclude, input_path, Ca
                         elif dshort == 'FB': #FB x_ctr_offset: 0.95, y_ctr_offset: 0.77, panel_gap: 0.33, setback: 41.0
                             x_ctr_offset = 0.95
                             y_ctr_offset = 0.77
-                        beam_center_x = X_FR + x_ctr_offset
-                        beam_center_y = Y_FR + y_ctr_offset
+                        Geometry[dshort]['beam_center_x'] = X_FR + x_ctr_offset
+                        Geometry[dshort]['beam_center_y'] = Y_FR + y_ctr_offset
                 if dshort == 'MR' or dshort == 'ML' or dshort == 'MT' or dshort == 'MB':
                     if 'NA' not in str(X_MR) and 'NA' not in str(Y_MR):
                         if dshort == 'MR': #MR x_ctr_offset: 0.0, y_ctr_offset: 0.0, panel_gap: 0.59, setback: 0.0
@@ -1216,277 +1950,421 @@ def QCalculation_AllDetectors(SampleDescriptionKeywordsToExclude, input_path, Ca
                         elif dshort == 'MB':#MB x_ctr_offset:  -0.89, y_ctr_offset: 0.96, panel_gap: 1.83, setback: 41.0
                             x_ctr_offset = -0.89
                             y_ctr_offset = 0.96
-                        beam_center_x = X_MR + x_ctr_offset
-                        beam_center_y = Y_MR + y_ctr_offset
-                beamstop_diameter = f['/entry/DAS_logs/C2BeamStop/diameter'][0]/10.0 #beam stop in cm; sits right in front of middle detector?
-            detector_distance = f['entry/instrument/detector_{ds}/distance'.format(ds=dshort)][0]
-            x_pixel_size = f['entry/instrument/detector_{ds}/x_pixel_size'.format(ds=dshort)][0]/10.0
-            y_pixel_size = f['entry/instrument/detector_{ds}/y_pixel_size'.format(ds=dshort)][0]/10.0
-            if dshort != 'B':
-                panel_gap = f['entry/instrument/detector_{ds}/panel_gap'.format(ds=dshort)][0]/10.0
-                coeffs = f['entry/instrument/detector_{ds}/spatial_calibration'.format(ds=dshort)][0][0]/10.0
-            SampleApInternal = f['/entry/DAS_logs/geometry/internalSampleApertureHeight'][0] #internal sample aperture in cm
-            SampleApShape = f['/entry/DAS_logs/geometry/externalSampleApertureShape'][0]
-            if SampleApShape == 'CIRCLE':
-                SampleApExternal = f['/entry/DAS_logs/geometry/externalSampleAperture'][0] # in cm
-            else:
-                SampleApExternal = f['/entry/DAS_logs/geometry/externalSampleApertureHeight'][0] #external sample aperture in cm
-            if SampleApertureInMM:
-                SampleApExternal *= 0.1 # convert mm to cm
-            SampleApOffset = f['/entry/instrument/sample_aperture_2/distance'][0] # distance from sample to external sample aperture, in cm
-            SourceAp = f['/entry/DAS_logs/geometry/sourceApertureHeight'][0] #source aperture in cm, assumes circular aperture(?) #0.75, 1.5, or 3 for guides; otherwise 6 cm for >= 1 guides
-            FrontDetToGateValve = f['/entry/DAS_logs/carriage/frontTrans'][0] #400
-            MiddleDetToGateValve = f['/entry/DAS_logs/carriage/middleTrans'][0] #1650
-            RearDetToGateValve = f['/entry/DAS_logs/carriage/rearTrans'][0]
-            FrontDetToSample = f['/entry/DAS_logs/geometry/sampleToFrontLeftDetector'][0] #491.4
-            MiddleDetToSample = f['/entry/DAS_logs/geometry/sampleToMiddleLeftDetector'][0] #1741.4
-            RearDetToSample = f['/entry/DAS_logs/geometry/sampleToRearDetector'][0]
-            SampleToSourceAp = f['/entry/DAS_logs/geometry/sourceApertureToSample'][0] #1490.6; "Calculated distance between sample and source aperture" in cm
-            '''
-            #GateValveToSample = f['/entry/DAS_logs/geometry/samplePositionOffset'][0] #e.g. 91.4; gate valve to sample in cm ("Hand-measured distance from the center of the table the sample is mounted on to the sample. A positive value means the sample is offset towards the guides.")
-            #SampleToSampleAp = f['/entry/DAS_logs/geometry/SampleApertureOffset'][0] #e.g. 106.9; sample to sample aperture in cm ("Hand-measured distance between the Sample aperture and the sample.")            
-            #SampleApToSourceAp = f['/entry/DAS_logs/geometry/sourceApertureToSampleAperture'][0] #1383.7; "Calculated distance between sample aperture and source aperture" in cm
-            #Note gate valve to source aperture distances are based on the number of guides used:
-            #0=2441; 1=2157; 2=1976; 3=1782; 4=1582; 5=1381; 6=1181; 7=980; 8=780; 9=579 in form of # guides=distance in cm
-            '''
-                
-            if dshort == 'MT' or dshort == 'MB' or dshort == 'FT' or dshort == 'FB':
-                setback = f['entry/instrument/detector_{ds}/setback'.format(ds=dshort)][0]
-                vertical_offset = f['entry/instrument/detector_{ds}/vertical_offset'.format(ds=dshort)][0]
-                lateral_offset = 0
-            else:
-                setback = 0
-                vertical_offset = 0
-                lateral_offset = f['entry/instrument/detector_{ds}/lateral_offset'.format(ds=dshort)][0]
+                        Geometry[dshort]['beam_center_x'] = X_MR + x_ctr_offset
+                        Geometry[dshort]['beam_center_y'] = Y_MR + y_ctr_offset
+
+    #values are keyed with their type, as e.g. float32 and float64 geometries do not give identical grids
+    key = (tuple([(dshort, tuple([(name, type(Geometry[dshort][name]), Geometry[dshort][name]) for name in sorted(Geometry[dshort])])) for dshort in Geometry]),
+           ConvertHighResToSubset > 0, HighResMinX, HighResMaxX, HighResMinY, HighResMaxY, MidddlePixelBorderHorizontal, MidddlePixelBorderVertical, np.dtype(ComputeDType).str)
+    if key in qgrid_cache:
+        qgrid_cache.move_to_end(key)
+        qgrid_cache_stats['hits'] += 1
+        QGrids = qgrid_cache[key]
+    else:
+        qgrid_cache_stats['misses'] += 1
+        QGrids = None
+        if QGridCacheDir != '' and len(Geometry) > 0:
+            Address = VSANS_QGridAddress(key)
+            QGrids = VSANS_LoadQGrids(Address, VSANS_ResolutionMakers(Geometry, HighResMinX, HighResMaxX, HighResMinY, HighResMaxY, ConvertHighResToSubset, np.dtype(ComputeDType)))
+        if QGrids is None:
+            QGrids = QCalculation_FromGeometry(Geometry, relevant_detectors, HighResMinX, HighResMaxX, HighResMinY, HighResMaxY, ConvertHighResToSubset, MidddlePixelBorderHorizontal, MidddlePixelBorderVertical)
+            for Grid in QGrids:
+                if isinstance(Grid, VSANS_LazyGrid):
+                    continue #read-only once computed
+                for dshort in Grid:
+                    if isinstance(Grid[dshort], np.ndarray):
+                        Grid[dshort].setflags(write=False)
+            if QGridCacheDir != '' and len(Geometry) > 0:
+                VSANS_SaveQGrids(Address, QGrids)
+        if QGridCacheSize > 0:
+            qgrid_cache[key] = QGrids
+            while len(qgrid_cache) > QGridCacheSize:
+                qgrid_cache.popitem(last=False)
+
+    Qx, Qy, Qz, Q_total, Q_perp_unc, Q_parl_unc, InPlaneAngleMap, dimXX, dimYY, Shadow_Mask = [Grid.copy() for Grid in QGrids]
+    return Qx, Qy, Qz, Q_total, Q_perp_unc, Q_parl_unc, InPlaneAngleMap, dimXX, dimYY, Shadow_Mask
 
-            realDistZ = detector_distance + setback
+#Panels that shadow each panel: pixels behind a left (right) panel are those with two-theta x at or below (above) its
+#edge, pixels behind a top (bottom) panel those with two-theta y at or above (below) its edge.
+ShadowingPanels = {'FT': ['FL', 'FR'], 'FB': ['FL', 'FR'],
+                   'ML': ['FR', 'FL', 'FT', 'FB'], 'MR': ['FR', 'FL', 'FT', 'FB'],
+                   'MT': ['FL', 'FR', 'FT', 'FB', 'ML', 'MR'], 'MB': ['FL', 'FR', 'FT', 'FB', 'ML', 'MR'],
+                   'B': ['FL', 'FR', 'FT', 'FB', 'ML', 'MR', 'MT', 'MB']}
+
+def VSANS_PanelFootprint(x_pos, y_pos, x_min, x_max, y_min, y_max, realDistZ):
+    #The pixel positions only depend on the row (x) or column (y), so the angular footprint of a panel is two-theta along
+    #each axis plus that of its edges
+
+    Footprint = {}
+    Footprint['x'] = np.arctan2(x_pos,realDistZ)
+    Footprint['y'] = np.arctan2(y_pos,realDistZ)
+    Footprint['xmin'] = np.arctan2(x_min,realDistZ)
+    Footprint['xmax'] = np.arctan2(x_max,realDistZ)
+    Footprint['ymin'] = np.arctan2(y_min,realDistZ)
+    Footprint['ymax'] = np.arctan2(y_max,realDistZ)
+    return Footprint
+
+def VSANS_ShadowMasks(Footprints, relevant_detectors, MidddlePixelBorderHorizontal, MidddlePixelBorderVertical, Like = None):
+    #Footprints[dshort] = VSANS_PanelFootprint(...), e.g. for any carriage positions; returns 1.2 for unshadowed pixels
+    #and 0.0 otherwise (with the dtype of Like[dshort] if given). A pixel is shadowed if its row or its column is, so
+    #each mask is the outer product of one row and one column selection.
 
-            if dshort == 'B':
-                realDistX =  x_pixel_size*(0.5)
-                realDistY =  y_pixel_size*(0.5)
-            else:
-                position_key = dshort[1]
-                if position_key == 'T':
-                    realDistX =  coeffs
-                    realDistY =  0.5 * y_pixel_size + vertical_offset + panel_gap/2.0
-                elif position_key == 'B':
-                    realDistX =  coeffs
-                    realDistY =  vertical_offset - (dimY - 0.5)*y_pixel_size - panel_gap/2.0
-                elif position_key == 'L':
-                    realDistX =  lateral_offset - (dimX - 0.5)*x_pixel_size - panel_gap/2.0
-                    realDistY =  coeffs
-                elif position_key == 'R':
-                    realDistX =  x_pixel_size*(0.5) + lateral_offset + panel_gap/2.0
-                    realDistY =  coeffs
-
-            X, Y = np.indices(data.shape)
-            if dshort == 'B':
-                x0_pos =  realDistX - beam_center_x*x_pixel_size + (X)*x_pixel_size 
-                y0_pos =  realDistY - beam_center_y*y_pixel_size + (Y)*y_pixel_size
-                x_min =  realDistX - beam_center_x*x_pixel_size - x_pixel_size 
-                y_min =  realDistY - beam_center_y*y_pixel_size - y_pixel_size
-                x_max =  realDistX - beam_center_x*x_pixel_size + (dimX)*x_pixel_size 
-                y_max =  realDistY - beam_center_y*y_pixel_size + (dimY)*y_pixel_size
-            else:
-                x0_pos =  realDistX - beam_center_x + (X)*x_pixel_size 
-                y0_pos =  realDistY - beam_center_y + (Y)*y_pixel_size
-                x_min =  realDistX - beam_center_x - (1.0)*x_pixel_size
-                y_min =  realDistY - beam_center_y - (1.0)*y_pixel_size
-                x_max =  realDistX - beam_center_x + (dimX)*x_pixel_size
-                y_max =  realDistY - beam_center_y + (dimY)*y_pixel_size
-                
-            if ConvertHighResToSubset > 0 and dshort == 'B':
-                dimXX[dshort] = int(HighResMaxX - HighResMinX + 1)
-                dimYY[dshort] = int(HighResMaxY - HighResMinY + 1)
-                x0_pos = x0_pos[HighResMinX:HighResMaxX+1,HighResMinY:HighResMaxY+1]
-                y0_pos = y0_pos[HighResMinX:HighResMaxX+1,HighResMinY:HighResMaxY+1]
-                x_min =  realDistX - beam_center_x*x_pixel_size + HighResMinX*x_pixel_size 
-                y_min =  realDistY - beam_center_y*y_pixel_size + HighResMinY*y_pixel_size
-                x_max =  realDistX - beam_center_x*x_pixel_size + HighResMaxX*x_pixel_size 
-                y_max =  realDistY - beam_center_y*y_pixel_size + HighResMaxY*y_pixel_size
-
-            '''
-            pad_factor = 1.0
-            if dshort == "FL" or dshort == "ML":
-                x_max = x_max - SampleApExternal/20.0
-                x_max = x_max/pad_factor
-            if dshort == "FR" or dshort == "MR":
-                x_min = x_min + SampleApExternal/20.0
-                x_min = x_min/pad_factor
-            if dshort == "FB" or dshort == "MB":
-                y_max = y_max - SampleApExternal/20.0
-                y_max = y_max/pad_factor
-            if dshort == "FT" or dshort == "MT":
-                y_min = y_min + SampleApExternal/20.0
-                y_min = y_min/pad_factor
-                '''
-                
-            InPlane0_pos = np.sqrt(x0_pos**2 + y0_pos**2)
-            twotheta = np.arctan2(InPlane0_pos,realDistZ)
-            twotheta_x[dshort] = np.arctan2(x0_pos,realDistZ)
-            twotheta_y[dshort] = np.arctan2(y0_pos,realDistZ)
-            twotheta_xmin[dshort] = np.arctan2(x_min,realDistZ)
-            twotheta_xmax[dshort] = np.arctan2(x_max,realDistZ)
-            twotheta_ymin[dshort] = np.arctan2(y_min,realDistZ)
-            twotheta_ymax[dshort] = np.arctan2(y_max,realDistZ)
-            '''#Q resolution from J. of Appl. Cryst. 44, 1127-1129 (2011) and file:///C:/Users/kkrycka/Downloads/SANS_2D_Resolution.pdf where
-            #there seems to be an extra factor of wavelength listed that shouldn't be there in (delta_wavelength/wavelength):'''
-            # carriage_key = dshort[0]
-            # if carriage_key == 'F':
-            #     L2 = FrontDetToSample
-            # elif carriage_key == 'M':
-            #     L2 = MiddleDetToSample
-            # elif dshort == 'B':
-            #     L2 = RearDetToSample
-            g = 981.0 #in cm/s^2
-            m_div_h = 252.77 #in s cm^-2
-            acc = 3.956e5 # velocity [cm/s] of 1 A neutron
-            L2 = realDistZ
-            L1 = SampleToSourceAp
-            Pix = 0.82
-            R1 = SourceAp * 0.5 #source aperture diameter, to radius in cm
-            R2 = SampleApExternal * 0.5 #sample aperture diameter, to radius in cm
-            Inv_LPrime = 1.0/L1 + 1.0/L2
-            k = 2*np.pi/Wavelength
-            YG_d = -0.5*g*L2*(L1+L2)*(Wavelength/acc)**2
-            phi = np.mod(np.arctan2(y0_pos + 2.0*YG_d,x0_pos), 2.0*np.pi) # constrain to [0, 2pi]
-            Sigma_D_Perp = np.abs(np.sin(phi)*x_pixel_size) + np.abs(np.cos(phi)*y_pixel_size)
-            Sigma_D_Parl = np.abs(np.cos(phi)*x_pixel_size) + np.abs(np.sin(phi)*y_pixel_size)
-            SigmaQPerpSqr = (k*k/12.0)*(3*np.power(R1/L1,2) + 3.0*np.power(R2*Inv_LPrime,2)+ np.power(Sigma_D_Perp/L2,2))
-            SigmaQParlSqr = (k*k/12.0)*(3*np.power(R1/L1,2) + 3.0*np.power(R2*Inv_LPrime,2)+ np.power(Sigma_D_Parl/L2,2))
-            R = np.sqrt(np.power(x0_pos,2)+np.power(y0_pos + 2.0*YG_d,2))
-            Q0 = k*R/L2
-            '''
-            #If no gravity correction:
-            #SigmaQParlSqr = SigmaQParlSqr + np.power(Q0,2)*np.power(Wavelength_spread/np.sqrt(6.0),2)
-            #Else, if adding gravity correction:
-            '''
-            
-            A = 0.5*g*L2*(L1+L2)*np.power(m_div_h , 2) # in units 1/cm
-            #A *= 1e-16 # now in units of cm/(A^2)
-            WL = Wavelength*1E-8 # in cm
+    Shadow_Mask = {}
+    for dshort in relevant_detectors:
+        Keep_X = np.ones(len(Footprints[dshort]['x']), dtype=bool)
+        Keep_Y = np.ones(len(Footprints[dshort]['y']), dtype=bool)
+        if dshort == 'ML' or dshort == 'MR' or dshort == 'MT' or dshort == 'MB':
+            Keep_Y[:MidddlePixelBorderHorizontal] = False
+            Keep_Y[len(Keep_Y) - MidddlePixelBorderHorizontal:] = False
+            if dshort != 'MR':
+                Keep_X[:MidddlePixelBorderVertical] = False
+            if dshort != 'ML':
+                Keep_X[len(Keep_X) - MidddlePixelBorderVertical:] = False
+        for Shadowing in ShadowingPanels.get(dshort, []):
+            position_key = Shadowing[1]
+            if position_key == 'L':
+                Keep_X &= ~(Footprints[dshort]['x'] <= Footprints[Shadowing]['xmax'])
+            elif position_key == 'R':
+                Keep_X &= ~(Footprints[dshort]['x'] >= Footprints[Shadowing]['xmin'])
+            elif position_key == 'T':
+                Keep_Y &= ~(Footprints[dshort]['y'] >= Footprints[Shadowing]['ymin'])
+            elif position_key == 'B':
+                Keep_Y &= ~(Footprints[dshort]['y'] <= Footprints[Shadowing]['ymax'])
+        Shadow = np.where(Keep_X[:, np.newaxis] & Keep_Y[np.newaxis, :], 1.2, 0.0)
+        if Like is not None:
+            Shadow = Shadow.astype(Like[dshort].dtype, copy=False)
+        Shadow_Mask[dshort] = Shadow
+    return Shadow_Mask
+
+def VSANS_PixelCoordinates(Geometry, dshort, HighResMinX, HighResMaxX, HighResMinY, HighResMaxY, ConvertHighResToSubset):
+    #Geometry = VSANS_DetectorGeometry(f, dshort), with the beam centers to be used; returns the pixel positions (in cm) and
+    #angles of one panel from which QCalculation_FromGeometry and VSANS_ResolutionMap derive their maps. With
+    #Geometry['rebin'] = Factor the positions and pixel sizes are those of the Factor x Factor blocks (see HighRes_Rebin)
+
+    data_shape = Geometry['data_shape']
+    Wavelength = Geometry['Wavelength']
+    dimX = Geometry['dimX']
+    dimY = Geometry['dimY']
+    beam_center_x = Geometry['beam_center_x']
+    beam_center_y = Geometry['beam_center_y']
+    detector_distance = Geometry['detector_distance']
+    x_pixel_size = Geometry['x_pixel_size']
+    y_pixel_size = Geometry['y_pixel_size']
+    if dshort != 'B':
+        panel_gap = Geometry['panel_gap']
+        coeffs = Geometry['coeffs']
+    SampleToSourceAp = Geometry['SampleToSourceAp']
+    setback = Geometry['setback']
+    vertical_offset = Geometry['vertical_offset']
+    lateral_offset = Geometry['lateral_offset']
+
+    realDistZ = detector_distance + setback
+
+    if dshort == 'B':
+        realDistX =  x_pixel_size*(0.5)
+        realDistY =  y_pixel_size*(0.5)
+    else:
+        position_key = dshort[1]
+        if position_key == 'T':
+            realDistX =  coeffs
+            realDistY =  0.5 * y_pixel_size + vertical_offset + panel_gap/2.0
+        elif position_key == 'B':
+            realDistX =  coeffs
+            realDistY =  vertical_offset - (dimY - 0.5)*y_pixel_size - panel_gap/2.0
+        elif position_key == 'L':
+            realDistX =  lateral_offset - (dimX - 0.5)*x_pixel_size - panel_gap/2.0
+            realDistY =  coeffs
+        elif position_key == 'R':
+            realDistX =  x_pixel_size*(0.5) + lateral_offset + panel_gap/2.0
+            realDistY =  coeffs
+
+    if ConvertHighResToSubset > 0 and dshort == 'B':
+        x0, x1, y0, y1 = HighRes_Subset(HighResMinX, HighResMaxX, HighResMinY, HighResMaxY)
+        X, Y = np.indices((min(x1, data_shape[0]) - x0, min(y1, data_shape[1]) - y0))
+        X = X + x0
+        Y = Y + y0 #pixel indices of the HighRes subset only
+    elif 'rebin' in Geometry:
+        Factor = Geometry['rebin']
+        X, Y = np.indices((data_shape[0]//Factor, data_shape[1]//Factor))
+        X = Factor*X + 0.5*(Factor - 1)
+        Y = Factor*Y + 0.5*(Factor - 1) #block centers in pixel units
+    else:
+        X, Y = np.indices(data_shape)
+    if dshort == 'B':
+        x0_pos =  realDistX - beam_center_x*x_pixel_size + (X)*x_pixel_size 
+        y0_pos =  realDistY - beam_center_y*y_pixel_size + (Y)*y_pixel_size
+        x_min =  realDistX - beam_center_x*x_pixel_size - x_pixel_size 
+        y_min =  realDistY - beam_center_y*y_pixel_size - y_pixel_size
+        x_max =  realDistX - beam_center_x*x_pixel_size + (dimX)*x_pixel_size 
+        y_max =  realDistY - beam_center_y*y_pixel_size + (dimY)*y_pixel_size
+    else:
+        x0_pos =  realDistX - beam_center_x + (X)*x_pixel_size 
+        y0_pos =  realDistY - beam_center_y + (Y)*y_pixel_size
+        x_min =  realDistX - beam_center_x - (1.0)*x_pixel_size
+        y_min =  realDistY - beam_center_y - (1.0)*y_pixel_size
+        x_max =  realDistX - beam_center_x + (dimX)*x_pixel_size
+        y_max =  realDistY - beam_center_y + (dimY)*y_pixel_size
+        
+    if ConvertHighResToSubset > 0 and dshort == 'B':
+        x_min =  realDistX - beam_center_x*x_pixel_size + HighResMinX*x_pixel_size 
+        y_min =  realDistY - beam_center_y*y_pixel_size + HighResMinY*y_pixel_size
+        x_max =  realDistX - beam_center_x*x_pixel_size + HighResMaxX*x_pixel_size 
+        y_max =  realDistY - beam_center_y*y_pixel_size + HighResMaxY*y_pixel_size
 
-            SigmaQParlSqr = SigmaQParlSqr + np.power(Wavelength_spread*k/(L2),2)*(R*R - 4*R*A*np.sin(phi)*WL*WL + 4*A*A*np.power(WL,4))/6.0 #gravity correction makes vary little difference for wavelength spread < 20%
-            '''VSANS IGOR 2D ASCII delta_Q seems to be way off the mark, but this 2D calculaation matches the VSANS circular average closely when pixels are converted to circular average...'''
-            
+    '''
+    pad_factor = 1.0
+    if dshort == "FL" or dshort == "ML":
+        x_max = x_max - SampleApExternal/20.0
+        x_max = x_max/pad_factor
+    if dshort == "FR" or dshort == "MR":
+        x_min = x_min + SampleApExternal/20.0
+        x_min = x_min/pad_factor
+    if dshort == "FB" or dshort == "MB":
+        y_max = y_max - SampleApExternal/20.0
+        y_max = y_max/pad_factor
+    if dshort == "FT" or dshort == "MT":
+        y_min = y_min + SampleApExternal/20.0
+        y_min = y_min/pad_factor
+        '''
+
+    InPlane0_pos = np.sqrt(x0_pos**2 + y0_pos**2)
+    twotheta = np.arctan2(InPlane0_pos,realDistZ)
+    g = 981.0 #in cm/s^2
+    acc = 3.956e5 # velocity [cm/s] of 1 A neutron
+    L2 = realDistZ
+    L1 = SampleToSourceAp
+    YG_d = -0.5*g*L2*(L1+L2)*(Wavelength/acc)**2
+    phi = np.mod(np.arctan2(y0_pos + 2.0*YG_d,x0_pos), 2.0*np.pi) # constrain to [0, 2pi]
+
+    Coordinates = {'realDistZ' : realDistZ, 'x0_pos' : x0_pos, 'y0_pos' : y0_pos, 'x_min' : x_min, 'x_max' : x_max, 'y_min' : y_min, 'y_max' : y_max}
+    Coordinates['x_pixel_size'] = x_pixel_size*Geometry.get('rebin', 1)
+    Coordinates['y_pixel_size'] = y_pixel_size*Geometry.get('rebin', 1)
+    Coordinates.update({'twotheta' : twotheta, 'YG_d' : YG_d, 'phi' : phi})
+    return Coordinates
+
+def VSANS_ResolutionMap(Name, Geometry, dshort, HighResMinX, HighResMaxX, HighResMinY, HighResMaxY, ConvertHighResToSubset, DType):
+    #Returns the map Name ('Qz', 'Q_perp_unc' or 'Q_parl_unc') of one panel, calculated in float64 and returned as DType;
+    #QCalculation_FromGeometry leaves these to be computed when first used (see VSANS_LazyGrid)
+
+    Coordinates = VSANS_PixelCoordinates(Geometry, dshort, HighResMinX, HighResMaxX, HighResMinY, HighResMaxY, ConvertHighResToSubset)
+    Wavelength = Geometry['Wavelength']
+    twotheta = Coordinates['twotheta']
+    if Name == 'Qz':
+        QQ_total = (4.0*np.pi/Wavelength)*np.sin(twotheta/2.0)
+        return (QQ_total*np.sin(twotheta/2.0)).astype(DType, copy=False)
+
+    Wavelength_spread = Geometry['Wavelength_spread']
+    x_pixel_size = Coordinates['x_pixel_size']
+    y_pixel_size = Coordinates['y_pixel_size']
+    SampleApExternal = Geometry['SampleApExternal']
+    SourceAp = Geometry['SourceAp']
+    SampleToSourceAp = Geometry['SampleToSourceAp']
+    realDistZ = Coordinates['realDistZ']
+    x0_pos = Coordinates['x0_pos']
+    y0_pos = Coordinates['y0_pos']
+    '''#Q resolution from J. of Appl. Cryst. 44, 1127-1129 (2011) and file:///C:/Users/kkrycka/Downloads/SANS_2D_Resolution.pdf where
+    #there seems to be an extra factor of wavelength listed that shouldn't be there in (delta_wavelength/wavelength):'''
+    # carriage_key = dshort[0]
+    # if carriage_key == 'F':
+    #     L2 = FrontDetToSample
+    # elif carriage_key == 'M':
+    #     L2 = MiddleDetToSample
+    # elif dshort == 'B':
+    #     L2 = RearDetToSample
+    g = 981.0 #in cm/s^2
+    m_div_h = 252.77 #in s cm^-2
+    L2 = realDistZ
+    L1 = SampleToSourceAp
+    Pix = 0.82
+    R1 = SourceAp * 0.5 #source aperture diameter, to radius in cm
+    R2 = SampleApExternal * 0.5 #sample aperture diameter, to radius in cm
+    Inv_LPrime = 1.0/L1 + 1.0/L2
+    k = 2*np.pi/Wavelength
+    YG_d = Coordinates['YG_d']
+    phi = Coordinates['phi']
+    if Name == 'Q_perp_unc':
+        Sigma_D_Perp = np.abs(np.sin(phi)*x_pixel_size) + np.abs(np.cos(phi)*y_pixel_size)
+        SigmaQPerpSqr = (k*k/12.0)*(3*np.power(R1/L1,2) + 3.0*np.power(R2*Inv_LPrime,2)+ np.power(Sigma_D_Perp/L2,2))
+        return (np.ones_like(twotheta)*np.sqrt(SigmaQPerpSqr)).astype(DType, copy=False)
+    Sigma_D_Parl = np.abs(np.cos(phi)*x_pixel_size) + np.abs(np.sin(phi)*y_pixel_size)
+    SigmaQParlSqr = (k*k/12.0)*(3*np.power(R1/L1,2) + 3.0*np.power(R2*Inv_LPrime,2)+ np.power(Sigma_D_Parl/L2,2))
+    R = np.sqrt(np.power(x0_pos,2)+np.power(y0_pos + 2.0*YG_d,2))
+    Q0 = k*R/L2
+    '''
+    #If no gravity correction:
+    #SigmaQParlSqr = SigmaQParlSqr + np.power(Q0,2)*np.power(Wavelength_spread/np.sqrt(6.0),2)
+    #Else, if adding gravity correction:
+    '''
+    
+    A = 0.5*g*L2*(L1+L2)*np.power(m_div_h , 2) # in units 1/cm
+    #A *= 1e-16 # now in units of cm/(A^2)
+    WL = Wavelength*1E-8 # in cm
 
-            Q_total[dshort] = (4.0*np.pi/Wavelength)*np.sin(twotheta/2.0)
-            QQ_total = (4.0*np.pi/Wavelength)*np.sin(twotheta/2.0)
-            Qx[dshort] = QQ_total*np.cos(twotheta/2.0)*np.cos(phi)
-            Qy[dshort] = QQ_total*np.cos(twotheta/2.0)*np.sin(phi)
-            Qz[dshort] = QQ_total*np.sin(twotheta/2.0)     
-            Q_perp_unc[dshort] = np.ones_like(Q_total[dshort])*np.sqrt(SigmaQPerpSqr)
-            Q_parl_unc[dshort] = np.sqrt(SigmaQParlSqr)
-            Phi_deg = phi*180.0/np.pi
-            TwoTheta_deg = twotheta*180.0/np.pi
-            InPlaneAngleMap[dshort] = Phi_deg
-            TwoThetaAngleMap[dshort] = TwoTheta_deg
-            '''#returns values between -180.0 degrees and +180.0 degrees'''
-
-            '''
-            pixel_size_cm = 0.82
-            source_aperture = SourceAp
-            a = 2 * np.pi / (WL*L_2)
-            b = np.power((L2*source_aperture) / (4*L1), 2)
-            c = np.power((L1 + L2) * sample_aperture / (4 * L1), 2)
-            d = np.power(pixel_size_cm/2, 2) / 3
-            dQ_geometric =  a * np.sqrt(b+c+d)
-
-            dlambda = WL*0.12 #my guess
-            resolution_factor = 6.0 #edit: 041019 from Grethe: should always be 6.
-            dQ_wavelength = dlambda / np.sqrt(resolution_factor)
-
-            g = 981.0 #cm/s^2
-            h_over_mn = 395603.0 #Angstrom cm / s
-            a = 2 * np.pi / (WL*L_2)_2);
-            b = np.power(g, 2) / (4 * np.power(h_over_mn, 4))
-            c = np.power(L2, 2) * np.power(L1 + L2, 2)
-            d = np.power(WL, 4) * (2/3) * np.power(dlambda, 2)
-            dQ_gravity = a * np.sqrt(b*c*d)
-            '''
+    SigmaQParlSqr = SigmaQParlSqr + np.power(Wavelength_spread*k/(L2),2)*(R*R - 4*R*A*np.sin(phi)*WL*WL + 4*A*A*np.power(WL,4))/6.0 #gravity correction makes vary little difference for wavelength spread < 20%
+    '''VSANS IGOR 2D ASCII delta_Q seems to be way off the mark, but this 2D calculaation matches the VSANS circular average closely when pixels are converted to circular average...'''
+    return np.sqrt(SigmaQParlSqr).astype(DType, copy=False)
 
+def QCalculation_FromGeometry(Geometry, relevant_detectors, HighResMinX, HighResMaxX, HighResMinY, HighResMaxY, ConvertHighResToSubset, MidddlePixelBorderHorizontal, MidddlePixelBorderVertical):
+    #Geometry[dshort] = VSANS_DetectorGeometry(f, dshort), with the beam centers to be used; the maps are of type ComputeDType
 
-    Shadow_Mask = {}
-    for dshort in relevant_detectors:
-        Shadow = 1.2*np.ones_like(Qx[dshort])
-        x,y = np.shape(Shadow)
-        if dshort == 'ML' or dshort == 'MR' or dshort == 'MT' or dshort == 'MB':
-            for i in range(0,MidddlePixelBorderHorizontal):
-                Shadow[:,i] = np.zeros(x)
-                Shadow[:,y-i-1] = np.zeros(x)
-            for j in range(0,MidddlePixelBorderVertical):
-                if dshort != 'MR':
-                    Shadow[j] = np.zeros(y)
-                if dshort != 'ML':
-                    Shadow[x-j-1] = np.zeros(y)
-                    
-        if dshort == 'FT' or dshort == 'FB':
-            Shadow[twotheta_x[dshort] <= twotheta_xmax['FL']] = 0.0
-            Shadow[twotheta_x[dshort] >= twotheta_xmin['FR']] = 0.0
-            
-        if dshort == "ML" or dshort == "MR":
-            Shadow[twotheta_x[dshort] >= twotheta_xmin['FR']] = 0.0
-            Shadow[twotheta_x[dshort] <= twotheta_xmax['FL']] = 0.0
-            Shadow[twotheta_y[dshort] >= twotheta_ymin['FT']] = 0.0
-            Shadow[twotheta_y[dshort] <= twotheta_ymax['FB']] = 0.0
-            
-        if dshort == "MT" or dshort == "MB":
-            Shadow[twotheta_x[dshort] <= twotheta_xmax['FL']] = 0.0
-            Shadow[twotheta_x[dshort] >= twotheta_xmin['FR']] = 0.0
-            Shadow[twotheta_y[dshort] >= twotheta_ymin['FT']] = 0.0
-            Shadow[twotheta_y[dshort] <= twotheta_ymax['FB']] = 0.0
-            Shadow[twotheta_x[dshort] <= twotheta_xmax['ML']] = 0.0
-            Shadow[twotheta_x[dshort] >= twotheta_xmin['MR']] = 0.0       
-        if dshort == "B":
-            Shadow[twotheta_x[dshort] <= twotheta_xmax['FL']] = 0.0
-            Shadow[twotheta_x[dshort] >= twotheta_xmin['FR']] = 0.0
-            Shadow[twotheta_y[dshort] >= twotheta_ymin['FT']] = 0.0
-            Shadow[twotheta_y[dshort] <= twotheta_ymax['FB']] = 0.0
-            Shadow[twotheta_x[dshort] <= twotheta_xmax['ML']] = 0.0
-            Shadow[twotheta_x[dshort] >= twotheta_xmin['MR']] = 0.0
-            Shadow[twotheta_y[dshort] >= twotheta_ymin['MT']] = 0.0
-            Shadow[twotheta_y[dshort] <= twotheta_ymax['MB']] = 0.0
+    DType = np.dtype(ComputeDType)
+    Q_total = {}
+    deltaQ = {}
+    Qx = {}
+    Qy = {}
+    InPlaneAngleMap = {}
+    TwoThetaAngleMap = {}
+    Footprints = {}
+    dimXX = {}
+    dimYY = {}
 
-        Shadow_Mask[dshort] = Shadow
+    Makers = VSANS_ResolutionMakers(Geometry, HighResMinX, HighResMaxX, HighResMinY, HighResMaxY, ConvertHighResToSubset, DType)
+    for dshort in Geometry:
+        Wavelength = Geometry[dshort]['Wavelength']
+        dimXX[dshort] = Geometry[dshort]['dimX']
+        dimYY[dshort] = Geometry[dshort]['dimY']
+        if ConvertHighResToSubset > 0 and dshort == 'B':
+            dimXX[dshort] = int(HighResMaxX - HighResMinX + 1)
+            dimYY[dshort] = int(HighResMaxY - HighResMinY + 1)
+        elif 'rebin' in Geometry[dshort]:
+            dimXX[dshort] = int(Geometry[dshort]['data_shape'][0]//Geometry[dshort]['rebin'])
+            dimYY[dshort] = int(Geometry[dshort]['data_shape'][1]//Geometry[dshort]['rebin'])
+        Coordinates = VSANS_PixelCoordinates(Geometry[dshort], dshort, HighResMinX, HighResMaxX, HighResMinY, HighResMaxY, ConvertHighResToSubset)
+        twotheta = Coordinates['twotheta']
+        phi = Coordinates['phi']
+        Footprints[dshort] = VSANS_PanelFootprint(Coordinates['x0_pos'][:, 0], Coordinates['y0_pos'][0, :], Coordinates['x_min'], Coordinates['x_max'], Coordinates['y_min'], Coordinates['y_max'], Coordinates['realDistZ'])
+
+        Q_total[dshort] = (4.0*np.pi/Wavelength)*np.sin(twotheta/2.0)
+        QQ_total = (4.0*np.pi/Wavelength)*np.sin(twotheta/2.0)
+        Qx[dshort] = QQ_total*np.cos(twotheta/2.0)*np.cos(phi)
+        Qy[dshort] = QQ_total*np.cos(twotheta/2.0)*np.sin(phi)
+        Phi_deg = phi*180.0/np.pi
+        TwoTheta_deg = twotheta*180.0/np.pi
+        InPlaneAngleMap[dshort] = Phi_deg
+        TwoThetaAngleMap[dshort] = TwoTheta_deg
+        for Grid in (Q_total, Qx, Qy, InPlaneAngleMap):
+            Grid[dshort] = Grid[dshort].astype(DType, copy=False)
+        '''#returns values between -180.0 degrees and +180.0 degrees'''
+
+        '''
+        pixel_size_cm = 0.82
+        source_aperture = SourceAp
+        a = 2 * np.pi / (WL*L_2)
+        b = np.power((L2*source_aperture) / (4*L1), 2)
+        c = np.power((L1 + L2) * sample_aperture / (4 * L1), 2)
+        d = np.power(pixel_size_cm/2, 2) / 3
+        dQ_geometric =  a * np.sqrt(b+c+d)
+
+        dlambda = WL*0.12 #my guess
+        resolution_factor = 6.0 #edit: 041019 from Grethe: should always be 6.
+        dQ_wavelength = dlambda / np.sqrt(resolution_factor)
+
+        g = 981.0 #cm/s^2
+        h_over_mn = 395603.0 #Angstrom cm / s
+        a = 2 * np.pi / (WL*L_2)_2);
+        b = np.power(g, 2) / (4 * np.power(h_over_mn, 4))
+        c = np.power(L2, 2) * np.power(L1 + L2, 2)
+        d = np.power(WL, 4) * (2/3) * np.power(dlambda, 2)
+        dQ_gravity = a * np.sqrt(b*c*d)
+        '''
+
+
+    Shadow_Mask = VSANS_ShadowMasks(Footprints, relevant_detectors, MidddlePixelBorderHorizontal, MidddlePixelBorderVertical, Qx)
+    Qz = VSANS_LazyGrid('Qz', Makers['Qz'])
+    Q_perp_unc = VSANS_LazyGrid('Q_perp_unc', Makers['Q_perp_unc'])
+    Q_parl_unc = VSANS_LazyGrid('Q_parl_unc', Makers['Q_parl_unc'])
 
     return Qx, Qy, Qz, Q_total, Q_perp_unc, Q_parl_unc, InPlaneAngleMap, dimXX, dimYY, Shadow_Mask
 
+#Sector masks of SectorMask_AllDetectors. The pixels of each in-plane angle map are sorted by angle once, so the pixels
+#of a sector are ranges of that order and only those next to a sector edge are compared. The masks for the last
+#SectorMaskCacheSize (angle map, sector) combinations are kept (read-only). SectorMaskCacheSize may be set in the user
+#input (0 disables both).
+SectorMaskCacheSize = 64
+sector_angle_orders = OrderedDict()
+sector_masks = OrderedDict()
+sector_mask_stats = {'hits': 0, 'misses': 0}
+
 def SectorMask_AllDetectors(SiMirror, Config, InPlaneAngleMap, PrimaryAngle, AngleWidth, BothSides):
 
     SectorMask = {}
     relevant_detectors = nonhighres_detectors
     if str(Config).find('CvB') != -1:
         relevant_detectors = all_detectors
+    if SectorMaskCacheSize <= 0:
+        for dshort in relevant_detectors:
+            SectorMask[dshort] = SectorSelection(InPlaneAngleMap[dshort], SiMirror, PrimaryAngle, AngleWidth, BothSides)
+        return SectorMask
+
+    #angle maps are identified by the arrays themselves, which the cache keeps alive
+    key = (tuple([(dshort, id(InPlaneAngleMap[dshort])) for dshort in relevant_detectors]), PrimaryAngle, AngleWidth, BothSides >= 1, 'IN' in SiMirror)
+    if key in sector_masks and all([sector_masks[key][0][dshort] is InPlaneAngleMap[dshort] for dshort in relevant_detectors]):
+        sector_masks.move_to_end(key)
+        sector_mask_stats['hits'] += 1
+        return dict(sector_masks[key][1])
+    sector_mask_stats['misses'] += 1
     for dshort in relevant_detectors:
-        Angles = InPlaneAngleMap[dshort]
-        SM = np.zeros_like(Angles)
-
-        if PrimaryAngle > 180.0:
-            PrimaryAngle = PrimaryAngle - 360.0
-        if PrimaryAngle < -180.0:
-            PrimaryAngle = PrimaryAngle + 360.0
-        SM[np.absolute(Angles - PrimaryAngle) <= AngleWidth] = 1.0
-        SM[np.absolute(Angles + 360 - PrimaryAngle) <= AngleWidth] = 1.0
-        SM[np.absolute(Angles - 360 - PrimaryAngle) <= AngleWidth] = 1.0
-        if BothSides >= 1:
-            SecondaryAngle = PrimaryAngle + 180
-            if SecondaryAngle > 180.0:
-                SecondaryAngle = SecondaryAngle - 360.0
-            if SecondaryAngle < -180.0:
-                SecondaryAngle = SecondaryAngle + 360.0
-            SM[np.absolute(Angles - SecondaryAngle) <= AngleWidth] = 1.0
-            SM[np.absolute(Angles + 360 - SecondaryAngle) <= AngleWidth] = 1.0
-            SM[np.absolute(Angles - 360 - SecondaryAngle) <= AngleWidth] = 1.0
-
-        #Kludge for Si Mirror
-        if 'IN' in SiMirror:
-            SM[np.absolute(Angles - 90.0) <= 60.0] = 0.0
-            
-            
-            
+        SM = SectorSelection(InPlaneAngleMap[dshort], SiMirror, PrimaryAngle, AngleWidth, BothSides, VSANS_AngleOrder(InPlaneAngleMap[dshort]))
+        SM.flags.writeable = False
         SectorMask[dshort] = SM
-    return SectorMask
-            
+    sector_masks[key] = ({dshort : InPlaneAngleMap[dshort] for dshort in relevant_detectors}, SectorMask)
+    while len(sector_masks) > SectorMaskCacheSize:
+        sector_masks.popitem(last=False)
+    return dict(SectorMask)
+
+def VSANS_AngleOrder(Angles):
+    #(flat pixel indices by increasing angle, sorted angles) of an angle map; those of the last maps used are kept
+
+    key = id(Angles)
+    if key in sector_angle_orders and sector_angle_orders[key][0] is Angles:
+        sector_angle_orders.move_to_end(key)
+        return sector_angle_orders[key][1]
+    Flat = np.ravel(Angles)
+    Order = np.argsort(Flat, kind='stable')
+    sector_angle_orders[key] = (Angles, (Order, Flat[Order]))
+    while len(sector_angle_orders) > SectorMaskCacheSize:
+        sector_angle_orders.popitem(last=False)
+    return sector_angle_orders[key][1]
+
+def sector_pixels(Angles, AngleOrder, Shift, Centre, Width):
+    #flat indices of the pixels with |Angles + Shift - Centre| <= Width, evaluated in float64 (also for float32 maps)
+
+    if AngleOrder is None:
+        return np.flatnonzero(np.absolute(np.asarray(Angles, dtype=np.float64) + Shift - Centre) <= Width)
+    Order, Sorted = AngleOrder
+    Margin = 1e-9*(360.0 + abs(Centre) + abs(Width))
+    Start = np.searchsorted(Sorted, Centre - Shift - Width - Margin, side='left')
+    Stop = np.searchsorted(Sorted, Centre - Shift + Width + Margin, side='right')
+    return Order[Start:Stop][np.absolute(Sorted[Start:Stop].astype(np.float64) + Shift - Centre) <= Width]
+
+def SectorSelection(Angles, SiMirror, PrimaryAngle, AngleWidth, BothSides, AngleOrder=None):
+    #1.0 where the in-plane angles (degrees) lie in the sector, 0.0 elsewhere. AngleOrder, from VSANS_AngleOrder(Angles),
+    #finds the pixels from the sorted angles instead of comparing every pixel
+
+    SM = np.zeros_like(Angles)
+
+    if PrimaryAngle > 180.0:
+        PrimaryAngle = PrimaryAngle - 360.0
+    if PrimaryAngle < -180.0:
+        PrimaryAngle = PrimaryAngle + 360.0
+    Centres = [PrimaryAngle]
+    if BothSides >= 1:
+        SecondaryAngle = PrimaryAngle + 180
+        if SecondaryAngle > 180.0:
+            SecondaryAngle = SecondaryAngle - 360.0
+        if SecondaryAngle < -180.0:
+            SecondaryAngle = SecondaryAngle + 360.0
+        Centres.append(SecondaryAngle)
+    for Centre in Centres:
+        for Shift in (0, 360, -360):
+            np.put(SM, sector_pixels(Angles, AngleOrder, Shift, Centre, AngleWidth), 1.0)
+
+    #Kludge for Si Mirror
+    if 'IN' in SiMirror:
+        np.put(SM, sector_pixels(Angles, AngleOrder, 0, 90.0, 60.0), 0.0)
+
+    return SM
+
 def He3Decay_func(t, p, gamma):
     
     return p * np.exp(-t / gamma)
@@ -1696,7 +2574,73 @@ def vSANS_PolarizationSupermirrorAndFlipper(Pol_Trans, HE3_Cell_Summary, UsePolC
     print(" ")
     return
 
-def AbsScale(YesNoManualHe3Entry, input_path, HighResMinX, HighResMaxX, HighResMinY, HighResMaxY, ConvertHighResToSubset, HighResGain, ScattType, Sample, Config, BlockBeam_per_second, Solid_Angle, Plex, Scatt, Trans):
+#Files averaged by AbsScale are read ahead: while one file is being scaled and added, the next PrefetchDepth files
+#are read by as many background processes, so the latency of slow storage is paid once per PrefetchDepth files
+#(h5py holds the GIL while reading, so threads would not overlap). Set PrefetchDepth = 0 in the user input to read
+#each file only when it is needed.
+PrefetchDepth = 2
+prefetch_readers = {}
+
+def get_prefetch_reader():
+    #The background process is started on first use and kept (with its open files) until close_pooled_files()
+
+    if 'Reader' not in prefetch_readers:
+        prefetch_readers['Reader'] = ProcessPoolExecutor(max_workers = int(PrefetchDepth), initializer = VSANS_ScanWorkerInit, initargs = (VSANS_WorkerSettings(),))
+    return prefetch_readers['Reader']
+
+def VSANS_ReadScattFile(input_path, filenumber, Detectors, HighResSubset, ReadGlassTransmission):
+    #Returns the detector panels (B as the HighResSubset hyperslab if one is given) and the monitor counts, count time and
+    #He3 glass transmission of one scattering file, or None if there is no such file
+
+    f = get_by_filenumber(input_path, filenumber)
+    if f is None:
+        return None
+    Run = {'MonCounts' : f['entry/control/monitor_counts'][0], 'Count_time' : f['entry/collection_time'][0], 'He3Glass_Trans' : 1.0, 'Data' : {}}
+    if ReadGlassTransmission > 0:
+        Run['He3Glass_Trans'] = f['/entry/DAS_logs/backPolarization/glassTransmission'][0]
+    for dshort in Detectors:
+        if dshort == 'B':
+            Run['Data'][dshort] = get_panel_data(input_path, filenumber, dshort, HighResSubset)
+        else:
+            Run['Data'][dshort] = get_panel_data(input_path, filenumber, dshort)
+    return Run
+
+def VSANS_PrefetchScattFiles(input_path, filenumbers, Detectors, HighResSubset, ReadGlassTransmission):
+    #Uses VSANS_ReadScattFile(input_path, filenumber, Detectors, HighResSubset, ReadGlassTransmission) and yields its result
+    #for each file in order, reading up to PrefetchDepth files ahead. Files whose panels are all cached are read here.
+
+    if PrefetchDepth < 1 or len(filenumbers) < 2:
+        for filenumber in filenumbers:
+            yield VSANS_ReadScattFile(input_path, filenumber, Detectors, HighResSubset, ReadGlassTransmission)
+        return
+    Reader = get_prefetch_reader()
+    Pending = deque()
+    for filenumber in filenumbers:
+        Keys = [(input_path, filenumber, dshort, HighResSubset if dshort == 'B' else None) for dshort in Detectors]
+        if all([key in panel_cache for key in Keys]):
+            Pending.append((filenumber, Keys, None))
+        else:
+            Pending.append((filenumber, Keys, Reader.submit(VSANS_ReadScattFile, input_path, filenumber, Detectors, HighResSubset, ReadGlassTransmission)))
+        if len(Pending) > PrefetchDepth:
+            yield VSANS_CollectScattFile(input_path, Pending.popleft(), Detectors, HighResSubset, ReadGlassTransmission)
+    while len(Pending) > 0:
+        yield VSANS_CollectScattFile(input_path, Pending.popleft(), Detectors, HighResSubset, ReadGlassTransmission)
+
+def VSANS_CollectScattFile(input_path, Entry, Detectors, HighResSubset, ReadGlassTransmission):
+    #Waits for a file read ahead by VSANS_PrefetchScattFiles and adds its panels to the panel cache
+
+    filenumber, Keys, Future = Entry
+    if Future is None:
+        return VSANS_ReadScattFile(input_path, filenumber, Detectors, HighResSubset, ReadGlassTransmission)
+    Run = Future.result()
+    if Run is not None:
+        panel_cache_stats['misses'] += len(Keys)
+        for dshort, key in zip(Detectors, Keys):
+            Run['Data'][dshort] = cache_panel_data(key, Run['Data'][dshort])
+    return Run
+
+def AbsScale(YesNoManualHe3Entry, input_path, HighResMinX, HighResMaxX, HighResMinY, HighResMaxY, ConvertHighResToSubset, HighResGain, ScattType, Sample, Config, BlockBeam_per_second, Solid_Angle, Plex, Scatt, Trans, BlockBeam_Subset=None):
+    #BlockBeam_Subset is the spec (HighRes_ReadSpec or None) with which the B panel of BlockBeam_per_second was read
 
     Scaled_Data = {}
     UncScaled_Data = {}
@@ -1706,6 +2650,7 @@ def AbsScale(YesNoManualHe3Entry, input_path, HighResMinX, HighResMaxX, HighResM
     relevant_detectors = nonhighres_detectors
     if str(Config).find('CvB') != -1:
         relevant_detectors = all_detectors
+    HighResSubset = HighRes_ReadSpec(HighResMinX, HighResMaxX, HighResMinY, HighResMaxY, ConvertHighResToSubset)
 
     if Sample in Scatt:
         if Config in Scatt[Sample]['Config(s)']:
@@ -1751,10 +2696,15 @@ def AbsScale(YesNoManualHe3Entry, input_path, HighResMinX, HighResMaxX, HighResM
                 Unc = np.sqrt(Sum)/Pixels
                 Ave = np.average(Holder[masks[dshort] > 0])
                 BB[dshort] = Ave
+                if dshort == 'B':
+                    BB[dshort] = Ave*(HighRes_RebinFactor(HighResSubset)/HighRes_RebinFactor(BlockBeam_Subset))**2 #per pixel as read for the data
                 if ConvertHighResToSubset > 0 and dshort == 'B':
-                    bb_holder = Holder[HighResMinX:HighResMaxX+1,HighResMinY:HighResMaxY+1]
-                    bb_sum = np.sum(bb_holder)
-                    bb_ave = np.average(Holder[HighResMinX:HighResMaxX+1,HighResMinY:HighResMaxY+1])
+                    if BlockBeam_Subset == HighResSubset:
+                        bb_holder = Holder #blocked beam was already read as the HighRes subset
+                    elif BlockBeam_Subset is None:
+                        bb_holder = Holder[HighResMinX:HighResMaxX+1,HighResMinY:HighResMaxY+1]
+                    else:
+                        raise ValueError('blocked beam of B was read as {b}, which is not the HighRes subset {s}'.format(b=BlockBeam_Subset, s=HighResSubset))
                     BB[dshort] = (bb_holder)/HighResGain # Better to subtract BB pixel-by-pixel than average for HighRes detector
 
 
@@ -1764,34 +2714,37 @@ def AbsScale(YesNoManualHe3Entry, input_path, HighResMinX, HighResMaxX, HighResM
                 Scaled_Data = 'NA'
                 UncScaled_Data = 'NA'
             else:
-                for filenumber in Scatt[Sample]['Config(s)'][Config][ScattType]:
+                ReadGlassTransmission = 0
+                if ScattType == 'UU' or ScattType == 'DU'  or ScattType == 'DD'  or ScattType == 'UD':
+                    if YesNoManualHe3Entry == 0:
+                        ReadGlassTransmission = 1
+                Layout = VSANS_DetectorLayout(relevant_detectors, {dshort : np.shape(Plex[dshort]) for dshort in relevant_detectors})
+                BB_Pixels = Layout.Expand(BB)
+                Normalization = Layout.Flatten({dshort : Number_Files*Plex[dshort]*Solid_Angle[dshort] for dshort in relevant_detectors})
+                for Run in VSANS_PrefetchScattFiles(input_path, Scatt[Sample]['Config(s)'][Config][ScattType], relevant_detectors, HighResSubset, ReadGlassTransmission):
                     filecounter += 1
-                    f = get_by_filenumber(input_path, filenumber)
-                    if f is not None:
-                        MonCounts = f['entry/control/monitor_counts'][0]
-                        Count_time = f['entry/collection_time'][0]
-                        He3Glass_Trans = 1.0
+                    if Run is not None:
+                        MonCounts = Run['MonCounts']
+                        Count_time = Run['Count_time']
+                        He3Glass_Trans = Run['He3Glass_Trans']
                         if ScattType == 'UU' or ScattType == 'DU'  or ScattType == 'DD'  or ScattType == 'UD':
-                            if YesNoManualHe3Entry == 0:
-                                He3Glass_Trans = f['/entry/DAS_logs/backPolarization/glassTransmission'][0]
-                            else:
+                            if YesNoManualHe3Entry != 0:
                                 He3Glass_Trans = TeValues[0]
-                        for dshort in relevant_detectors:
-                            data = np.array(f['entry/instrument/detector_{ds}/data'.format(ds=dshort)])
-                            unc = np.array(f['entry/instrument/detector_{ds}/data'.format(ds=dshort)])
-                            if ConvertHighResToSubset > 0 and dshort == 'B':
-                                data_holder = data/HighResGain
-                                data = data_holder[HighResMinX:HighResMaxX+1,HighResMinY:HighResMaxY+1]
-                                unc = data_holder[HighResMinX:HighResMaxX+1,HighResMinY:HighResMaxY+1]
-                            data = (data - Count_time*BB[dshort])/(Number_Files*Plex[dshort]*Solid_Angle[dshort])
-                            if filecounter < 2:
-                                Scaled_Data[dshort] = ((1E8/MonCounts)/(ABS_Scale*He3Glass_Trans))*data
-                                UncScaled_Data[dshort] = unc
-                            else:
-                                Scaled_Data[dshort] += ((1E8/MonCounts)/(ABS_Scale*He3Glass_Trans))*data
-                                UncScaled_Data[dshort] += unc           
-                for dshort in relevant_detectors:
-                    UncScaled_Data[dshort] = np.sqrt(UncScaled_Data[dshort])*((1E8/MonCounts)/(ABS_Scale*He3Glass_Trans))/(Number_Files*Plex[dshort]*Solid_Angle[dshort])
+                        Counts = dict(Run['Data'])
+                        if ConvertHighResToSubset > 0 and 'B' in Counts:
+                            Counts['B'] = Counts['B']/HighResGain
+                        data = Layout.Flatten(Counts) #always a new array, as cached panel data is read-only
+                        unc = data
+                        data = (data - Count_time*BB_Pixels)/Normalization
+                        if filecounter < 2:
+                            Scaled_Data = ((1E8/MonCounts)/(ABS_Scale*He3Glass_Trans))*data
+                            UncScaled_Data = unc
+                        else:
+                            Scaled_Data += ((1E8/MonCounts)/(ABS_Scale*He3Glass_Trans))*data
+                            UncScaled_Data += unc
+                UncScaled_Data = np.sqrt(UncScaled_Data)*((1E8/MonCounts)/(ABS_Scale*He3Glass_Trans))/Normalization
+                Scaled_Data = Layout.Unflatten(Scaled_Data.astype(ComputeDType, copy=False)) #summed over the files in float64
+                UncScaled_Data = Layout.Unflatten(UncScaled_Data.astype(ComputeDType, copy=False))
         else:
             Scaled_Data = 'NA'
             UncScaled_Data = 'NA'
@@ -1819,38 +2772,8 @@ def vSANS_BestSuperMirrorPolarizationValue(UsePolCorr, Starting_PSM, YesNoBypass
 
 def vSANS_PolCorrScattFiles(UsePolCorr, input_path, He3CorrectionType, BestPSM, Minimum_PSM, dimXX, dimYY, Sample, Config, Scatt, Trans, Pol_Trans, UUScaledData, DUScaledData, DDScaledData, UDScaledData, UUScaledData_Unc, DUScaledData_Unc, DDScaledData_Unc, UDScaledData_Unc, HE3_Cell_Summary):
 
-    Scaled_Data = np.zeros((8,4,6144))
-    UncScaled_Data = np.zeros((8,4,6144))
-
     relevant_detectors = nonhighres_detectors
-
-    Det_counter = 0
-    for dshort in relevant_detectors:
-        UUD = np.array(UUScaledData[dshort])
-        Scaled_Data[Det_counter][0][:] += UUD.flatten()
-        
-        DUD = np.array(DUScaledData[dshort])
-        Scaled_Data[Det_counter][1][:] += DUD.flatten()
-
-        DDD = np.array(DDScaledData[dshort])
-        Scaled_Data[Det_counter][2][:] += DDD.flatten()
-
-        UDD = np.array(UDScaledData[dshort])
-        Scaled_Data[Det_counter][3][:] += UDD.flatten()
-
-        UUD_Unc = np.array(UUScaledData_Unc[dshort])
-        UncScaled_Data[Det_counter][0][:] += UUD_Unc.flatten()
-        
-        DUD_Unc = np.array(DUScaledData_Unc[dshort])
-        UncScaled_Data[Det_counter][1][:] += DUD_Unc.flatten()
-
-        DDD_Unc = np.array(DDScaledData_Unc[dshort])
-        UncScaled_Data[Det_counter][2][:] += DDD_Unc.flatten()
-
-        UDD_Unc = np.array(UDScaledData_Unc[dshort])
-        UncScaled_Data[Det_counter][3][:] += UDD_Unc.flatten()
-
-        Det_counter += 1
+    Layout = VSANS_DetectorLayout(relevant_detectors, {dshort : (dimXX[dshort], dimYY[dshort]) for dshort in relevant_detectors})
 
     '''#Full-Pol Reduction:'''
     PolCorr_UU = {}
@@ -1874,9 +2797,7 @@ def vSANS_PolCorrScattFiles(UsePolCorr, input_path, He3CorrectionType, BestPSM,
     Pol_Efficiency_V2 = np.zeros((4,4))
     Pol_Efficiency_V3 = np.zeros((4,4))
     HE3_Efficiency = np.zeros((4,4))
-    PolCorr_AllDetectors = {}
     HE3Corr_AllDetectors = {}
-    Uncertainty_PolCorr_AllDetectors = {}
     Have_FullPol = 0
     if Sample in Trans and str(Scatt[Sample]['Config(s)'][Config]['UU']).find('NA') == -1 and str(Scatt[Sample]['Config(s)'][Config]['DU']).find('NA') == -1 and str(Scatt[Sample]['Config(s)'][Config]['DD']).find('NA') == -1 and str(Scatt[Sample]['Config(s)'][Config]['UD']).find('NA') == -1:
         Have_FullPol = 1
@@ -1959,8 +2880,8 @@ def vSANS_PolCorrScattFiles(UsePolCorr, input_path, He3CorrectionType, BestPSM,
             HRX = int(dimXX['B'])
             HRY = int(dimYY['B'])
             highrespixels = HRX*HRY
-            RearScaled_Data = np.zeros((4, highrespixels))
-            UncRearScaled_Data = np.zeros((4, highrespixels))
+            RearScaled_Data = np.zeros((4, highrespixels), dtype=ComputeDType)
+            UncRearScaled_Data = np.zeros((4, highrespixels), dtype=ComputeDType)
             
             UUR = np.array(UUScaledData['B'])
             RearScaled_Data[0][:] += UUR.flatten()
@@ -1975,7 +2896,7 @@ def vSANS_PolCorrScattFiles(UsePolCorr, input_path, He3CorrectionType, BestPSM,
             UncRearScaled_Data[2][:] = RearScaled_Data[2][:]
             UncRearScaled_Data[3][:] = RearScaled_Data[3][:]
 
-            BackPolCorr = np.dot(Prefactor, RearScaled_Data)
+            BackPolCorr = np.dot(Prefactor, RearScaled_Data).astype(ComputeDType, copy=False) #in float64, as the cross-sections partly cancel
             BackUncertainty_PolCorr = UncRearScaled_Data
             
             PolCorr_UU['B'] = BackPolCorr[0][:][:].reshape((HRX, HRY))
@@ -1988,43 +2909,36 @@ def vSANS_PolCorrScattFiles(UsePolCorr, input_path, He3CorrectionType, BestPSM,
             PolCorr_UD_Unc['B'] = BackUncertainty_PolCorr[3][:][:].reshape((HRX, HRY))
 
         
-        Det_Index = 0
-        for dshort in relevant_detectors:
-            UncData_Per_Detector = UncScaled_Data[Det_Index][:][:]
-            Data_Per_Detector = Scaled_Data[Det_Index][:][:]
-            
-            PolCorr_Data = np.dot(2.0*Prefactor, Data_Per_Detector)
-            '''
-            #Below is the code that allows true matrix error propagation, but it takes a while...so may want to optimize more before implementing.
-            #Also will need to uncomment from uncertainties import unumpy (top).
-            Data_Per_Detector2 = unumpy.umatrix(Scaled_Data[Det_Index][:][:], UncScaled_Data[Det_Index][:][:])
-            PolCorr_Data2 = np.dot(Prefactor, Data_Per_Detector2)
-            PolCorr_Data = unumpy.nominal_values(PolCorr_Data2)
-            PolCorr_Unc = unumpy.std_devs(PolCorr_Data2)
-            '''
-            PolCorr_AllDetectors[dshort] = PolCorr_Data
-            Uncertainty_PolCorr_AllDetectors[dshort] = UncData_Per_Detector
-            Det_Index += 1
-
-            dimX = dimXX[dshort]
-            dimY = dimYY[dshort]
-            PolCorr_UU[dshort] = PolCorr_AllDetectors[dshort][0][:][:].reshape((dimX, dimY))
-            PolCorr_DU[dshort] = PolCorr_AllDetectors[dshort][1][:][:].reshape((dimX, dimY))
-            PolCorr_DD[dshort] = PolCorr_AllDetectors[dshort][2][:][:].reshape((dimX, dimY))
-            PolCorr_UD[dshort] = PolCorr_AllDetectors[dshort][3][:][:].reshape((dimX, dimY))
-            PolCorr_Sum_All[dshort] = PolCorr_UU[dshort] + PolCorr_DU[dshort] + PolCorr_DD[dshort] + PolCorr_UD[dshort]
-            PolCorr_NSF_Sum[dshort] = PolCorr_UU[dshort] + PolCorr_DD[dshort]
-            PolCorr_SF_Sum[dshort] = PolCorr_DU[dshort] + PolCorr_UD[dshort]
-            PolCorr_NSF_Diff[dshort] = PolCorr_DD[dshort] - PolCorr_UU[dshort]
-
-            PolCorr_UU_Unc[dshort] = Uncertainty_PolCorr_AllDetectors[dshort][0][:][:].reshape((dimX, dimY))
-            PolCorr_DU_Unc[dshort] = Uncertainty_PolCorr_AllDetectors[dshort][1][:][:].reshape((dimX, dimY))
-            PolCorr_DD_Unc[dshort] = Uncertainty_PolCorr_AllDetectors[dshort][2][:][:].reshape((dimX, dimY))
-            PolCorr_UD_Unc[dshort] = Uncertainty_PolCorr_AllDetectors[dshort][3][:][:].reshape((dimX, dimY))
-            PolCorr_Sum_All_Unc[dshort] = np.sqrt(np.power(PolCorr_UU_Unc[dshort],2) + np.power(PolCorr_UD_Unc[dshort],2) + np.power(PolCorr_DD_Unc[dshort],2) + np.power(PolCorr_UD_Unc[dshort],2))
-            PolCorr_NSF_Sum_Unc[dshort] = np.sqrt(np.power(PolCorr_UU_Unc[dshort],2) + np.power(PolCorr_DD_Unc[dshort],2))
-            PolCorr_NSF_Diff_Unc[dshort] = PolCorr_NSF_Sum_Unc[dshort]
-            PolCorr_SF_Sum_Unc[dshort] = np.sqrt(np.power(PolCorr_UD_Unc[dshort],2) + np.power(PolCorr_UD_Unc[dshort],2))
+        #all non-HighRes panels at once: rows are the UU, DU, DD, UD cross-sections, columns the stitched pixels
+        Scaled_Data = Layout.Flatten({dshort : np.array([UUScaledData[dshort], DUScaledData[dshort], DDScaledData[dshort], UDScaledData[dshort]], dtype=ComputeDType) for dshort in relevant_detectors})
+        UncScaled_Data = Layout.Flatten({dshort : np.array([UUScaledData_Unc[dshort], DUScaledData_Unc[dshort], DDScaledData_Unc[dshort], UDScaledData_Unc[dshort]], dtype=ComputeDType) for dshort in relevant_detectors})
+
+        PolCorr_Data = np.dot(2.0*Prefactor, Scaled_Data).astype(ComputeDType, copy=False) #in float64, as the cross-sections partly cancel
+        '''
+        #Below is the code that allows true matrix error propagation, but it takes a while...so may want to optimize more before implementing.
+        #Also will need to uncomment from uncertainties import unumpy (top).
+        Data_Per_Detector2 = unumpy.umatrix(Scaled_Data, UncScaled_Data)
+        PolCorr_Data2 = np.dot(Prefactor, Data_Per_Detector2)
+        PolCorr_Data = unumpy.nominal_values(PolCorr_Data2)
+        PolCorr_Unc = unumpy.std_devs(PolCorr_Data2)
+        '''
+        PolCorr_UU.update(Layout.Unflatten(PolCorr_Data[0]))
+        PolCorr_DU.update(Layout.Unflatten(PolCorr_Data[1]))
+        PolCorr_DD.update(Layout.Unflatten(PolCorr_Data[2]))
+        PolCorr_UD.update(Layout.Unflatten(PolCorr_Data[3]))
+        PolCorr_Sum_All.update(Layout.Unflatten(PolCorr_Data[0] + PolCorr_Data[1] + PolCorr_Data[2] + PolCorr_Data[3]))
+        PolCorr_NSF_Sum.update(Layout.Unflatten(PolCorr_Data[0] + PolCorr_Data[2]))
+        PolCorr_SF_Sum.update(Layout.Unflatten(PolCorr_Data[1] + PolCorr_Data[3]))
+        PolCorr_NSF_Diff.update(Layout.Unflatten(PolCorr_Data[2] - PolCorr_Data[0]))
+
+        PolCorr_UU_Unc.update(Layout.Unflatten(UncScaled_Data[0]))
+        PolCorr_DU_Unc.update(Layout.Unflatten(UncScaled_Data[1]))
+        PolCorr_DD_Unc.update(Layout.Unflatten(UncScaled_Data[2]))
+        PolCorr_UD_Unc.update(Layout.Unflatten(UncScaled_Data[3]))
+        PolCorr_Sum_All_Unc.update(Layout.Unflatten(np.sqrt(np.power(UncScaled_Data[0],2) + np.power(UncScaled_Data[3],2) + np.power(UncScaled_Data[2],2) + np.power(UncScaled_Data[3],2))))
+        PolCorr_NSF_Sum_Unc.update(Layout.Unflatten(np.sqrt(np.power(UncScaled_Data[0],2) + np.power(UncScaled_Data[2],2))))
+        PolCorr_NSF_Diff_Unc.update(PolCorr_NSF_Sum_Unc)
+        PolCorr_SF_Sum_Unc.update(Layout.Unflatten(np.sqrt(np.power(UncScaled_Data[3],2) + np.power(UncScaled_Data[3],2))))
 
     return Have_FullPol, PolCorr_Sum_All, PolCorr_NSF_Sum, PolCorr_NSF_Diff, PolCorr_SF_Sum, PolCorr_UU, PolCorr_DU, PolCorr_DD, PolCorr_UD, PolCorr_Sum_All_Unc, PolCorr_NSF_Sum_Unc, PolCorr_NSF_Diff_Unc, PolCorr_SF_Sum_Unc, PolCorr_UU_Unc, PolCorr_DU_Unc, PolCorr_DD_Unc, PolCorr_UD_Unc
 
@@ -2034,14 +2948,14 @@ def MinMaxQ(Absolute_Q_min, Absolute_Q_max, Q_total, Config, HighResMinX, HighRe
     MinQ2 = np.amin(Q_total['ML'])
     MinQ3 = np.amin(Q_total['MT'])
     MinQ4 = np.amin(Q_total['MB'])
-    MinQs = np.array([MinQ1, MinQ2, MinQ3, MinQ4])
+    MinQs = np.array([MinQ1, MinQ2, MinQ3, MinQ4], dtype=np.float64)
     MinQ_Middle = np.amin(MinQs)
     
     MaxQ1 = np.amax(Q_total['FR'])
     MaxQ2 = np.amax(Q_total['FL'])
     MaxQ3 = np.amax(Q_total['FT'])
     MaxQ4 = np.amax(Q_total['FB'])
-    MaxQs = np.array([MaxQ1, MaxQ2, MaxQ3, MaxQ4])
+    MaxQs = np.array([MaxQ1, MaxQ2, MaxQ3, MaxQ4], dtype=np.float64)
     MaxQ_Front = np.amax(MaxQs)
     
     Q_minCalc = MinQ_Middle 
@@ -2064,8 +2978,70 @@ def MinMaxQ(Absolute_Q_min, Absolute_Q_max, Q_total, Config, HighResMinX, HighRe
     
     return Q_min, Q_max, Q_bins
 
+#Pixel-to-Q-bin operators of TwoDimToOneDim. For one Q grid, pixel mask and Q binning, an operator holds the stitched index
+#and the (carriage, Q bin) of every binned pixel, and everything that depends on the geometry alone (pixels, mean Q and
+#Q resolution per bin), so binning an intensity map is one np.bincount. The last QBinOperatorCacheSize operators are kept.
+QBinOperatorCacheSize = 64
+qbin_operators = OrderedDict()
+QBinCarriages = ["F", "M", "B"]
+
+def VSANS_QBinOperator(Q_min, Q_max, Q_bins, QGridPerDetector, masks, relevant_detectors):
+    #Bins as np.histogram(Q, bins=Exp_bins) per carriage; the Q resolution as in the original per-panel calculation
+    import hashlib
+
+    Layout = VSANS_DetectorLayout(relevant_detectors, {dshort : np.shape(QGridPerDetector['Q_total'][dshort]) for dshort in relevant_detectors})
+    Q_tot = Layout.Flatten(QGridPerDetector['Q_total'])
+    Q_unc = Layout.Flatten(QGridPerDetector['Q_parl_unc'])
+    Selected = Layout.Flatten(masks) > 0
+    Digest = hashlib.sha1()
+    for Vector in (Q_tot, Q_unc, Selected):
+        Digest.update(str(Vector.dtype).encode())
+        Digest.update(np.ascontiguousarray(Vector).tobytes())
+    key = (tuple(relevant_detectors), Q_min, Q_max, Q_bins, Digest.hexdigest())
+    if key in qbin_operators:
+        qbin_operators.move_to_end(key)
+        return qbin_operators[key]
+
+    Q_step = (Q_max - Q_min) / Q_bins
+    Exp_bins = np.linspace(Q_min, Q_max + Q_step, Q_bins + 1, endpoint=True)
+    Length = len(QBinCarriages)*Q_bins
+    Carriage = Layout.Expand({dshort : QBinCarriages.index(dshort[0]) for dshort in relevant_detectors})
+    Pixels = np.flatnonzero(Selected)
+    Q = Q_tot[Pixels].astype(np.float64) #binned and summed in float64 also for float32 maps
+    Q_lookup = np.searchsorted(Exp_bins, Q, side="right") - 1
+    Bins = Q_lookup.copy()
+    Bins[Q == Exp_bins[-1]] = Q_bins - 1 #the last histogram bin includes its upper edge
+    InRange = np.logical_and(Bins >= 0, Bins < Q_bins)
+    Operator = {'Layout' : Layout, 'Length' : Length, 'Pixels' : Pixels[InRange], 'Bins' : Carriage[Pixels[InRange]]*Q_bins + Bins[InRange]}
+    Operator['Pixel_Counts'] = np.bincount(Operator['Bins'], minlength=Length).astype(np.float64).reshape((len(QBinCarriages), Q_bins))
+    Operator['Q_Mean'] = np.bincount(Operator['Bins'], weights=Q[InRange], minlength=Length).reshape((len(QBinCarriages), Q_bins))
+
+    # now that we have MeanQ, we can calculate sigmaQ statistically:
+    nonzero_mask = Operator['Pixel_Counts'] > 0
+    MeanQ = Operator['Q_Mean'].copy()
+    MeanQ[nonzero_mask] /= Operator['Pixel_Counts'][nonzero_mask]
+    MeanQ = MeanQ.ravel()
+    # Only the projection of dQ(single_pixel) parallel to Q is important in this calculation:
+    Q_lookup_mask = np.logical_and((Q_lookup < Q_bins), (Q_lookup >= 0))
+    Lookup_Bins = Carriage[Pixels[Q_lookup_mask]]*Q_bins + Q_lookup[Q_lookup_mask]
+    Q_var_contrib = (MeanQ[Lookup_Bins] - Q[Q_lookup_mask])**2 + (Q_unc[Pixels[Q_lookup_mask]].astype(np.float64))**2
+    Q_var = np.bincount(Lookup_Bins, weights=Q_var_contrib, minlength=Length).reshape((len(QBinCarriages), Q_bins))
+    Operator['MeanQ_Unc'] = np.where(nonzero_mask, Q_var, 0.0)
+
+    if QBinOperatorCacheSize > 0:
+        qbin_operators[key] = Operator
+        while len(qbin_operators) > QBinOperatorCacheSize:
+            qbin_operators.popitem(last=False)
+    return Operator
+
 def TwoDimToOneDim(Key, Q_min, Q_max, Q_bins, QGridPerDetector, generalmask, sectormask, PolCorr_AllDetectors, Unc_PolCorr_AllDetectors, ID, Config, PlotYesNo, AverageQRanges):
 
+    return TwoDimToOneDim_Channels(Key, Q_min, Q_max, Q_bins, QGridPerDetector, generalmask, sectormask, [PolCorr_AllDetectors], [Unc_PolCorr_AllDetectors], ID, Config, PlotYesNo, AverageQRanges)[0]
+
+def TwoDimToOneDim_Channels(Key, Q_min, Q_max, Q_bins, QGridPerDetector, generalmask, sectormask, Channels, Unc_Channels, ID, Config, PlotYesNo, AverageQRanges):
+    #Bins several intensity maps sharing the Q grid and masks (e.g. the UU, DU, DD and UD cross-sections) in one pass and
+    #returns the TwoDimToOneDim output of each; the pixels, mean Q and Q resolution are binned once for all of them
+
     masks = {}
     relevant_detectors = nonhighres_detectors
     if str(Config).find('CvB') != -1:
@@ -2073,39 +3049,37 @@ def TwoDimToOneDim(Key, Q_min, Q_max, Q_bins, QGridPerDetector, generalmask, sec
     for dshort in relevant_detectors:
         masks[dshort] = generalmask[dshort]*sectormask[dshort]
 
+    Operator = VSANS_QBinOperator(Q_min, Q_max, Q_bins, QGridPerDetector, masks, relevant_detectors)
+    Layout = Operator['Layout']
+    Number_Channels = len(Channels)
+    #rows are the channels, columns the binned pixels; each channel is binned into its own block of bins
+    UU = Layout.Flatten({dshort : np.array([Channel[dshort] for Channel in Channels]) for dshort in relevant_detectors})[:, Operator['Pixels']]
+    UU_Unc = Layout.Flatten({dshort : np.array([Channel[dshort] for Channel in Unc_Channels]) for dshort in relevant_detectors})[:, Operator['Pixels']]
+    Channel_Bins = (Operator['Bins'] + Operator['Length']*np.arange(Number_Channels)[:, np.newaxis]).ravel()
+    countsUU = np.bincount(Channel_Bins, weights=UU.ravel(), minlength=Number_Channels*Operator['Length']).reshape((Number_Channels, len(QBinCarriages), Q_bins))
+    UncUU = np.bincount(Channel_Bins, weights=np.power(UU_Unc,2).ravel(), minlength=Number_Channels*Operator['Length']).reshape((Number_Channels, len(QBinCarriages), Q_bins))
+
+    return TwoDimToOneDim_Combine(Key, Q_min, Q_max, Q_bins, countsUU, UncUU, Operator['Q_Mean'], Operator['MeanQ_Unc'], Operator['Pixel_Counts'], ID, Config, PlotYesNo, AverageQRanges)
+
+def TwoDimToOneDim_Combine(Key, Q_min, Q_max, Q_bins, countsUU, UncUU, Q_Sum, Q_Var, Pixel_Counts, ID, Config, PlotYesNo, AverageQRanges):
+    #Joins the per-carriage sums (channel, carriage, Q bin) of the intensities, squared uncertainties, Q, Q variance and
+    #pixels into the 1D output of each channel
+
     Q_step = (Q_max - Q_min) / Q_bins
     #Kludge of adding half step 1/20/21
     Q_Values = np.linspace(Q_min, Q_max, Q_bins, endpoint=True) + Q_step/2
+    Number_Channels = len(countsUU)
 
     Histograms = {} # store results by carriage_key
-    zeros_like_Q = np.zeros_like(Q_Values)
-    carriage_keys = ["F", "M", "B"]
-    result_keys = ["I", "I_Unc", "Q_Mean", "MeanQ_Unc", "Pixels", "Sigma_UU"]
-    for carriage_key in carriage_keys:
+    carriage_keys = QBinCarriages
+    for Index, carriage_key in enumerate(carriage_keys):
         Histograms[carriage_key] = {}
-        for k in result_keys:
-            Histograms[carriage_key][k] = zeros_like_Q.copy()
-
-    Q_lookups = {}
-    Exp_bins = np.linspace(Q_min, Q_max + Q_step, Q_bins + 1, endpoint=True)
-    for dshort in relevant_detectors:
-        carriage_key = dshort[0]
-        CurrentHistogram = Histograms[carriage_key]
-        Q_tot = QGridPerDetector['Q_total'][dshort][:][:]
-        UU = PolCorr_AllDetectors[dshort][:][:]
-        UU_Unc = Unc_PolCorr_AllDetectors[dshort][:][:]
-
-        Q_lookup = np.searchsorted(Exp_bins, Q_tot[masks[dshort] > 0], side="right") - 1
-        Q_lookups[dshort] = Q_lookup
-        countsUU, _ = np.histogram(Q_tot[masks[dshort] > 0], bins=Exp_bins, weights=UU[masks[dshort] > 0])
-        UncUU, _ = np.histogram(Q_tot[masks[dshort] > 0], bins=Exp_bins, weights=np.power(UU_Unc[masks[dshort] > 0],2))        
-        MeanQSum, _ = np.histogram(Q_tot[masks[dshort] > 0], bins=Exp_bins, weights=Q_tot[masks[dshort] > 0])
-        pixels, _ = np.histogram(Q_tot[masks[dshort] > 0], bins=Exp_bins, weights=np.ones_like(UU)[masks[dshort] > 0])
-
-        CurrentHistogram["I"] += countsUU
-        CurrentHistogram["I_Unc"] += UncUU
-        CurrentHistogram["Q_Mean"] += MeanQSum
-        CurrentHistogram["Pixels"] += pixels
+        Histograms[carriage_key]["I"] = countsUU[:, Index]
+        Histograms[carriage_key]["I_Unc"] = UncUU[:, Index]
+        Histograms[carriage_key]["Q_Mean"] = Q_Sum[Index].copy()
+        Histograms[carriage_key]["MeanQ_Unc"] = Q_Var[Index].copy()
+        Histograms[carriage_key]["Pixels"] = Pixel_Counts[Index].copy()
+        Histograms[carriage_key]["Sigma_UU"] = np.zeros((Number_Channels, Q_bins))
 
     CombinedPixels = sum(Histograms[k]["Pixels"] for k in carriage_keys)
     nonzero_combined_mask = (CombinedPixels > 0) #True False map
@@ -2117,60 +3091,39 @@ def TwoDimToOneDim(Key, Q_min, Q_max, Q_bins, QGridPerDetector, generalmask, sec
         CurrentHistogram["Q"] = Q_Values[nonzero_mask]
         #CurrentHistogram["Q_Mean"][nonzero_mask]
         #CurrentHistogram["I"][nonzero_mask] 
-        CurrentHistogram["Sigma_UU"][nonzero_mask] = np.sqrt(CurrentHistogram["I_Unc"][nonzero_mask]) / CurrentHistogram["Pixels"][nonzero_mask]
+        CurrentHistogram["Sigma_UU"][:, nonzero_mask] = np.sqrt(CurrentHistogram["I_Unc"][:, nonzero_mask]) / CurrentHistogram["Pixels"][nonzero_mask]
         #CurrentHistogram["I_Unc"][nonzero_mask]
 
-    # now that we have MeanQ, we can calculate sigmaQ statistically:
-    for dshort in relevant_detectors:
-        carriage_key = dshort[0]
-        CurrentHistogram = Histograms[carriage_key]
-        nonzero_mask = CurrentHistogram["nonzero_mask"]
-        # Only the projection of dQ(single_pixel) parallel to Q is important in this calculation:
-        Q_unc = (QGridPerDetector['Q_parl_unc'][dshort][:][:])[masks[dshort] > 0]
-        # This is the Q value for the pixel
-        Q_tot = (QGridPerDetector['Q_total'][dshort][:][:])[masks[dshort] > 0]
-        # Get the lookup table for which bin we're in:
-        Q_lookup = Q_lookups[dshort]
-        Q_lookup_mask = np.logical_and((Q_lookup < Q_bins), (Q_lookup >= 0))
-        # Get the MeanQ for that bin:
-        MeanQ = CurrentHistogram["Q_Mean"].copy()
-        MeanQ[nonzero_mask] /= CurrentHistogram["Pixels"][nonzero_mask]
-        Q_mean_center = MeanQ[Q_lookup[Q_lookup_mask]]
-        Q_pixel_center = Q_tot[Q_lookup_mask]
-        Q_pixel_uncertainty = Q_unc[Q_lookup_mask]
-        Q_var_contrib = (Q_mean_center - Q_pixel_center)**2 + (Q_unc[Q_lookup_mask])**2 
-        Q_var, _ = np.histogram(Q_tot[Q_lookup_mask], bins=Exp_bins, weights=Q_var_contrib)
-        CurrentHistogram["MeanQ_Unc"][nonzero_mask] += Q_var[nonzero_mask]
-
     ErrorBarsYesNo = 0
     if PlotYesNo == 1:
-        fig = plt.figure()
-        if ErrorBarsYesNo == 1:
-            ax = plt.axes()
-            ax.set_xscale("log")
-            ax.set_yscale("log")
-            hist = Histograms["F"]
-            ax.errorbar(hist["Q"], hist["I"][hist["nonzero_mask"]], yerr=hist["Sigma_UU"][hist["nonzero_mask"]], fmt = 'b*', label='Front')
-            hist = Histograms["M"]
-            ax.errorbar(hist["Q"], hist["I"][hist["nonzero_mask"]], yerr=hist["Sigma_UU"][hist["nonzero_mask"]], fmt = 'g*', label='Middle')
-            if str(Config).find('CvB') != -1:
-                hist = Histograms["B"]
-                ax.errorbar(hist["Q"], hist["I"][hist["nonzero_mask"]], yerr=hist["Sigma_UU"][hist["nonzero_mask"]], fmt = 'r*', label='HighRes')
-        else:
-            hist = Histograms["F"]
-            plt.loglog(hist["Q"], hist["I"][hist["nonzero_mask"]], 'b*', label='Front')
-            hist = Histograms["M"]
-            plt.loglog(hist["Q"], hist["I"][hist["nonzero_mask"]], 'g*', label='Middle')
-            if str(Config).find('CvB') != -1:
-                hist = Histograms["B"]
-                plt.loglog(hist["Q"], hist["I"][hist["nonzero_mask"]], 'r*', label='High Res')
+        for Channel in range(Number_Channels):
+            fig = plt.figure()
+            if ErrorBarsYesNo == 1:
+                ax = plt.axes()
+                ax.set_xscale("log")
+                ax.set_yscale("log")
+                hist = Histograms["F"]
+                ax.errorbar(hist["Q"], hist["I"][Channel][hist["nonzero_mask"]], yerr=hist["Sigma_UU"][Channel][hist["nonzero_mask"]], fmt = 'b*', label='Front')
+                hist = Histograms["M"]
+                ax.errorbar(hist["Q"], hist["I"][Channel][hist["nonzero_mask"]], yerr=hist["Sigma_UU"][Channel][hist["nonzero_mask"]], fmt = 'g*', label='Middle')
+                if str(Config).find('CvB') != -1:
+                    hist = Histograms["B"]
+                    ax.errorbar(hist["Q"], hist["I"][Channel][hist["nonzero_mask"]], yerr=hist["Sigma_UU"][Channel][hist["nonzero_mask"]], fmt = 'r*', label='HighRes')
+            else:
+                hist = Histograms["F"]
+                plt.loglog(hist["Q"], hist["I"][Channel][hist["nonzero_mask"]], 'b*', label='Front')
+                hist = Histograms["M"]
+                plt.loglog(hist["Q"], hist["I"][Channel][hist["nonzero_mask"]], 'g*', label='Middle')
+                if str(Config).find('CvB') != -1:
+                    hist = Histograms["B"]
+                    plt.loglog(hist["Q"], hist["I"][Channel][hist["nonzero_mask"]], 'r*', label='High Res')
                 
-        plt.xlabel('Q')
-        plt.ylabel('Intensity')
-        plt.title('{keyword}_{idnum},{cf}'.format(keyword=Key, idnum=ID, cf = Config))
-        plt.legend()
-        fig.savefig('{keyword}_{idnum},CF{cf}.png'.format(keyword=Key, idnum=ID, cf = Config))
-        plt.show()
+            plt.xlabel('Q')
+            plt.ylabel('Intensity')
+            plt.title('{keyword}_{idnum},{cf}'.format(keyword=Key, idnum=ID, cf = Config))
+            plt.legend()
+            fig.savefig('{keyword}_{idnum},CF{cf}.png'.format(keyword=Key, idnum=ID, cf = Config))
+            plt.show()
         
     Q_Common = Q_Values[nonzero_combined_mask]
     Output = {        
@@ -2187,14 +3140,14 @@ def TwoDimToOneDim(Key, Q_min, Q_max, Q_bins, QGridPerDetector, generalmask, sec
         # overlaps = sum([final_masks["B"].astype("float"), final_masks["M"].astype("float"), final_masks["F"].astype("float")])
         
         for k in ["I", "I_Unc", "Q_Mean", "MeanQ_Unc", "Pixels"]:
-            Output[k] = zeros_like_Q.copy()
+            Output[k] = np.zeros(np.shape(Histograms["F"][k]))
             for carriage_key in carriage_keys:
                 mask = final_masks[carriage_key]
-                Output[k][mask] += Histograms[carriage_key][k][mask] # / overlaps[mask]
+                Output[k][..., mask] += Histograms[carriage_key][k][..., mask] # / overlaps[mask]
 
         Output["I_Unc"] = np.sqrt(Output["I_Unc"])
-        Output["I_Unc"][nonzero_combined_mask] /= Output["Pixels"][nonzero_combined_mask]
-        Output["I"][nonzero_combined_mask] /= Output["Pixels"][nonzero_combined_mask]
+        Output["I_Unc"][:, nonzero_combined_mask] /= Output["Pixels"][nonzero_combined_mask]
+        Output["I"][:, nonzero_combined_mask] /= Output["Pixels"][nonzero_combined_mask]
         Output["Q_Mean"][nonzero_combined_mask] /= Output["Pixels"][nonzero_combined_mask]
 
         # This is correct: with no overlap, there is no averaging of uncertainties  
@@ -2216,14 +3169,14 @@ def TwoDimToOneDim(Key, Q_min, Q_max, Q_bins, QGridPerDetector, generalmask, sec
         # overlaps = sum([final_masks["B"].astype("float"), final_masks["M"].astype("float"), final_masks["F"].astype("float")])
 
         for k in ["I", "I_Unc", "Q_Mean", "MeanQ_Unc", "Pixels"]:
-            Output[k] = zeros_like_Q.copy()
+            Output[k] = np.zeros(np.shape(Histograms["F"][k]))
             for carriage_key in carriage_keys:
                 mask = final_masks[carriage_key]
-                Output[k][mask] += Histograms[carriage_key][k][mask] # / overlaps[mask]
+                Output[k][..., mask] += Histograms[carriage_key][k][..., mask] # / overlaps[mask]
 
         Output["I_Unc"] = np.sqrt(Output["I_Unc"])
-        Output["I_Unc"][nonzero_combined_mask] /= Output["Pixels"][nonzero_combined_mask]
-        Output["I"][nonzero_combined_mask] /= Output["Pixels"][nonzero_combined_mask]
+        Output["I_Unc"][:, nonzero_combined_mask] /= Output["Pixels"][nonzero_combined_mask]
+        Output["I"][:, nonzero_combined_mask] /= Output["Pixels"][nonzero_combined_mask]
         #Added this:
         Output["Q_Mean"][nonzero_combined_mask] /= Output["Pixels"][nonzero_combined_mask]
 
@@ -2235,7 +3188,85 @@ def TwoDimToOneDim(Key, Q_min, Q_max, Q_bins, QGridPerDetector, generalmask, sec
     # fig = plt.figure()
     # plt.plot(Output["Q_Mean"], Output["Q_Uncertainty"], 'r+')
     # plt.show()
-    return Output
+    Outputs = []
+    for Channel in range(Number_Channels):
+        Channel_Output = {}
+        for k in Output:
+            if k == "I" or k == "I_Unc":
+                Channel_Output[k] = Output[k][Channel]
+            else:
+                Channel_Output[k] = Output[k].copy() #shared by all channels
+        Outputs.append(Channel_Output)
+    return Outputs
+
+#(Q, in-plane angle) cakes. With UseCakeSlices = 1 (default) the cross-sections of a measurement are binned once into
+#cells of one Q bin by CakeAngleStep degrees (per carriage) and each sector slice is the sum of the angle columns that
+#make up its sector, so further slices or sector widths cost next to nothing. Slices with a sector edge inside a column
+#(e.g. a 12.5 degree half-width with 1 degree columns) are binned with their pixel mask, as they all are with
+#UseCakeSlices = 0. Both may be set in the user input.
+UseCakeSlices = 1
+CakeAngleStep = 1.0
+
+def VSANS_CakeColumns(Sectors, SiMirror, BothSides):
+    #Angle columns of the cake that make up the (PrimaryAngle, AngleWidth) sectors, or None if an edge falls inside a column
+
+    Angle_bins = max(int(round(360.0/CakeAngleStep)), 1)
+    Angle_step = 360.0/Angle_bins
+    Edges = []
+    for PrimaryAngle, AngleWidth in Sectors:
+        Edges += [PrimaryAngle - AngleWidth, PrimaryAngle + AngleWidth]
+    if BothSides >= 1:
+        Edges += [Edge + 180.0 for Edge in Edges]
+    if 'IN' in SiMirror:
+        Edges += [30.0, 150.0]
+    Positions = (np.array(Edges) + 180.0)/Angle_step
+    if not np.allclose(Positions, np.round(Positions), rtol=0, atol=1e-6):
+        return None
+    Angles = -180.0 + (np.arange(Angle_bins) + 0.5)*Angle_step
+    return sum([SectorSelection(Angles, SiMirror, PrimaryAngle, AngleWidth, BothSides) for PrimaryAngle, AngleWidth in Sectors]) > 0
+
+def VSANS_CakeHistogram(Q_min, Q_max, Q_bins, QGridPerDetector, InPlaneAngleMap, generalmask, Channels, Unc_Channels, relevant_detectors):
+    #Sums of the channels, their squared uncertainties, the pixels, Q, Q^2 and the squared Q resolution per cake cell
+
+    Operator = VSANS_QBinOperator(Q_min, Q_max, Q_bins, QGridPerDetector, generalmask, relevant_detectors)
+    Layout = Operator['Layout']
+    Pixels = Operator['Pixels']
+    Angle_bins = max(int(round(360.0/CakeAngleStep)), 1)
+    Angle_step = 360.0/Angle_bins
+    Angle_Index = np.floor(np.mod(Layout.Flatten(InPlaneAngleMap)[Pixels].astype(np.float64) + 180.0, 360.0)/Angle_step).astype(np.int64) #exact for float32 maps
+    Cells = Operator['Bins']*Angle_bins + np.clip(Angle_Index, 0, Angle_bins - 1)
+    Length = Operator['Length']*Angle_bins
+    Shape = (len(QBinCarriages), Q_bins, Angle_bins)
+    Q = Layout.Flatten(QGridPerDetector['Q_total'])[Pixels].astype(np.float64)
+
+    Cake = {}
+    Cake['Pixels'] = np.bincount(Cells, minlength=Length).astype(np.float64).reshape(Shape)
+    Cake['Q'] = np.bincount(Cells, weights=Q, minlength=Length).reshape(Shape)
+    Cake['Q2'] = np.bincount(Cells, weights=Q*Q, minlength=Length).reshape(Shape)
+    Cake['Q_Unc2'] = np.bincount(Cells, weights=np.power(Layout.Flatten(QGridPerDetector['Q_parl_unc'])[Pixels].astype(np.float64), 2), minlength=Length).reshape(Shape)
+
+    Number_Channels = len(Channels)
+    Data = Layout.Flatten({dshort : np.array([Channel[dshort] for Channel in Channels]) for dshort in relevant_detectors})[:, Pixels]
+    Data_Unc = Layout.Flatten({dshort : np.array([Channel[dshort] for Channel in Unc_Channels]) for dshort in relevant_detectors})[:, Pixels]
+    Channel_Cells = (Cells + Length*np.arange(Number_Channels)[:, np.newaxis]).ravel()
+    Cake['I'] = np.bincount(Channel_Cells, weights=Data.ravel(), minlength=Number_Channels*Length).reshape((Number_Channels,) + Shape)
+    Cake['I_Unc2'] = np.bincount(Channel_Cells, weights=np.power(Data_Unc, 2).ravel(), minlength=Number_Channels*Length).reshape((Number_Channels,) + Shape)
+    return Cake
+
+def TwoDimToOneDim_Cake(Key, Q_min, Q_max, Q_bins, Cake, Columns, ID, Config, PlotYesNo, AverageQRanges):
+    #TwoDimToOneDim_Channels output for the pixels of the selected angle columns of a cake
+
+    Weights = np.asarray(Columns, dtype=np.float64)
+    Pixel_Counts = np.dot(Cake['Pixels'], Weights)
+    Q_Sum = np.dot(Cake['Q'], Weights)
+    nonzero_mask = Pixel_Counts > 0
+    MeanQ = np.zeros_like(Q_Sum)
+    MeanQ[nonzero_mask] = Q_Sum[nonzero_mask] / Pixel_Counts[nonzero_mask]
+    #sum over pixels of (MeanQ - Q)^2 + dQ^2
+    Q_Var = np.maximum(np.dot(Cake['Q2'], Weights) - MeanQ*Q_Sum, 0.0) + np.dot(Cake['Q_Unc2'], Weights)
+    Q_Var = np.where(nonzero_mask, Q_Var, 0.0)
+
+    return TwoDimToOneDim_Combine(Key, Q_min, Q_max, Q_bins, np.dot(Cake['I'], Weights), np.dot(Cake['I_Unc2'], Weights), Q_Sum, Q_Var, Pixel_Counts, ID, Config, PlotYesNo, AverageQRanges)
 
 def Raw_Data(input_path, filenumber):
 
@@ -2245,7 +3276,7 @@ def Raw_Data(input_path, filenumber):
     f = get_by_filenumber(input_path, filenumber)
     if f is not None:
         for dshort in nonhighres_detectors:
-            data = np.array(f['entry/instrument/detector_{ds}/data'.format(ds=dshort)])
+            data = get_panel_data(input_path, filenumber, dshort)
             RawData_AllDetectors[dshort] = data
             Unc_RawData_AllDetectors[dshort] = np.sqrt(data)
                     
@@ -2259,81 +3290,23 @@ def ASCIIlike_Output(save_path, YesNo_2DFilesPerDetector, Type, ID, Config, Data
 
     if 'NA' not in Data_AllDetectors and 'NA' not in Unc_Data_AllDetectors:
 
-        for dshort in relevant_detectors:
+        Layout = VSANS_DetectorLayout(relevant_detectors, {dshort : np.shape(QGridPerDetector['Q_total'][dshort]) for dshort in relevant_detectors})
+        Keep = Layout.Flatten(GeneralMask) > 0
+        #columns QX, QY, I, dI, QZ, Q_parl_unc, Q_perp_unc, shadow (all ones) of the stitched pixels
+        Columns = [Layout.Flatten(QGridPerDetector['QX']), Layout.Flatten(QGridPerDetector['QY']), Layout.Flatten(Data_AllDetectors), Layout.Flatten(Unc_Data_AllDetectors),
+                   Layout.Flatten(QGridPerDetector['QZ']), Layout.Flatten(QGridPerDetector['Q_parl_unc']), Layout.Flatten(QGridPerDetector['Q_perp_unc']), np.ones(Layout.Size)]
 
-            Mask = np.array(GeneralMask[dshort])
-            mini_mask = Mask > 0
-
-            Q_tot = QGridPerDetector['Q_total'][dshort][:][:]
-            Q_unc = np.sqrt(np.power(QGridPerDetector['Q_perp_unc'][dshort][:][:],2) + np.power(QGridPerDetector['Q_parl_unc'][dshort][:][:],2))
-
-            QQX = QGridPerDetector['QX'][dshort][:][:]
-            QQX = QQX[mini_mask,...]
-            QQX = QQX.T
-            QXData = QQX.flatten()
-            QQY = QGridPerDetector['QY'][dshort][:][:]
-            QQY = QQY[mini_mask,...]
-            QQY = QQY.T
-            QYData = QQY.flatten()
-            QQZ = QGridPerDetector['QZ'][dshort][:][:]
-            QQZ = QQZ[mini_mask,...]
-            QQZ = QQZ.T
-            QZData = QQZ.flatten()
-            QPP = QGridPerDetector['Q_perp_unc'][dshort][:][:]
-            QPP = QPP[mini_mask,...]
-            QPP = QPP.T
-            QPerpUnc = QPP.flatten()
-            QPR = QGridPerDetector['Q_parl_unc'][dshort][:][:]
-            QPR = QPR[mini_mask,...]
-            QPR = QPR.T
-            QParlUnc = QPR.flatten()
-            Shadow = np.ones_like(Q_tot)
-            Shadow = Shadow[mini_mask,...]
-            Shadow = Shadow.T
-            ShadowHolder = Shadow.flatten()
-
-            Intensity = Data_AllDetectors[dshort]
-            Intensity = Intensity[mini_mask,...]
-            Intensity = Intensity.T
-            Int = Intensity.flatten()
-            Intensity = Intensity.flatten()
-            IntensityUnc = Unc_Data_AllDetectors[dshort]
-            IntensityUnc = IntensityUnc[mini_mask,...]
-            IntensityUnc = IntensityUnc.T
-            DeltaInt = IntensityUnc.flatten()
-            IntensityUnc = IntensityUnc.flatten()
-            if YesNo_2DFilesPerDetector > 0:
+        if YesNo_2DFilesPerDetector > 0:
+            for dshort in relevant_detectors:
+                Start = Layout.Offsets[dshort]
+                End = Start + Layout.Sizes[dshort]
                 print('Outputting Unpol data into ASCII-like format for {det}, GroupID = {idnum} '.format(det=dshort, idnum=ID))
-                ASCII_like = np.array([QXData, QYData, Int, DeltaInt, QZData, QParlUnc, QPerpUnc, ShadowHolder])
+                ASCII_like = np.array([Column[Start:End][Keep[Start:End]] for Column in Columns])
                 ASCII_like = ASCII_like.T
                 np.savetxt('{TP}Scatt_{Samp}_{CF}_{det}.DAT'.format(TP=Type, Samp=ID, CF=Config, det=dshort), ASCII_like, delimiter = ' ', comments = '', header = 'ASCII data created Mon, Jan 13, 2020 2:39:54 PM')
-           
-
-            if dshort == relevant_detectors[0]:
-                Int_Combined = Intensity
-                DeltaInt_Combined = IntensityUnc
-                QXData_Combined = QXData
-                QYData_Combined = QYData
-                QZData_Combined = QZData
-                QPP_Combined = QPP
-                QPerpUnc_Combined = QPerpUnc
-                QPR_Combined = QPR
-                QParlUnc_Combined = QParlUnc
-                Shadow_Combined = ShadowHolder
-            else:
-                Int_Combined = np.concatenate((Int_Combined, Intensity), axis=0)
-                DeltaInt_Combined = np.concatenate((DeltaInt_Combined, IntensityUnc), axis=0)
-                QXData_Combined = np.concatenate((QXData_Combined, QXData), axis=0)
-                QYData_Combined = np.concatenate((QYData_Combined, QYData), axis=0)
-                QZData_Combined = np.concatenate((QZData_Combined, QZData), axis=0)
-                QPP_Combined = np.concatenate((QPP_Combined, QPP), axis=0)
-                QPerpUnc_Combined = np.concatenate((QPerpUnc_Combined, QPerpUnc), axis=0)
-                QPR_Combined = np.concatenate((QPR_Combined, QPR), axis=0)
-                QParlUnc_Combined = np.concatenate((QParlUnc_Combined, QParlUnc), axis=0)
-                Shadow_Combined = np.concatenate((Shadow_Combined, ShadowHolder), axis=0)
 
         print('Outputting {TP} 2D data, {idnum}, {CF} '.format(TP=Type, idnum=ID, CF=Config))        
-        ASCII_Combined = np.array([QXData_Combined, QYData_Combined, Int_Combined, DeltaInt_Combined, QZData_Combined, QParlUnc_Combined, QPerpUnc_Combined, Shadow_Combined])
+        ASCII_Combined = np.array([Column[Keep] for Column in Columns])
         ASCII_Combined = ASCII_Combined.T
         #Kludge
         np.savetxt(save_path + '2D_{Samp}_{TP}.DAT'.format(Samp=ID, CF=Config, TP=Type,), ASCII_Combined, delimiter = ' ', comments = '', header = 'ASCII data created Mon, Jan 13, 2020 2:39:54 PM')
@@ -2464,11 +3437,57 @@ def PlotFourCombinedCrossSections(save_path, YesNoShowPlots, YesNoSetPlotXRange,
 
     return
 
-def vSANS_FullPolSlices(Q_total, SiMirror, Slices, SectorCutAngles, AverageQRanges, PolCorrDegree, Sample, Config, InPlaneAngleMap, Q_min, Q_max, Q_bins, QValues_All, Shadow_Mask, PolCorrUU, PolCorrUU_Unc, PolCorrDU, PolCorrDU_Unc, PolCorrDD, PolCorrDD_Unc, PolCorrUD, PolCorrUD_Unc):
+def VSANS_SectorCutWidths(SectorCutAngles):
+    #SectorCutAngles is one sector half-width or a list of them, which are then all sliced and saved side by side
+
+    if isinstance(SectorCutAngles, (list, tuple, np.ndarray)):
+        return list(SectorCutAngles)
+    return [SectorCutAngles]
+
+def VSANS_SectorSlices(SiMirror, Slices, SectorCutAngles, AverageQRanges, Sample, Config, InPlaneAngleMap, Q_min, Q_max, Q_bins, QValues_All, Shadow_Mask, Channels, Unc_Channels):
+    #1D cuts of the channels for each of the Slices (and sector widths), as {slice_key : [output of each channel]}
 
     relevant_detectors = nonhighres_detectors
     if str(Config).find('CvB') != -1:
         relevant_detectors = all_detectors
+
+    PlotYesNo = 0
+    BothSides = 1
+    Sectors = OrderedDict()
+    for Width in VSANS_SectorCutWidths(SectorCutAngles):
+        for slices in Slices:
+            if slices == "Circ":
+                Sectors["CircAve"] = [(0, 180)]
+            elif slices == "Vert":
+                Sectors["Vert"+str(Width)] = [(90, Width)]
+            elif slices == "Horz":
+                Sectors["Horz"+str(Width)] = [(0, Width)]
+            elif slices == "Diag":
+                Sectors["Diag"+str(Width)] = [(45, Width), (-45, Width)]
+
+    Cuts = {}
+    Cake = None
+    for slice_key in Sectors:
+        Columns = None
+        if UseCakeSlices > 0:
+            Columns = VSANS_CakeColumns(Sectors[slice_key], SiMirror, BothSides)
+        if Columns is not None:
+            if Cake is None:
+                Cake = VSANS_CakeHistogram(Q_min, Q_max, Q_bins, QValues_All, InPlaneAngleMap, Shadow_Mask, Channels, Unc_Channels, relevant_detectors)
+            Cuts[slice_key] = TwoDimToOneDim_Cake(slice_key, Q_min, Q_max, Q_bins, Cake, Columns, Sample, Config, PlotYesNo, AverageQRanges)
+        else:
+            local_mask = {}
+            for PrimaryAngle, AngleWidth in Sectors[slice_key]:
+                Mask = SectorMask_AllDetectors(SiMirror, Config, InPlaneAngleMap, PrimaryAngle, AngleWidth, BothSides)
+                for dshort in relevant_detectors:
+                    local_mask[dshort] = local_mask[dshort] + Mask[dshort] if dshort in local_mask else Mask[dshort]
+            Cuts[slice_key] = TwoDimToOneDim_Channels(slice_key, Q_min, Q_max, Q_bins, QValues_All, Shadow_Mask, local_mask, Channels, Unc_Channels, Sample, Config, PlotYesNo, AverageQRanges)
+
+    return Cuts
+
+def vSANS_FullPolSlices(Q_total, SiMirror, Slices, SectorCutAngles, AverageQRanges, PolCorrDegree, Sample, Config, InPlaneAngleMap, Q_min, Q_max, Q_bins, QValues_All, Shadow_Mask, PolCorrUU, PolCorrUU_Unc, PolCorrDU, PolCorrDU_Unc, PolCorrDD, PolCorrDD_Unc, PolCorrUD, PolCorrUD_Unc):
+
+    if str(Config).find('CvB') != -1:
         AverageQRanges = 0
 
     Corr = "PolCorr"
@@ -2479,39 +3498,10 @@ def vSANS_FullPolSlices(Q_total, SiMirror, Slices, SectorCutAngles, AverageQRang
     else:
         Corr = "NotCorr"
 
-    PlotYesNo = 0
-    BothSides = 1
-    HorzMask = SectorMask_AllDetectors(SiMirror, Config, InPlaneAngleMap, 0, SectorCutAngles, BothSides)
-    VertMask = SectorMask_AllDetectors(SiMirror, Config, InPlaneAngleMap, 90, SectorCutAngles, BothSides)
-    CircMask = SectorMask_AllDetectors(SiMirror, Config, InPlaneAngleMap, 0, 180, BothSides)
-    DiagMaskA = SectorMask_AllDetectors(SiMirror, Config, InPlaneAngleMap, 45, SectorCutAngles, BothSides)
-    DiagMaskB = SectorMask_AllDetectors(SiMirror, Config, InPlaneAngleMap, -45, SectorCutAngles, BothSides)
-    DiagMask = {}
-    for dshort in relevant_detectors:
-        DiagMask[dshort] = DiagMaskA[dshort] + DiagMaskB[dshort]
-
     ReturnSlices = {}
-    
-    for slices in Slices:
-        if slices == "Circ":
-            slice_key = "CircAve"
-            local_mask = CircMask
-        elif slices == "Vert":
-            slice_key = "Vert"+str(SectorCutAngles)
-            local_mask = VertMask
-        elif slices == "Horz":
-            slice_key = "Horz"+str(SectorCutAngles)
-            local_mask = HorzMask
-        elif slices == "Diag":
-            slice_key = "Diag"+str(SectorCutAngles)
-            local_mask = DiagMask
-
-        UU = TwoDimToOneDim(slice_key, Q_min, Q_max, Q_bins, QValues_All, Shadow_Mask, local_mask, PolCorrUU, PolCorrUU_Unc, Sample, Config, PlotYesNo, AverageQRanges)
-        DU = TwoDimToOneDim(slice_key, Q_min, Q_max, Q_bins, QValues_All, Shadow_Mask, local_mask, PolCorrDU, PolCorrDU_Unc, Sample, Config, PlotYesNo, AverageQRanges)
-        DD = TwoDimToOneDim(slice_key, Q_min, Q_max, Q_bins, QValues_All, Shadow_Mask, local_mask, PolCorrDD, PolCorrDD_Unc, Sample, Config, PlotYesNo, AverageQRanges)
-        UD = TwoDimToOneDim(slice_key, Q_min, Q_max, Q_bins, QValues_All, Shadow_Mask, local_mask, PolCorrUD, PolCorrUD_Unc, Sample, Config, PlotYesNo, AverageQRanges)
-
-        #Annular_Average(save_path, Sample, Config, InPlaneAngleMap, 0.004, 0.01, Q_total, local_mask, PolCorrUU, PolCorrDU, PolCorrDD, PolCorrUD)
+    Cuts = VSANS_SectorSlices(SiMirror, Slices, SectorCutAngles, AverageQRanges, Sample, Config, InPlaneAngleMap, Q_min, Q_max, Q_bins, QValues_All, Shadow_Mask, [PolCorrUU, PolCorrDU, PolCorrDD, PolCorrUD], [PolCorrUU_Unc, PolCorrDU_Unc, PolCorrDD_Unc, PolCorrUD_Unc])
+    for slice_key in Cuts:
+        UU, DU, DD, UD = Cuts[slice_key]
 
         #SaveTextDataFourCrossSections(save_path, '{corr}'.format(corr = Corr), slice_key, Sample, Config, UU, DU, DD, UD)
         '''saves data as SliceFullPol_{samp},{cf}_{corr}{slice_key}.txt'''
@@ -2521,44 +3511,20 @@ def vSANS_FullPolSlices(Q_total, SiMirror, Slices, SectorCutAngles, AverageQRang
 
         ReturnSlices[slice_key] = {'PolType' : Corr, 'UU' : UU, 'DU' : DU, 'DD' : DD, 'UD' : UD}
 
+    for Q_Low, Q_High in AnnularQRanges:
+        Annular_Average(save_path, Sample, Config, InPlaneAngleMap, Q_Low, Q_High, Q_total, Shadow_Mask, PolCorrUU, PolCorrDU, PolCorrDD, PolCorrUD, [PolCorrUU_Unc, PolCorrDU_Unc, PolCorrDD_Unc, PolCorrUD_Unc], AnnularCombination, AnnularAngleStep)
+
     return ReturnSlices
 
 def vSANS_HalfPolSlices(SiMirror, Slices, SectorCutAngles, AverageQRanges, PolType, Sample, Config, InPlaneAngleMap, Q_min, Q_max, Q_bins, QValues_All, Shadow_Mask, U, U_Unc, D, D_Unc):
 
-    relevant_detectors = nonhighres_detectors
     if str(Config).find('CvB') != -1:
-        relevant_detectors = all_detectors
         AverageQRanges = 0
 
-    PlotYesNo = 0
-    BothSides = 1
-    HorzMask = SectorMask_AllDetectors(SiMirror, Config, InPlaneAngleMap, 0, SectorCutAngles, BothSides)
-    VertMask = SectorMask_AllDetectors(SiMirror, Config, InPlaneAngleMap, 90, SectorCutAngles, BothSides)
-    CircMask = SectorMask_AllDetectors(SiMirror, Config, InPlaneAngleMap, 0, 180, BothSides)
-    DiagMaskA = SectorMask_AllDetectors(SiMirror, Config, InPlaneAngleMap, 45, SectorCutAngles, BothSides)
-    DiagMaskB = SectorMask_AllDetectors(SiMirror, Config, InPlaneAngleMap, -45, SectorCutAngles, BothSides)
-    DiagMask = {}
-    for dshort in relevant_detectors:
-        DiagMask[dshort] = DiagMaskA[dshort] + DiagMaskB[dshort]
-
     ReturnSlices = {}
-    
-    for slices in Slices:
-        if slices == "Circ":
-            slice_key = "CircAve"
-            local_mask = CircMask
-        elif slices == "Vert":
-            slice_key = "Vert"+str(SectorCutAngles)
-            local_mask = VertMask
-        elif slices == "Horz":
-            slice_key = "Horz"+str(SectorCutAngles)
-            local_mask = HorzMask
-        elif slices == "Diag":
-            slice_key = "Diag"+str(SectorCutAngles)
-            local_mask = DiagMask
-
-        UCut = TwoDimToOneDim(slice_key, Q_min, Q_max, Q_bins, QValues_All, Shadow_Mask, local_mask, U, U_Unc, Sample, Config, PlotYesNo, AverageQRanges)
-        DCut = TwoDimToOneDim(slice_key, Q_min, Q_max, Q_bins, QValues_All, Shadow_Mask, local_mask, D, D_Unc, Sample, Config, PlotYesNo, AverageQRanges)
+    Cuts = VSANS_SectorSlices(SiMirror, Slices, SectorCutAngles, AverageQRanges, Sample, Config, InPlaneAngleMap, Q_min, Q_max, Q_bins, QValues_All, Shadow_Mask, [U, D], [U_Unc, D_Unc])
+    for slice_key in Cuts:
+        UCut, DCut = Cuts[slice_key]
 
         ReturnSlices[slice_key] = {'PolType' : PolType, 'U' : UCut, 'D' : DCut}
 
@@ -2566,39 +3532,13 @@ def vSANS_HalfPolSlices(SiMirror, Slices, SectorCutAngles, AverageQRanges, PolTy
 
 def vSANS_UnpolSlices(SiMirror, Slices, SectorCutAngles, AverageQRanges, PolType, Sample, Config, InPlaneAngleMap, Q_min, Q_max, Q_bins, QValues_All, Shadow_Mask, Unpol, Unpol_Unc):
 
-    relevant_detectors = nonhighres_detectors
     if str(Config).find('CvB') != -1:
-        relevant_detectors = all_detectors
         AverageQRanges = 0
 
-    PlotYesNo = 0
-    BothSides = 1
-    HorzMask = SectorMask_AllDetectors(SiMirror, Config, InPlaneAngleMap, 0, SectorCutAngles, BothSides)
-    VertMask = SectorMask_AllDetectors(SiMirror, Config, InPlaneAngleMap, 90, SectorCutAngles, BothSides)
-    CircMask = SectorMask_AllDetectors(SiMirror, Config, InPlaneAngleMap, 0, 180, BothSides)
-    DiagMaskA = SectorMask_AllDetectors(SiMirror, Config, InPlaneAngleMap, 45, SectorCutAngles, BothSides)
-    DiagMaskB = SectorMask_AllDetectors(SiMirror, Config, InPlaneAngleMap, -45, SectorCutAngles, BothSides)
-    DiagMask = {}
-    for dshort in relevant_detectors:
-        DiagMask[dshort] = DiagMaskA[dshort] + DiagMaskB[dshort]
-
     ReturnSlices = {}
-    
-    for slices in Slices:
-        if slices == "Circ":
-            slice_key = "CircAve"
-            local_mask = CircMask
-        elif slices == "Vert":
-            slice_key = "Vert"+str(SectorCutAngles)
-            local_mask = VertMask
-        elif slices == "Horz":
-            slice_key = "Horz"+str(SectorCutAngles)
-            local_mask = HorzMask
-        elif slices == "Diag":
-            slice_key = "Diag"+str(SectorCutAngles)
-            local_mask = DiagMask
-
-        UnpolCut = TwoDimToOneDim(slice_key, Q_min, Q_max, Q_bins, QValues_All, Shadow_Mask, local_mask, Unpol, Unpol_Unc, Sample, Config, PlotYesNo, AverageQRanges)
+    Cuts = VSANS_SectorSlices(SiMirror, Slices, SectorCutAngles, AverageQRanges, Sample, Config, InPlaneAngleMap, Q_min, Q_max, Q_bins, QValues_All, Shadow_Mask, [Unpol], [Unpol_Unc])
+    for slice_key in Cuts:
+        UnpolCut = Cuts[slice_key][0]
         
         ReturnSlices[slice_key] = {'PolType' : PolType, 'Unpol' : UnpolCut}
 
@@ -3847,61 +4787,90 @@ def vSANS_Record_DataProcessing(YesNoManualHe3Entry, save_path, Contents, Plex_N
 
     return
 
-def Annular_Average(save_path, Sample, Config, InPlaneAngleMap, Q_min, Q_max, Q_total, GeneralMask, ScaledUUData, ScaledDUData, ScaledDDData, ScaledUDData):
+#Angular profiles. For each (Q_min, Q_max) in AnnularQRanges the full-pol cross-sections of every sample are averaged over
+#that Q annulus in AnnularAngleStep degree bins (centred on 0, AnnularAngleStep, ...) and saved as AnnularAverage*.txt and
+#.png. AnnularCombination gives the cross-sections added up (with their factors) into the profile, e.g. {'DD' : 1.0,
+#'UU' : -1.0} for the non spin-flip difference. All may be set in the user input; [] (default) makes no profiles.
+AnnularQRanges = []
+AnnularAngleStep = 5.0
+AnnularCombination = {'DU' : 1.0, 'UD' : 1.0}
+
+def VSANS_AnnularProfile(InPlaneAngleMap, Q_total, Q_min, Q_max, GeneralMask, Channels, Unc_Channels, relevant_detectors, AngleStep):
+    #Mean of each channel (weighted by GeneralMask) in the angle bins over Q_min <= Q <= Q_max, binned in one np.bincount
+
+    Layout = VSANS_DetectorLayout(relevant_detectors, {dshort : np.shape(Q_total[dshort]) for dshort in relevant_detectors})
+    Q = Layout.Flatten(Q_total)
+    Weights = Layout.Flatten(GeneralMask)*np.logical_and(Q >= Q_min, Q <= Q_max)
+    Pixels = np.flatnonzero(Weights)
+    Weights = Weights[Pixels]
+    Angle_bins = max(int(round(360.0/AngleStep)), 1)
+    Angle_step = 360.0/Angle_bins
+    Bins = np.floor(np.mod(Layout.Flatten(InPlaneAngleMap)[Pixels].astype(np.float64) + Angle_step/2.0, 360.0)/Angle_step).astype(np.int64) % Angle_bins
+
+    Number_Channels = len(Channels)
+    Channel_Bins = (Bins + Angle_bins*np.arange(Number_Channels)[:, np.newaxis]).ravel()
+    Data = Layout.Flatten({dshort : np.array([Channel[dshort] for Channel in Channels]) for dshort in relevant_detectors})[:, Pixels]
+    Profile = {'Angle' : np.arange(Angle_bins)*Angle_step}
+    Profile['Pixels'] = np.bincount(Bins, weights=Weights, minlength=Angle_bins)
+    Profile['I'] = np.bincount(Channel_Bins, weights=(Data*Weights).ravel(), minlength=Number_Channels*Angle_bins).reshape((Number_Channels, Angle_bins))
+    nonzero_mask = Profile['Pixels'] > 0
+    Profile['I'][:, nonzero_mask] /= Profile['Pixels'][nonzero_mask]
+    if Unc_Channels is not None:
+        Data_Unc = Layout.Flatten({dshort : np.array([Channel[dshort] for Channel in Unc_Channels]) for dshort in relevant_detectors})[:, Pixels]
+        Profile['I_Unc'] = np.sqrt(np.bincount(Channel_Bins, weights=np.power(Data_Unc*Weights, 2).ravel(), minlength=Number_Channels*Angle_bins).reshape((Number_Channels, Angle_bins)))
+        Profile['I_Unc'][:, nonzero_mask] /= Profile['Pixels'][nonzero_mask]
+    return Profile
+
+def Annular_Average(save_path, Sample, Config, InPlaneAngleMap, Q_min, Q_max, Q_total, GeneralMask, ScaledUUData, ScaledDUData, ScaledDDData, ScaledUDData, Uncertainties=None, Combination=None, AngleStep=5.0):
+    #Uncertainties = [UU, DU, DD, UD uncertainty maps] adds the uncertainty of the profile; Combination defaults to DU + UD
 
     relevant_detectors = nonhighres_detectors
-    AverageQRanges = 1
     if str(Config).find('CvB') != -1:
         relevant_detectors = all_detectors
-        AverageQRanges = 0
+    if Combination is None:
+        Combination = {'DU' : 1.0, 'UD' : 1.0}
 
-    Q_Mask = {}
+    CrossSections = {'UU' : ScaledUUData, 'DU' : ScaledDUData, 'DD' : ScaledDDData, 'UD' : ScaledUDData}
+    Combined = {}
+    Combined_Unc = {}
     for dshort in relevant_detectors:
-        QBorder = np.ones_like(Q_total[dshort])
-        QBorder[Q_total[dshort] < Q_min] = 0.0
-        QBorder[Q_total[dshort] > Q_max] = 0.0
-        Q_Mask[dshort] = QBorder
-
-    
-    Counts = -101
-    Deg = -101
-    BothSides = 0
-    PlotYesNo = 0
-    for x in range(0, 72):
-        degree = x*5
-        Sector_Mask = SectorMask_AllDetectors('Unknown', Config, InPlaneAngleMap, degree, 2.5, BothSides)
-
-        summed_pixels = 0
-        summed_intensity = 0
-        for dshort in relevant_detectors:
-            pixel_counts = Sector_Mask[dshort]*Q_Mask[dshort]*GeneralMask[dshort]
-            intensity_counts = pixel_counts*(ScaledDUData[dshort] + ScaledUDData[dshort])
-            summed_pixels = summed_pixels + np.sum(pixel_counts)
-            summed_intensity = summed_intensity + np.sum(intensity_counts)
-        ratio = summed_intensity/summed_pixels
-        if Counts == -101 and summed_pixels > 0:
-            Counts = [ratio]
-            Deg = [degree]
-        elif summed_pixels > 0:
-            Counts.append(ratio)
-            Deg.append(degree)
-
-    xdata = np.array(Deg)
-    ydata = np.array(Counts)
+        Combined[dshort] = sum([Factor*CrossSections[Name][dshort] for Name, Factor in Combination.items()])
+        if Uncertainties is not None:
+            Unc = dict(zip(['UU', 'DU', 'DD', 'UD'], Uncertainties))
+            Combined_Unc[dshort] = np.sqrt(sum([np.power(Factor*Unc[Name][dshort], 2) for Name, Factor in Combination.items()]))
+    Profile = VSANS_AnnularProfile(InPlaneAngleMap, Q_total, Q_min, Q_max, GeneralMask, [Combined], [Combined_Unc] if Uncertainties is not None else None, relevant_detectors, AngleStep)
+
+    Label = ''
+    for Name, Factor in Combination.items():
+        Sign = 'minus' if Factor < 0 else ('plus' if Label != '' else '')
+        Label += Sign + ('' if abs(Factor) == 1 else '{f:g}'.format(f=abs(Factor))) + Name
+    nonzero_mask = Profile['Pixels'] > 0
+    xdata = Profile['Angle'][nonzero_mask]
+    ydata = Profile['I'][0][nonzero_mask]
     fig = plt.figure()
-    plt.plot(xdata, ydata, 'b*-', label='DU - UD Annular_Average')
+    if Uncertainties is not None:
+        plt.errorbar(xdata, ydata, yerr=Profile['I_Unc'][0][nonzero_mask], fmt='b*-', label='{cs} Annular_Average'.format(cs=Label))
+    else:
+        plt.plot(xdata, ydata, 'b*-', label='{cs} Annular_Average'.format(cs=Label))
     plt.xscale('linear')
     plt.yscale('linear')
     plt.xlabel('Angle (degrees)')
     plt.ylabel('Summed Counts')
     plt.title('Annular Average_{qmin}to{qmax}invang'.format(qmin = Q_min, qmax = Q_max))
     plt.legend()
-    fig.savefig(save_path + 'AnnularAverageDDminusUU_{idnum},{cf}.png'.format(idnum=Sample, cf = Config))
+    fig.savefig(save_path + 'AnnularAverage{cs}_{qmin}to{qmax}_{idnum},{cf}.png'.format(cs=Label, qmin=Q_min, qmax=Q_max, idnum=Sample, cf = Config))
     #plt.show()
     plt.close()
-    
-    
-    return
+
+    if Uncertainties is not None:
+        text_output = np.array([xdata, ydata, Profile['I_Unc'][0][nonzero_mask], Profile['Pixels'][nonzero_mask]])
+        header = 'Angle, I, DelI, Pixels'
+    else:
+        text_output = np.array([xdata, ydata, Profile['Pixels'][nonzero_mask]])
+        header = 'Angle, I, Pixels'
+    np.savetxt(save_path + 'AnnularAverage{cs}_{qmin}to{qmax}_{idnum},{cf}.txt'.format(cs=Label, qmin=Q_min, qmax=Q_max, idnum=Sample, cf = Config), text_output.T, delimiter = ' ', comments = '', header= header, fmt='%1.4e')
+
+    return Profile
 
 def getVarFromFile(filename):
     import imp
@@ -4026,14 +4995,15 @@ def VSANS_MakeSlices_and_SaveASCII(SampleDescriptionKeywordsToExclude, UsePolCor
         for Config in Configs:
             representative_filenumber = Configs[Config]
             if representative_filenumber != 0:
-                Solid_Angle = SolidAngle_AllDetectors(input_path, representative_filenumber, Config)
+                HighResSubset = HighRes_ReadSpec(HighResMinX, HighResMaxX, HighResMinY, HighResMaxY, ConvertHighResToSubset)
+                Solid_Angle = SolidAngle_AllDetectors(input_path, representative_filenumber, Config, HighResSubset)
                 BBList = [0]
                 if Config in BlockBeamCatalog:
                     if 'NA' not in BlockBeamCatalog[Config]['Trans']['File']:
                         BBList = BlockBeamCatalog[Config]['Trans']['File']
                     elif 'NA' not in BlockBeamCatalog[Config]['Scatt']['File']:
                         BBList = BlockBeamCatalog[Config]['Scatt']['File']
-                BB_per_second, BBUnc_per_second = VSANS_BlockedBeamCountsPerSecond_ListOfFiles(input_path, BBList, Config, representative_filenumber)
+                BB_per_second, BBUnc_per_second = VSANS_BlockedBeamCountsPerSecond_ListOfFiles(input_path, BBList, Config, representative_filenumber, HighResSubset)
                 Qx, Qy, Qz, Q_total, Q_perp_unc, Q_parl_unc, InPlaneAngleMap, dimXX, dimYY, Shadow_Mask = QCalculation_AllDetectors(SampleDescriptionKeywordsToExclude, input_path, Calc_Q_From_Trans, HighResMinX, HighResMaxX, HighResMinY, HighResMaxY, ConvertHighResToSubset, HighResGain, representative_filenumber, Config, MidddlePixelBorderHorizontal, MidddlePixelBorderVertical, SectorCutAngles, Slices, AlignDet_Trans)
                 QValues_All = {'QX':Qx,'QY':Qy,'QZ':Qz,'Q_total':Q_total,'Q_perp_unc':Q_perp_unc,'Q_parl_unc':Q_parl_unc}
                 Q_min, Q_max, Q_bins = MinMaxQ(Absolute_Q_min, Absolute_Q_max, Q_total, Config, HighResMinX, HighResMaxX, HighResMinY, HighResMaxY, ConvertHighResToSubset, HighResGain)
@@ -4048,14 +5018,12 @@ def VSANS_MakeSlices_and_SaveASCII(SampleDescriptionKeywordsToExclude, UsePolCor
                 UnpolSampleSlices = {}
                 for Sample in Sample_Names:
                     if Sample in ScattCatalog:
-                        VSANS_GetBeamCenterForScattFile(input_path, Sample, Config, AlignDet_Trans)
-                                                    
                         if str(ScattCatalog[Sample]['Intent']).find('Sample') != -1 or str(ScattCatalog[Sample]['Intent']).find('Empty') != -1:
 
-                            UUScaledData, UUScaledData_Unc = AbsScale(YesNoManualHe3Entry, input_path, HighResMinX, HighResMaxX, HighResMinY, HighResMaxY, ConvertHighResToSubset, HighResGain, 'UU', Sample, Config, BB_per_second, Solid_Angle, Plex, ScattCatalog, TransCatalog)
-                            DUScaledData, DUScaledData_Unc = AbsScale(YesNoManualHe3Entry, input_path, HighResMinX, HighResMaxX, HighResMinY, HighResMaxY, ConvertHighResToSubset, HighResGain, 'DU', Sample, Config, BB_per_second, Solid_Angle, Plex, ScattCatalog, TransCatalog)
-                            DDScaledData, DDScaledData_Unc = AbsScale(YesNoManualHe3Entry, input_path, HighResMinX, HighResMaxX, HighResMinY, HighResMaxY, ConvertHighResToSubset, HighResGain, 'DD', Sample, Config, BB_per_second, Solid_Angle, Plex, ScattCatalog, TransCatalog)
-                            UDScaledData, UDScaledData_Unc = AbsScale(YesNoManualHe3Entry, input_path, HighResMinX, HighResMaxX, HighResMinY, HighResMaxY, ConvertHighResToSubset, HighResGain, 'UD', Sample, Config, BB_per_second, Solid_Angle, Plex, ScattCatalog, TransCatalog)
+                            UUScaledData, UUScaledData_Unc = AbsScale(YesNoManualHe3Entry, input_path, HighResMinX, HighResMaxX, HighResMinY, HighResMaxY, ConvertHighResToSubset, HighResGain, 'UU', Sample, Config, BB_per_second, Solid_Angle, Plex, ScattCatalog, TransCatalog, HighResSubset)
+                            DUScaledData, DUScaledData_Unc = AbsScale(YesNoManualHe3Entry, input_path, HighResMinX, HighResMaxX, HighResMinY, HighResMaxY, ConvertHighResToSubset, HighResGain, 'DU', Sample, Config, BB_per_second, Solid_Angle, Plex, ScattCatalog, TransCatalog, HighResSubset)
+                            DDScaledData, DDScaledData_Unc = AbsScale(YesNoManualHe3Entry, input_path, HighResMinX, HighResMaxX, HighResMinY, HighResMaxY, ConvertHighResToSubset, HighResGain, 'DD', Sample, Config, BB_per_second, Solid_Angle, Plex, ScattCatalog, TransCatalog, HighResSubset)
+                            UDScaledData, UDScaledData_Unc = AbsScale(YesNoManualHe3Entry, input_path, HighResMinX, HighResMaxX, HighResMinY, HighResMaxY, ConvertHighResToSubset, HighResGain, 'UD', Sample, Config, BB_per_second, Solid_Angle, Plex, ScattCatalog, TransCatalog, HighResSubset)
                             FullPolGo = 0
                             if 'NA' not in UUScaledData and 'NA' not in DUScaledData and 'NA' not in DDScaledData and 'NA' not in UDScaledData:
 
@@ -4099,8 +5067,8 @@ def VSANS_MakeSlices_and_SaveASCII(SampleDescriptionKeywordsToExclude, UsePolCor
                                 #Kludge
                                 YesNo_2DCombinedFiles  = 0
                             
-                            UScaledData, UScaledData_Unc = AbsScale(YesNoManualHe3Entry, input_path, HighResMinX, HighResMaxX, HighResMinY, HighResMaxY, ConvertHighResToSubset, HighResGain, 'U', Sample, Config, BB_per_second, Solid_Angle, Plex, ScattCatalog, TransCatalog)
-                            DScaledData, DScaledData_Unc = AbsScale(YesNoManualHe3Entry, input_path, HighResMinX, HighResMaxX, HighResMinY, HighResMaxY, ConvertHighResToSubset, HighResGain, 'D', Sample, Config, BB_per_second, Solid_Angle, Plex, ScattCatalog, TransCatalog)
+                            UScaledData, UScaledData_Unc = AbsScale(YesNoManualHe3Entry, input_path, HighResMinX, HighResMaxX, HighResMinY, HighResMaxY, ConvertHighResToSubset, HighResGain, 'U', Sample, Config, BB_per_second, Solid_Angle, Plex, ScattCatalog, TransCatalog, HighResSubset)
+                            DScaledData, DScaledData_Unc = AbsScale(YesNoManualHe3Entry, input_path, HighResMinX, HighResMaxX, HighResMinY, HighResMaxY, ConvertHighResToSubset, HighResGain, 'D', Sample, Config, BB_per_second, Solid_Angle, Plex, ScattCatalog, TransCatalog, HighResSubset)
                             if 'NA' not in UScaledData and 'NA' not in DScaledData:
                                 if YesNo_2DCombinedFiles > 0:
                                     representative_filenumber = Scatt[Sample]['Config(s)'][Config]['U'][0]
@@ -4117,7 +5085,7 @@ def VSANS_MakeSlices_and_SaveASCII(SampleDescriptionKeywordsToExclude, UsePolCor
                                     SiMirror = ScattCatalog[Sample]['Config(s)'][Config]['SiMirror']
                                     HalfPolSampleSlices['Empty'] = vSANS_HalfPolSlices(SiMirror, Slices, SectorCutAngles, AverageQRanges, 'HalfPol', Sample, Config, InPlaneAngleMap, Q_min, Q_max, Q_bins, QValues_All, Shadow_Mask, UScaledData, UScaledData_Unc, DScaledData, DScaledData_Unc)
 
-                            UnpolScaledData, UnpolScaledData_Unc = AbsScale(YesNoManualHe3Entry, input_path, HighResMinX, HighResMaxX, HighResMinY, HighResMaxY, ConvertHighResToSubset, HighResGain, 'Unpol', Sample, Config, BB_per_second, Solid_Angle, Plex, ScattCatalog, TransCatalog)
+                            UnpolScaledData, UnpolScaledData_Unc = AbsScale(YesNoManualHe3Entry, input_path, HighResMinX, HighResMaxX, HighResMinY, HighResMaxY, ConvertHighResToSubset, HighResGain, 'Unpol', Sample, Config, BB_per_second, Solid_Angle, Plex, ScattCatalog, TransCatalog, HighResSubset)
                             if 'NA' not in UnpolScaledData:
                                 if YesNo_2DCombinedFiles > 0:
                                     representative_filenumber = ScattCatalog[Sample]['Config(s)'][Config]['Unpol'][0]
@@ -4150,23 +5118,30 @@ def vSANS_SaveSlices_And_Results(Slices, SectorCutAngles, save_path, YesNoShowPl
                 FullPolResults = {}
                 HalfPolResults = {}
                 UnpolResults = {}
-                for Sample in Sample_Names:
-                    if Sample in ScattCatalog:                
-                        if str(ScattCatalog[Sample]['Intent']).find('Sample') != -1:
-                            print('     ', Sample)
-                            if Sample in AllFullPolSlices[Config]:
-                                FullPolResults[Sample] = vSANS_ProcessFullPolSlices(Slices, SectorCutAngles, save_path, YesNoShowPlots, YesNoSetPlotXRange, YesNoSetPlotYRange, PlotXmin, PlotXmax, PlotYmin, PlotYmax, AutoSubtractEmpty, UseMTCirc, Config, AllFullPolSlices[Config], Sample)
-                            if Sample in AllHalfPolSlices[Config]:
-                                HalfPolResults[Sample] = vSANS_ProcessHalfPolSlices(Slices, SectorCutAngles, save_path, YesNoShowPlots, YesNoSetPlotXRange, YesNoSetPlotYRange, PlotXmin, PlotXmax, PlotYmin, PlotYmax, AutoSubtractEmpty, UseMTCirc, Config, AllHalfPolSlices[Config], Sample)
-                            if Sample in AllUnpolSlices[Config]:
-                                UnpolResults[Sample] = vSANS_ProcessUnpolSlices(Slices, SectorCutAngles, save_path, YesNoShowPlots, YesNoSetPlotXRange, YesNoSetPlotYRange, PlotXmin, PlotXmax, PlotYmin, PlotYmax, AutoSubtractEmpty, UseMTCirc, Config, AllUnpolSlices[Config], Sample)
-                if AutoSubtractEmpty == 0:
-                    if 'Empty' in AllFullPolSlices[Config]:
-                        FullPolResults['Empty'] = vSANS_ProcessFullPolSlices(Slices, SectorCutAngles, save_path, YesNoShowPlots, YesNoSetPlotXRange, YesNoSetPlotYRange, PlotXmin, PlotXmax, PlotYmin, PlotYmax, AutoSubtractEmpty, UseMTCirc, Config, AllFullPolSlices[Config], 'Empty')
-                    if 'Empty' in AllHalfPolSlices[Config]:
-                        HalfPolResults['Empty'] = vSANS_ProcessHalfPolSlices(Slices, SectorCutAngles, save_path, YesNoShowPlots, YesNoSetPlotXRange, YesNoSetPlotYRange, PlotXmin, PlotXmax, PlotYmin, PlotYmax, AutoSubtractEmpty, UseMTCirc, Config, AllHalfPolSlices[Config], 'Empty')
-                    if 'Empty' in AllUnpolSlices[Config]:
-                        UnpolResults['Empty'] = vSANS_ProcessUnpolSlices(Slices, SectorCutAngles, save_path, YesNoShowPlots, YesNoSetPlotXRange, YesNoSetPlotYRange, PlotXmin, PlotXmax, PlotYmin, PlotYmax, AutoSubtractEmpty, UseMTCirc, Config, AllUnpolSlices[Config], 'Empty')
+                Widths = VSANS_SectorCutWidths(SectorCutAngles)
+                for Index, Width in enumerate(Widths):
+                    #one pass per sector half-width (the results kept are those of the last); the circular average does
+                    #not depend on the width and full-pol only saves it, so it is saved once
+                    if len(Widths) > 1:
+                        print('   Sector half-width', Width)
+                    FullPolSlices = Slices if Index == 0 else [slices for slices in Slices if slices != "Circ"]
+                    for Sample in Sample_Names:
+                        if Sample in ScattCatalog:                
+                            if str(ScattCatalog[Sample]['Intent']).find('Sample') != -1:
+                                print('     ', Sample)
+                                if Sample in AllFullPolSlices[Config]:
+                                    FullPolResults[Sample] = vSANS_ProcessFullPolSlices(FullPolSlices, Width, save_path, YesNoShowPlots, YesNoSetPlotXRange, YesNoSetPlotYRange, PlotXmin, PlotXmax, PlotYmin, PlotYmax, AutoSubtractEmpty, UseMTCirc, Config, AllFullPolSlices[Config], Sample)
+                                if Sample in AllHalfPolSlices[Config]:
+                                    HalfPolResults[Sample] = vSANS_ProcessHalfPolSlices(Slices, Width, save_path, YesNoShowPlots, YesNoSetPlotXRange, YesNoSetPlotYRange, PlotXmin, PlotXmax, PlotYmin, PlotYmax, AutoSubtractEmpty, UseMTCirc, Config, AllHalfPolSlices[Config], Sample)
+                                if Sample in AllUnpolSlices[Config]:
+                                    UnpolResults[Sample] = vSANS_ProcessUnpolSlices(Slices, Width, save_path, YesNoShowPlots, YesNoSetPlotXRange, YesNoSetPlotYRange, PlotXmin, PlotXmax, PlotYmin, PlotYmax, AutoSubtractEmpty, UseMTCirc, Config, AllUnpolSlices[Config], Sample)
+                    if AutoSubtractEmpty == 0:
+                        if 'Empty' in AllFullPolSlices[Config]:
+                            FullPolResults['Empty'] = vSANS_ProcessFullPolSlices(FullPolSlices, Width, save_path, YesNoShowPlots, YesNoSetPlotXRange, YesNoSetPlotYRange, PlotXmin, PlotXmax, PlotYmin, PlotYmax, AutoSubtractEmpty, UseMTCirc, Config, AllFullPolSlices[Config], 'Empty')
+                        if 'Empty' in AllHalfPolSlices[Config]:
+                            HalfPolResults['Empty'] = vSANS_ProcessHalfPolSlices(Slices, Width, save_path, YesNoShowPlots, YesNoSetPlotXRange, YesNoSetPlotYRange, PlotXmin, PlotXmax, PlotYmin, PlotYmax, AutoSubtractEmpty, UseMTCirc, Config, AllHalfPolSlices[Config], 'Empty')
+                        if 'Empty' in AllUnpolSlices[Config]:
+                            UnpolResults['Empty'] = vSANS_ProcessUnpolSlices(Slices, Width, save_path, YesNoShowPlots, YesNoSetPlotXRange, YesNoSetPlotYRange, PlotXmin, PlotXmax, PlotYmin, PlotYmax, AutoSubtractEmpty, UseMTCirc, Config, AllUnpolSlices[Config], 'Empty')
 
                 AllFullPolResults[Config] = FullPolResults
                 AllHalfPolResults[Config] = HalfPolResults
@@ -4310,6 +5285,175 @@ def VSANS_SaveComparativePlots(Slices, SectorCutAngles, save_path, FullPol_BaseT
                     
     return
 
+#Watch mode: with WatchForNewFiles = 1 in the user input, main() keeps running after the first reduction and checks
+#input_path every WatchPollSeconds seconds. Once new or changed sansNNNNN.nxs.ngv files have stopped changing (same size
+#and modification time on two checks in a row), the catalogs are rebuilt (only the new headers are read, see the run index)
+#and only the (Sample, Config) groups whose files, transmissions, empties, blocked beams or He3 cells changed are re-reduced.
+WatchForNewFiles = 0
+WatchPollSeconds = 10
+
+def VSANS_FolderState(input_path):
+    #Size and modification time of every run file in input_path
+
+    State = {}
+    for filename in os.listdir(input_path):
+        if filename.endswith(".nxs.ngv"):
+            try:
+                Stat = os.stat(os.path.join(input_path, filename))
+            except OSError:
+                continue
+            State[filename] = (Stat.st_size, Stat.st_mtime_ns)
+    return State
+
+def VSANS_CatalogFilenumbers(Entry):
+    #Returns every file number held (at any depth) in a catalog entry
+
+    if isinstance(Entry, dict):
+        Entry = list(Entry.values())
+    if isinstance(Entry, (list, tuple)):
+        Filenumbers = set()
+        for Item in Entry:
+            Filenumbers |= VSANS_CatalogFilenumbers(Item)
+        return Filenumbers
+    if isinstance(Entry, (int, np.integer)) and not isinstance(Entry, bool):
+        return set([int(Entry)])
+    return set()
+
+def VSANS_GroupSignatures(Configs, Sample_Names, Scatt, Trans, Pol_Trans, BlockBeam, AlignDet_Trans, HE3_Trans, State):
+    #Returns {(Sample, Config) : text}, where text changes whenever anything the reduction of that group depends on changes:
+    #its own scattering and transmission files, the empties and blocked beams of its configuration, and the He3 cells,
+    #including the size and modification time (State = VSANS_FolderState(input_path)) of every file they name
+
+    def File_Text(Entries):
+        Filenames = ["sans" + str(filenumber) + ".nxs.ngv" for filenumber in sorted(VSANS_CatalogFilenumbers(Entries))]
+        return repr([(filename, State[filename]) for filename in Filenames if filename in State])
+
+    Shared = repr(HE3_Trans) + repr(Pol_Trans) + File_Text([HE3_Trans, Pol_Trans])
+    Signatures = {}
+    for Config in Configs:
+        Config_Entries = [Configs[Config], BlockBeam.get(Config)]
+        for Sample in Sample_Names:
+            if Sample in Scatt and str(Scatt[Sample]['Intent']).find('Empty') != -1 and Config in Scatt[Sample]['Config(s)']:
+                Config_Entries.append(Scatt[Sample]['Config(s)'][Config])
+                if Sample in Trans:
+                    Config_Entries.append(Trans[Sample]['Config(s)'].get(Config))
+        Config_Text = ''.join([repr(Entry) for Entry in Config_Entries]) + File_Text(Config_Entries)
+        for Sample in Sample_Names:
+            if Sample in Scatt and Config in Scatt[Sample]['Config(s)']:
+                Entries = [Scatt[Sample]['Config(s)'][Config]]
+                if Sample in Trans:
+                    Entries.append(Trans[Sample]['Config(s)'].get(Config))
+                if Sample in AlignDet_Trans:
+                    Entries.append(AlignDet_Trans[Sample]['Config(s)'].get(Config))
+                Text = repr(Scatt[Sample]['Intent']) + ''.join([repr(Entry) for Entry in Entries]) + File_Text(Entries)
+                Signatures[(Sample, Config)] = Text + Config_Text + Shared
+    return Signatures
+
+def VSANS_ForgetFiles(input_path, filenames):
+    #Drops everything read from the given run files (cached panels and beam centers, open handles, the experiment pack's
+    #check of the file), so files rewritten in place are read again; the prefetch processes are restarted on next use
+
+    filenumbers = set([int(filename[4:9]) for filename in filenames])
+    for key in [key for key in panel_cache if key[0] == input_path and key[1] in filenumbers]:
+        panel_cache_stats['bytes'] -= panel_cache.pop(key).nbytes
+    for key in [key for key in beam_center_table if key[0] == input_path and key[1] in filenumbers]:
+        del beam_center_table[key]
+    for filename in filenames:
+        fullpath = os.path.join(input_path, filename)
+        if fullpath in file_objects:
+            file_objects.pop(fullpath).close()
+        if experiment_packs.get(input_path) is not None:
+            experiment_packs[input_path]['Current'].pop(filename, None)
+    while len(prefetch_readers) > 0:
+        old_name, old_reader = prefetch_readers.popitem()
+        old_reader.shutdown()
+    return
+
+def VSANS_ChangedGroups(Configs, Scatt, Old_Signatures, New_Signatures):
+    #Returns the configurations and a copy of the scattering catalog reduced to the (Sample, Config) groups whose
+    #signature changed, plus the empties of those configurations (needed for the empty subtraction)
+
+    Changed = [Group for Group in New_Signatures if Old_Signatures.get(Group) != New_Signatures[Group]]
+    Changed_Configs = {}
+    for Config in Configs:
+        if any([Group[1] == Config for Group in Changed]):
+            Changed_Configs[Config] = Configs[Config]
+    Changed_Scatt = {}
+    for Sample in Scatt:
+        Sample_Configs = {}
+        for Config in Scatt[Sample]['Config(s)']:
+            if (Sample, Config) in Changed or (Config in Changed_Configs and str(Scatt[Sample]['Intent']).find('Empty') != -1):
+                Sample_Configs[Config] = Scatt[Sample]['Config(s)'][Config]
+        if len(Sample_Configs) > 0:
+            Changed_Scatt[Sample] = dict(Scatt[Sample])
+            Changed_Scatt[Sample]['Config(s)'] = Sample_Configs
+    return Changed, Changed_Configs, Changed_Scatt
+
+def VSANS_ReduceFolder(Contents, Old_Signatures=None):
+    #The full reduction of input_path; with Old_Signatures (as returned by an earlier call) the catalogs are rebuilt
+    #but only groups that changed since then are re-reduced. Returns the group signatures of this reduction.
+
+    State = VSANS_FolderState(input_path)
+    Sample_Names, Sample_Bases, Configs, BlockBeamCatalog, ScattCatalog, TransCatalog, Pol_TransCatalog, AlignDet_Trans, HE3_TransCatalog, start_number, filenumberlisting = VSANS_SortDataAutomaticAlt(SampleDescriptionKeywordsToExclude, TransPanel, input_path, YesNoManualHe3Entry, New_HE3_Files, MuValues, TeValues, Excluded_Filenumbers, Min_Filenumber, Max_Filenumber, Min_Scatt_Filenumber, Max_Scatt_Filenumber, Min_Trans_Filenumber, Max_Trans_Filenumber, ReAssignBlockBeam, ReAssignEmpty, ReAssignOpen, ReAssignSample, YesNoRenameEmpties)
+
+    VSANS_ShareAlignDetTransCatalog(TempDiffAllowedForSharingTrans, AlignDet_Trans, ScattCatalog)
+    VSANS_ShareSampleBaseTransCatalog(TransCatalog, ScattCatalog)
+    VSANS_ShareEmptyPolBeamScattCatalog(ScattCatalog)
+
+    VSANS_ProcessHe3TransCatalog(input_path, HE3_TransCatalog, BlockBeamCatalog, TransPanel)
+    VSANS_ProcessPolTransCatalog(input_path, Pol_TransCatalog, BlockBeamCatalog, TransPanel)
+    VSANS_ProcessTransCatalog(input_path, TransCatalog, BlockBeamCatalog, TransPanel)
+
+    Plex_Name, Plex = Plex_File(input_path, start_number, HighResMinX, HighResMaxX, HighResMinY, HighResMaxY, ConvertHighResToSubset, HighResGain)
+    HE3_Cell_Summary = HE3_DecayCurves(save_path, HE3_TransCatalog)
+    vSANS_PolarizationSupermirrorAndFlipper(Pol_TransCatalog, HE3_Cell_Summary, UsePolCorr)
+    Truest_PSM = vSANS_BestSuperMirrorPolarizationValue(UsePolCorr, PSM_Guess, YesNoBypassBestGuessPSM, Pol_TransCatalog)
+
+    vSANS_Record_DataProcessing(YesNoManualHe3Entry, save_path, Contents, Plex_Name, ScattCatalog, BlockBeamCatalog, TransCatalog, Pol_TransCatalog, HE3_Cell_Summary)
+    He3_Evaluation(He3Only_Check, HE3_TransCatalog)
+
+    Signatures = VSANS_GroupSignatures(Configs, Sample_Names, ScattCatalog, TransCatalog, Pol_TransCatalog, BlockBeamCatalog, AlignDet_Trans, HE3_TransCatalog, State)
+    if Old_Signatures is not None:
+        Changed, Configs, ScattCatalog = VSANS_ChangedGroups(Configs, ScattCatalog, Old_Signatures, Signatures)
+        print('Re-reducing', len(Changed), 'changed (Sample, Config) group(s):', Changed)
+
+    AllFullPolSlices, AllHalfPolSlices, AllUnpolSlices = VSANS_MakeSlices_and_SaveASCII(SampleDescriptionKeywordsToExclude, UsePolCorr, YesNoManualHe3Entry, input_path, save_path, He3CorrectionType, YesNo_2DFilesPerDetector, YesNo_2DCombinedFiles, Absolute_Q_min, Absolute_Q_max, AverageQRanges, Calc_Q_From_Trans, HighResMinX, HighResMaxX, HighResMinY, HighResMaxY, ConvertHighResToSubset, HighResGain, HE3_Cell_Summary, Plex, Truest_PSM, Minimum_PSM, AlignDet_Trans, HE3_TransCatalog, start_number, He3Only_Check, ScattCatalog, BlockBeamCatalog, Configs, Sample_Names, TransCatalog, Pol_TransCatalog, MidddlePixelBorderHorizontal, MidddlePixelBorderVertical, SectorCutAngles, Slices)
+
+    AllFullPolResults, AllHalfPolResults, AllUnpolResults = vSANS_SaveSlices_And_Results(Slices, SectorCutAngles, save_path, YesNoShowPlots, YesNoSetPlotXRange, YesNoSetPlotYRange, PlotXmin, PlotXmax, PlotYmin, PlotYmax, AutoSubtractEmpty, UseMTCirc, He3Only_Check, Configs, Sample_Names, ScattCatalog, AllFullPolSlices, AllHalfPolSlices, AllUnpolSlices)
+
+    #FullPol_BaseToSampleMap, HalfPol_BaseToSampleMap, Unpol_BaseToSampleMap = VSANS_CatergorizeSamplesAndBases(He3Only_Check, Configs, Sample_Bases, Sample_Names, ScattCatalog, AllFullPolSlices,AllHalfPolSlices, AllUnpolSlices)
+    #VSANS_SaveComparativePlots(Slices, SectorCutAngles, save_path, FullPol_BaseToSampleMap, HalfPol_BaseToSampleMap, Unpol_BaseToSampleMap, AllFullPolSlices, AllHalfPolSlices, AllUnpolSlices, AllFullPolResults, AllHalfPolResults, AllUnpolResults, Configs, He3Only_Check, CompareUnpolCirc, CompareHalfPolSumCirc, CompareFullPolSumCirc, CompareFullPolStruc, CompareFullPolMagnetism)
+
+    return Signatures
+
+def VSANS_WatchFolder(Contents, Signatures):
+    #Uses VSANS_ReduceFolder(Contents, Signatures) each time new or changed run files in input_path have settled
+
+    print('Watching', input_path, 'for new files every', WatchPollSeconds, 'seconds (Ctrl+C to stop)...')
+    Reduced_State = VSANS_FolderState(input_path)
+    Last_State = Reduced_State
+    try:
+        while True:
+            time.sleep(WatchPollSeconds)
+            State = VSANS_FolderState(input_path)
+            if State != Reduced_State and State == Last_State:
+                print(' ')
+                Changed_Files = sorted([filename for filename in State if State[filename] != Reduced_State.get(filename)])
+                print('New or changed files:', Changed_Files)
+                VSANS_ForgetFiles(input_path, [filename for filename in Changed_Files if filename in Reduced_State])
+                try:
+                    Signatures = VSANS_ReduceFolder(Contents, Signatures)
+                    Reduced_State = State
+                except Exception:
+                    #e.g. a run that is still being written or a transmission file that is not there yet; retried next poll
+                    traceback.print_exc()
+                    print('Reduction failed; it will be retried at the next check.')
+                print('Watching', input_path, 'for new files...')
+            Last_State = State
+    except KeyboardInterrupt:
+        print('Stopped watching', input_path)
+    return Signatures
+
 def load_python_config(module_name="UserInput"):
     import importlib
     module = importlib.import_module(module_name)
@@ -4348,34 +5492,20 @@ def main(python_config=None, json_config=None):
     if not os.path.exists(save_path):
         os.makedirs(save_path)
         
-    Sample_Names, Sample_Bases, Configs, BlockBeamCatalog, ScattCatalog, TransCatalog, Pol_TransCatalog, AlignDet_Trans, HE3_TransCatalog, start_number, filenumberlisting = VSANS_SortDataAutomaticAlt(SampleDescriptionKeywordsToExclude, TransPanel, input_path, YesNoManualHe3Entry, New_HE3_Files, MuValues, TeValues, Excluded_Filenumbers, Min_Filenumber, Max_Filenumber, Min_Scatt_Filenumber, Max_Scatt_Filenumber, Min_Trans_Filenumber, Max_Trans_Filenumber, ReAssignBlockBeam, ReAssignEmpty, ReAssignOpen, ReAssignSample, YesNoRenameEmpties)
-
-    VSANS_ShareAlignDetTransCatalog(TempDiffAllowedForSharingTrans, AlignDet_Trans, ScattCatalog)
-    VSANS_ShareSampleBaseTransCatalog(TransCatalog, ScattCatalog)
-    VSANS_ShareEmptyPolBeamScattCatalog(ScattCatalog)
-
-    VSANS_ProcessHe3TransCatalog(input_path, HE3_TransCatalog, BlockBeamCatalog, TransPanel)
-    VSANS_ProcessPolTransCatalog(input_path, Pol_TransCatalog, BlockBeamCatalog, TransPanel)
-    VSANS_ProcessTransCatalog(input_path, TransCatalog, BlockBeamCatalog, TransPanel)
-
-    Plex_Name, Plex = Plex_File(input_path, start_number, HighResMinX, HighResMaxX, HighResMinY, HighResMaxY, ConvertHighResToSubset, HighResGain)
-    HE3_Cell_Summary = HE3_DecayCurves(save_path, HE3_TransCatalog)
-    vSANS_PolarizationSupermirrorAndFlipper(Pol_TransCatalog, HE3_Cell_Summary, UsePolCorr)
-    Truest_PSM = vSANS_BestSuperMirrorPolarizationValue(UsePolCorr, PSM_Guess, YesNoBypassBestGuessPSM, Pol_TransCatalog)
-
-    vSANS_Record_DataProcessing(YesNoManualHe3Entry, save_path, Contents, Plex_Name, ScattCatalog, BlockBeamCatalog, TransCatalog, Pol_TransCatalog, HE3_Cell_Summary)
-    He3_Evaluation(He3Only_Check, HE3_TransCatalog)
-
-    AllFullPolSlices, AllHalfPolSlices, AllUnpolSlices = VSANS_MakeSlices_and_SaveASCII(SampleDescriptionKeywordsToExclude, UsePolCorr, YesNoManualHe3Entry, input_path, save_path, He3CorrectionType, YesNo_2DFilesPerDetector, YesNo_2DCombinedFiles, Absolute_Q_min, Absolute_Q_max, AverageQRanges, Calc_Q_From_Trans, HighResMinX, HighResMaxX, HighResMinY, HighResMaxY, ConvertHighResToSubset, HighResGain, HE3_Cell_Summary, Plex, Truest_PSM, Minimum_PSM, AlignDet_Trans, HE3_TransCatalog, start_number, He3Only_Check, ScattCatalog, BlockBeamCatalog, Configs, Sample_Names, TransCatalog, Pol_TransCatalog, MidddlePixelBorderHorizontal, MidddlePixelBorderVertical, SectorCutAngles, Slices)
-
-    AllFullPolResults, AllHalfPolResults, AllUnpolResults = vSANS_SaveSlices_And_Results(Slices, SectorCutAngles, save_path, YesNoShowPlots, YesNoSetPlotXRange, YesNoSetPlotYRange, PlotXmin, PlotXmax, PlotYmin, PlotYmax, AutoSubtractEmpty, UseMTCirc, He3Only_Check, Configs, Sample_Names, ScattCatalog, AllFullPolSlices, AllHalfPolSlices, AllUnpolSlices)
-
-    #FullPol_BaseToSampleMap, HalfPol_BaseToSampleMap, Unpol_BaseToSampleMap = VSANS_CatergorizeSamplesAndBases(He3Only_Check, Configs, Sample_Bases, Sample_Names, ScattCatalog, AllFullPolSlices,AllHalfPolSlices, AllUnpolSlices)
-    #VSANS_SaveComparativePlots(Slices, SectorCutAngles, save_path, FullPol_BaseToSampleMap, HalfPol_BaseToSampleMap, Unpol_BaseToSampleMap, AllFullPolSlices, AllHalfPolSlices, AllUnpolSlices, AllFullPolResults, AllHalfPolResults, AllUnpolResults, Configs, He3Only_Check, CompareUnpolCirc, CompareHalfPolSumCirc, CompareFullPolSumCirc, CompareFullPolStruc, CompareFullPolMagnetism)
+    try:
+        Signatures = VSANS_ReduceFolder(Contents)
+        if WatchForNewFiles > 0:
+            VSANS_WatchFolder(Contents, Signatures)
+    finally:
+        clear_panel_cache()
+        clear_beam_center_table()
+        close_pooled_files()
 
     #*************************************************
     #***           End of 'The Program'            ***
     #*************************************************
 
 if __name__ == '__main__':
+    import multiprocessing
+    multiprocessing.freeze_support()
     main(python_config="UserInput")
@@ -3,12 +3,112 @@ import posixpath
 import os
 from hashlib import sha256
 import argparse
+import json
+from concurrent.futures import ThreadPoolExecutor
 
-def retrieve_NCNR_datafiles(path, localpath="datafiles", extension=None, check_signature=True, verbose=True):
+MANIFEST_NAME = ".ncnr_manifest.json"
+
+def file_sha256(fullpath, chunk_size=1024*1024):
+    """ sha256 (upper-case hex) of a file, read in chunks rather than all at once """
+
+    h = sha256()
+    with open(fullpath, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            h.update(chunk)
+    return h.hexdigest().upper()
+
+def load_manifest(localpath):
+    """ The local signature manifest: {filename: {'size', 'mtime', 'sha256'}}
+    for the files already hashed in localpath """
+
+    try:
+        with open(os.path.join(localpath, MANIFEST_NAME), 'rt') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+def save_manifest(localpath, manifest):
+    """ Write the manifest (dropping files that no longer exist), replacing the old one atomically """
+
+    manifest = dict([(fn, v) for fn, v in manifest.items() if os.path.exists(os.path.join(localpath, fn))])
+    manifest_fullpath = os.path.join(localpath, MANIFEST_NAME)
+    with open(manifest_fullpath + ".tmp", 'wt') as f:
+        json.dump(manifest, f, indent=0, sort_keys=True)
+    os.replace(manifest_fullpath + ".tmp", manifest_fullpath)
+
+def local_sha256(localpath, fn, manifest):
+    """ sha256 of a local file, taken from the manifest while the file's size and
+    modification time are unchanged since it was hashed, and recorded there otherwise """
+
+    local_fullpath = os.path.join(localpath, fn)
+    stat = os.stat(local_fullpath)
+    entry = manifest.get(fn)
+    if entry is not None and entry['size'] == stat.st_size and entry['mtime'] == stat.st_mtime_ns:
+        return entry['sha256']
+    local_hash = file_sha256(local_fullpath)
+    manifest[fn] = {'size': stat.st_size, 'mtime': stat.st_mtime_ns, 'sha256': local_hash}
+    return local_hash
+
+def response_validator(response):
+    """ The ETag (or else Last-Modified) of a response, which identifies the
+    version of the remote file; None if the server sends neither """
+
+    return response.headers.get('ETag', response.headers.get('Last-Modified'))
+
+def download_file(session, url, local_fullpath, chunk_size=1024*1024):
+    """ Stream url to local_fullpath + '.part' and rename it into place once
+    complete, so an interrupted download never leaves a truncated data file.
+    If a .part file is left over from an earlier attempt, only the rest of
+    the file is requested (HTTP Range) and appended to it. The remote file's
+    validator is kept next to the .part file and sent as If-Range, and the
+    .part file is discarded unless the server answers with a 206 for that
+    same version, so a file that changed remotely is downloaded afresh
+    rather than spliced from two versions """
+
+    part_fullpath = local_fullpath + ".part"
+    validator_fullpath = part_fullpath + ".validator"
+    validator = None
+    if os.path.exists(part_fullpath) and os.path.exists(validator_fullpath):
+        with open(validator_fullpath, 'rt') as f:
+            validator = f.read()
+    headers = {}
+    if validator:
+        headers['Range'] = "bytes={start}-".format(start=os.path.getsize(part_fullpath))
+        headers['If-Range'] = validator
+    with session.get(url, headers=headers, stream=True, timeout=60) as response:
+        if response.status_code == 416:
+            # the .part file is already complete (or larger than the remote file); start over
+            os.remove(part_fullpath)
+            os.remove(validator_fullpath)
+            return download_file(session, url, local_fullpath, chunk_size=chunk_size)
+        response.raise_for_status()
+        resume = (validator and response.status_code == 206 and response_validator(response) == validator)
+        if validator and response.status_code == 206 and not resume:
+            # a partial response for another version of the file (or without one); start over
+            os.remove(part_fullpath)
+            if os.path.exists(validator_fullpath):
+                os.remove(validator_fullpath)
+            return download_file(session, url, local_fullpath, chunk_size=chunk_size)
+        if not resume:
+            if os.path.exists(validator_fullpath):
+                os.remove(validator_fullpath)
+            if response_validator(response) is not None:
+                with open(validator_fullpath, 'wt') as f:
+                    f.write(response_validator(response))
+        with open(part_fullpath, 'ab' if resume else 'wb') as part_file:
+            for chunk in response.iter_content(chunk_size=chunk_size):
+                part_file.write(chunk)
+    os.replace(part_fullpath, local_fullpath)
+    if os.path.exists(validator_fullpath):
+        os.remove(validator_fullpath)
+
+def retrieve_NCNR_datafiles(path, localpath="datafiles", extension=None, check_signature=True, verbose=True, jobs=4):
     """ Get a listing of all the datafiles matching the extension in
     the specified path, and retrieve them locally if they do no exist here
     or if check_signature=True and the remote signature differs from the
-    local sha256 """
+    local sha256. Up to jobs files are hashed or downloaded at once, downloads
+    over one shared (connection-pooled) session. Local signatures are kept in
+    a manifest in localpath, so unchanged files are not hashed again """
     
     pathlist = posixpath.split(path)
     data = {'pathlist[]' : pathlist}
@@ -29,16 +129,24 @@ def retrieve_NCNR_datafiles(path, localpath="datafiles", extension=None, check_s
     if not os.path.exists(localpath):
         os.mkdir(localpath)
         
+    jobs = max(int(jobs), 1)
+    manifest = load_manifest(localpath)
+    local_hashes = {}
+    if check_signature:
+        existing = [fn for fn in files_metadata if os.path.exists(os.path.join(localpath, fn))]
+        with ThreadPoolExecutor(max_workers=jobs) as pool:
+            local_hashes = dict(zip(existing, pool.map(lambda fn: local_sha256(localpath, fn, manifest), existing)))
+
+    to_retrieve = []
     for fn in files_metadata:
         retrieve = False
-        local_fullpath = os.path.join(localpath, fn)
         if not os.path.exists(os.path.join(localpath, fn)):
             if verbose:
                 print("file does not exist locally... retrieving: " + fn)
             retrieve = True
         else:
             if check_signature:
-                local_hash = sha256(open(local_fullpath, 'rb').read()).hexdigest().upper()
+                local_hash = local_hashes[fn]
                 if local_hash.upper() != files_metadata[fn]['sha256'].upper():
                     retrieve = True
                     if verbose:
@@ -52,8 +160,37 @@ def retrieve_NCNR_datafiles(path, localpath="datafiles", extension=None, check_s
                     print("file exists locally and not checking signatures: " + fn)
         
         if retrieve:
-            file_contents = requests.get(posixpath.join(remote_url, fn)).content
-            open(local_fullpath, 'wb').write(file_contents)
+            to_retrieve.append(fn)
+
+    if to_retrieve == []:
+        save_manifest(localpath, manifest)
+        return
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=jobs)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+
+    def retrieve_one(fn):
+        download_file(session, posixpath.join(remote_url, fn), os.path.join(localpath, fn))
+        local_hash = local_sha256(localpath, fn, manifest)
+        if check_signature and local_hash != files_metadata[fn]['sha256'].upper():
+            os.remove(os.path.join(localpath, fn))
+            raise OSError("hash of the downloaded file does not match remote")
+        if verbose:
+            print("retrieved: " + fn)
+
+    failed = []
+    with session, ThreadPoolExecutor(max_workers=jobs) as pool:
+        futures = [(fn, pool.submit(retrieve_one, fn)) for fn in to_retrieve]
+        for fn, future in futures:
+            try:
+                future.result()
+            except (requests.RequestException, OSError) as e:
+                failed.append(fn)
+                print("failed to retrieve {fn}: {e}".format(fn=fn, e=e))
+    save_manifest(localpath, manifest)
+    if failed != []:
+        print("{n} file(s) could not be retrieved; run again to resume them.".format(n=len(failed)))
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
@@ -62,9 +199,10 @@ if __name__ == '__main__':
     parser.add_argument("-e", "--extension", help="filter for file endings, e.g. .nxs.ngv")
     parser.add_argument("-f", "--force", action="store_true", help="force re-download even for files you already have")
     parser.add_argument("-q", "--quiet", action="store_true", help="suppress debugging printouts during execution")
+    parser.add_argument("-j", "--jobs", type=int, default=4, help="number of files to download at once (defaults to 4)")
     args = parser.parse_args()
     check_signature = (not args.force)
     verbose = (not args.quiet)
     print(args)
 
-    retrieve_NCNR_datafiles(args.path, localpath=args.localpath, extension=args.extension, check_signature=check_signature, verbose=verbose)
+    retrieve_NCNR_datafiles(args.path, localpath=args.localpath, extension=args.extension, check_signature=check_signature, verbose=verbose, jobs=args.jobs)
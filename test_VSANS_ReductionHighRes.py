@@ -0,0 +1,92 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import h5py
+import numpy as np
+
+import VSANS_ReductionHighRes as VSANS
+
+DETECTORS = ["B", "MT", "MB", "MR", "ML", "FT", "FB", "FR", "FL"]
+SHAPES = dict([(dshort, (16, 24) if dshort == 'B' else (4, 6)) for dshort in DETECTORS])
+CONFIG = 'CvB_test'
+
+def write_run(input_path, filenumber, count_time, mean_counts, rng):
+    """ A minimal run file with the monitor, count time and detector data AbsScale reads """
+
+    with h5py.File(os.path.join(input_path, "sans{n}.nxs.ngv".format(n=filenumber)), 'w') as f:
+        f['entry/control/monitor_counts'] = [1.0E8]
+        f['entry/collection_time'] = [count_time]
+        for dshort in DETECTORS:
+            f['entry/instrument/detector_{ds}/data'.format(ds=dshort)] = rng.poisson(mean_counts, SHAPES[dshort]).astype(np.int32)
+
+def block_sum(data, factor):
+    return data.reshape(data.shape[0]//factor, factor, data.shape[1]//factor, factor).sum(axis=(1, 3))
+
+class RearPanelAbsScaleTest(unittest.TestCase):
+
+    def setUp(self):
+        self.input_path = tempfile.mkdtemp() + os.sep
+        rng = np.random.default_rng(0)
+        write_run(self.input_path, 10001, 100.0, 50, rng)
+        write_run(self.input_path, 10002, 200.0, 2, rng) #blocked beam
+        self.saved = dict([(name, VSANS.__dict__.get(name)) for name in ('all_detectors', 'nonhighres_detectors', 'PrefetchDepth', 'HighResRebin', 'ComputeDType')])
+        VSANS.all_detectors = DETECTORS
+        VSANS.nonhighres_detectors = DETECTORS[1:]
+        VSANS.PrefetchDepth = 0
+        VSANS.ComputeDType = 'float64'
+        self.plex = dict([(dshort, rng.uniform(0.8, 1.2, SHAPES[dshort])) for dshort in DETECTORS])
+        self.scatt = {'S' : {'Config(s)' : {CONFIG : {'Unpol' : [10001]}}}}
+        self.window = (4, 11, 8, 19) #HighResMinX, HighResMaxX, HighResMinY, HighResMaxY
+
+    def tearDown(self):
+        VSANS.clear_panel_cache(report=False)
+        VSANS.close_pooled_files(report=False)
+        for name, value in self.saved.items():
+            if value is None:
+                delattr(VSANS, name) #only set by the user input
+            else:
+                setattr(VSANS, name, value)
+        shutil.rmtree(self.input_path)
+
+    def abs_scale(self, convert_to_subset, plex, solid_angle, blockbeam_subset):
+        blockbeam, blockbeam_unc = VSANS.VSANS_BlockedBeamCountsPerSecond_ListOfFiles(self.input_path, [10002], CONFIG, 10001, blockbeam_subset)
+        scaled, scaled_unc = VSANS.AbsScale(1, self.input_path, *self.window, convert_to_subset, 100.0, 'Unpol', 'S', CONFIG, blockbeam, solid_angle, plex, self.scatt, {}, blockbeam_subset)
+        return scaled
+
+    def test_rebinned_rear_panel(self):
+        solid_angle = dict([(dshort, 1.0E-6) for dshort in DETECTORS])
+        full = self.abs_scale(0, self.plex, solid_angle, None)
+        for factor in (2, 4, 8):
+            VSANS.HighResRebin = factor
+            spec = VSANS.HighRes_ReadSpec(*self.window, 0)
+            self.assertEqual(spec, VSANS.HighRes_Rebin(factor))
+            plex = dict(self.plex)
+            plex['B'] = block_sum(self.plex['B'], factor)/factor**2
+            rebinned_solid_angle = dict(solid_angle)
+            rebinned_solid_angle['B'] = solid_angle['B']*factor**2
+            for blockbeam_subset in (spec, None):
+                rebinned = self.abs_scale(0, plex, rebinned_solid_angle, blockbeam_subset)
+                self.assertEqual(rebinned['B'].shape, (16//factor, 24//factor))
+                # the counts per block are the sums of the counts per pixel
+                np.testing.assert_allclose(rebinned['B']*plex['B']*rebinned_solid_angle['B'],
+                                           block_sum(full['B']*self.plex['B']*solid_angle['B'], factor), rtol=1e-12)
+                for dshort in DETECTORS[1:]:
+                    np.testing.assert_array_equal(rebinned[dshort], full[dshort])
+
+    def test_subset_blocked_beam(self):
+        solid_angle = dict([(dshort, 1.0E-6) for dshort in DETECTORS])
+        subset = VSANS.HighRes_Subset(*self.window)
+        plex = dict(self.plex)
+        plex['B'] = self.plex['B'][subset[0]:subset[1], subset[2]:subset[3]]
+        as_subset = self.abs_scale(1, plex, solid_angle, subset)
+        as_full_panel = self.abs_scale(1, plex, solid_angle, None)
+        self.assertEqual(as_subset['B'].shape, (8, 12))
+        np.testing.assert_array_equal(as_subset['B'], as_full_panel['B'])
+        VSANS.HighResRebin = 2
+        with self.assertRaises(ValueError):
+            self.abs_scale(1, plex, solid_angle, VSANS.HighRes_Rebin(2))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,138 @@
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import requests
+
+from get_ncnr_files import download_file
+
+CONTENT = bytes(range(256))*400
+
+class RangeHandler(BaseHTTPRequestHandler):
+    """ Serves server.content with server.etag, honouring Range (and If-Range)
+    unless server.ignore_range is set; the headers of each request are kept
+    in server.requests """
+
+    def do_GET(self):
+        server = self.server
+        server.requests.append(dict(self.headers))
+        content = server.content
+        byte_range = self.headers.get('Range')
+        if_range = self.headers.get('If-Range')
+        if byte_range is None or server.ignore_range or (if_range is not None and if_range != server.etag):
+            self.send_response(200)
+            self.send_header('ETag', server.etag)
+            self.send_header('Content-Length', str(len(content)))
+            self.end_headers()
+            self.wfile.write(content)
+            return
+        start = int(byte_range.split('=')[1].split('-')[0])
+        if start >= len(content):
+            self.send_response(416)
+            self.send_header('Content-Range', 'bytes */{n}'.format(n=len(content)))
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        self.send_response(206)
+        self.send_header('ETag', server.etag)
+        self.send_header('Content-Range', 'bytes {start}-{end}/{n}'.format(start=start, end=len(content) - 1, n=len(content)))
+        self.send_header('Content-Length', str(len(content) - start))
+        self.end_headers()
+        self.wfile.write(content[start:])
+
+    def log_message(self, format, *args):
+        return
+
+class DownloadFileTest(unittest.TestCase):
+
+    def setUp(self):
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), RangeHandler)
+        self.server.content = CONTENT
+        self.server.etag = '"v1"'
+        self.server.ignore_range = False
+        self.server.requests = []
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        self.url = 'http://127.0.0.1:{port}/sans12345.nxs.ngv'.format(port=self.server.server_address[1])
+        self.localpath = tempfile.mkdtemp()
+        self.local_fullpath = os.path.join(self.localpath, 'sans12345.nxs.ngv')
+        self.session = requests.Session()
+
+    def tearDown(self):
+        self.session.close()
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.localpath)
+
+    def write_part(self, data, validator):
+        with open(self.local_fullpath + '.part', 'wb') as f:
+            f.write(data)
+        if validator is not None:
+            with open(self.local_fullpath + '.part.validator', 'wt') as f:
+                f.write(validator)
+
+    def assertDownloaded(self, content=CONTENT):
+        with open(self.local_fullpath, 'rb') as f:
+            self.assertEqual(f.read(), content)
+        self.assertEqual(os.listdir(self.localpath), ['sans12345.nxs.ngv'])
+
+    def test_fresh_download(self):
+        download_file(self.session, self.url, self.local_fullpath, chunk_size=1000)
+        self.assertDownloaded()
+        self.assertNotIn('Range', self.server.requests[0])
+
+    def test_resume_part(self):
+        self.write_part(CONTENT[:30000], '"v1"')
+        download_file(self.session, self.url, self.local_fullpath)
+        self.assertDownloaded()
+        self.assertEqual(len(self.server.requests), 1)
+        self.assertEqual(self.server.requests[0]['Range'], 'bytes=30000-')
+        self.assertEqual(self.server.requests[0]['If-Range'], '"v1"')
+
+    def test_416_starts_over(self):
+        self.write_part(CONTENT + b'extra', '"v1"')
+        download_file(self.session, self.url, self.local_fullpath)
+        self.assertDownloaded()
+        self.assertEqual(len(self.server.requests), 2)
+        self.assertNotIn('Range', self.server.requests[1])
+
+    def test_server_ignoring_range(self):
+        self.server.ignore_range = True
+        self.write_part(CONTENT[:30000], '"v1"')
+        download_file(self.session, self.url, self.local_fullpath)
+        self.assertDownloaded()
+
+    def test_remote_file_changed(self):
+        self.server.content = CONTENT[::-1]
+        self.server.etag = '"v2"'
+        self.write_part(CONTENT[:30000], '"v1"')
+        download_file(self.session, self.url, self.local_fullpath)
+        self.assertDownloaded(CONTENT[::-1])
+
+    def test_part_without_validator_is_discarded(self):
+        self.write_part(b'unknown version', None)
+        download_file(self.session, self.url, self.local_fullpath)
+        self.assertDownloaded()
+        self.assertNotIn('Range', self.server.requests[0])
+
+    def test_partial_response_for_other_version(self):
+        #a server that ignores If-Range and sends the rest of another version
+        self.server.content = CONTENT[::-1]
+        self.server.etag = '"v2"'
+        self.write_part(CONTENT[:30000], '"v1"')
+        self.server.requests = []
+        original_get = self.session.get
+        def get_without_if_range(url, headers=None, **kwargs):
+            headers = dict(headers or {})
+            headers.pop('If-Range', None)
+            return original_get(url, headers=headers, **kwargs)
+        self.session.get = get_without_if_range
+        download_file(self.session, self.url, self.local_fullpath)
+        self.assertDownloaded(CONTENT[::-1])
+        self.assertEqual(len(self.server.requests), 2)
+
+if __name__ == '__main__':
+    unittest.main()